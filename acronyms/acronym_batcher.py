@@ -1,13 +1,203 @@
+from collections import defaultdict
+import hashlib
+import json
+import os
+
 from allennlp.data.tokenizers.token import Token
 import numpy as np
 
+home_dir = os.path.expanduser('~/LMC/')
+CACHE_DIR = os.path.join(home_dir, 'weights', 'acronyms', 'cache')
+CACHE_VERSION = 3  # Increment whenever the layout of the tensorized arrays changes
+MAX_LF_LEN = 5
+BUCKET_OPTIONS = [None, 'sf', 'num_outputs']
+CANDIDATE_KEYS = ['sfs', 'num_outputs', 'lf_ids', 'lf_token_ct', 'sf_lf_offsets', 'lf_metadata_offsets',
+                  'lf_metadata_ids', 'lf_metadata_p']
+
+
+def _metadata_column_ids(df, col, m_vocab):
+    """
+    :return: vocabulary id for every value in df[col].  Missing columns and unknown values are mapped to 0 (padding).
+    """
+    if col not in df.columns:
+        return np.zeros([df.shape[0], ], dtype=int)
+    ids = np.array([m_vocab.get_id(name) for name in df[col].tolist()], dtype=int)
+    ids[ids < 0] = 0
+    return ids
+
+
+def compute_lf_metadata_csr(sfs, sf_lf_map, lf_metadata_counts, metadata_vocab):
+    """
+    :param sfs: ordered list of SFs
+    :param sf_lf_map: dictionary mapping SFs to original string LFs
+    :param lf_metadata_counts: dictionary mapping LFs to metadata counts.  None if the model does not use metadata.
+    :param metadata_vocab: metadata-specific vocabulary (LMC only)
+    :return: sf_lf_offsets, lf_metadata_offsets, lf_metadata_ids, lf_metadata_p
+
+    p(metadata|LF) is ragged (most LFs appear in a handful of sections) so it is stored in compressed sparse row form
+    rather than padded to the size of the metadata vocabulary.  The j^th candidate LF of sfs[i] is the pair
+    sf_lf_offsets[i] + j and its metadata are lf_metadata_ids[lf_metadata_offsets[pair]:lf_metadata_offsets[pair + 1]]
+    (likewise for lf_metadata_p).  LFs never seen in the metadata counts are assigned a single entry (id=0, p=1).
+    """
+    sf_lf_offsets = np.zeros([len(sfs) + 1], dtype=int)
+    lf_metadata_offsets = [0]
+    lf_metadata_ids, lf_metadata_p = [], []
+    for sf_idx, sf in enumerate(sfs):
+        candidate_lf_senses = sf_lf_map[sf]
+        sf_lf_offsets[sf_idx + 1] = sf_lf_offsets[sf_idx] + len(candidate_lf_senses)
+        for lf_sense in candidate_lf_senses:
+            if lf_metadata_counts is not None:
+                if lf_sense in lf_metadata_counts:
+                    lf_m = lf_metadata_counts[lf_sense]
+                    k = 'section' if 'section' in lf_m.keys() else 'category'
+                    lf_metadata_ids += metadata_vocab.get_ids(lf_m[k])
+                    lf_metadata_p += list(lf_m['p'])
+                else:
+                    lf_metadata_ids.append(0)
+                    lf_metadata_p.append(1.0)
+            lf_metadata_offsets.append(len(lf_metadata_ids))
+    return (sf_lf_offsets, np.array(lf_metadata_offsets, dtype=int), np.array(lf_metadata_ids, dtype=int),
+            np.array(lf_metadata_p, dtype=float))
+
+
+def _ragged_arange(starts, counts):
+    """
+    :return: concatenation of np.arange(start, start + count) for every (start, count) pair
+    """
+    segment_starts = np.cumsum(counts) - counts
+    return np.repeat(starts - segment_starts, counts) + np.arange(counts.sum())
+
+
+def tensorize_candidates(sfs, token_vocab, sf_lf_map, sf_tokenized_lf_map, lf_metadata_counts, metadata_vocab=None):
+    """
+    :param sfs: ordered list of SFs
+    :param token_vocab: unigram token vocabulary
+    :param sf_lf_map: dictionary mapping SFs to original string LFs
+    :param sf_tokenized_lf_map: dictionary mapping SFs to tokenized LFs
+    :param lf_metadata_counts: dictionary mapping LFs to metadata counts.  Used for computing p(metadata|LF)
+    :param metadata_vocab: metadata-specific vocabulary (LMC only)
+    :return: dictionary of numpy arrays (CANDIDATE_KEYS) with one row per SF in sfs
+
+    Candidate LFs only depend on the SF so they are stored once per SF:
+    - sfs, num_outputs, lf_ids, lf_token_ct
+    - sf_lf_offsets, lf_metadata_offsets, lf_metadata_ids, lf_metadata_p: p(metadata|LF) in CSR form (see
+    compute_lf_metadata_csr)
+
+    Computing these once for every SF in sf_lf_map and passing them to each AcronymBatcherLoader (i.e. when serving)
+    lets the expanders reuse LF Gaussians cached for these arrays across batchers (see cache_lf_gaussians).
+    """
+    num_sfs = len(sfs)
+    num_outputs = np.array([len(sf_tokenized_lf_map[sf]) for sf in sfs], dtype=int)
+    max_output_length = num_outputs.max() if num_sfs > 0 else 0
+    lf_ids = np.zeros([num_sfs, max_output_length, MAX_LF_LEN], dtype=int)
+    lf_token_ct = np.zeros([num_sfs, max_output_length])
+    for sf_idx, sf in enumerate(sfs):
+        for lf_idx, lf_toks in enumerate(sf_tokenized_lf_map[sf]):
+            lf_id_seq = token_vocab.get_ids(lf_toks)
+            assert len(lf_id_seq) <= MAX_LF_LEN
+            num_toks = len(lf_id_seq)
+            assert num_toks > 0
+            lf_ids[sf_idx, lf_idx, :num_toks] = lf_id_seq
+            lf_token_ct[sf_idx, lf_idx] = num_toks
+
+    sf_lf_offsets, lf_metadata_offsets, lf_metadata_ids, lf_metadata_p = compute_lf_metadata_csr(
+        sfs, sf_lf_map, lf_metadata_counts, metadata_vocab)
+
+    return {
+        'sfs': np.array(sfs, dtype=str),
+        'num_outputs': num_outputs,
+        'lf_ids': lf_ids,
+        'lf_token_ct': lf_token_ct,
+        'sf_lf_offsets': sf_lf_offsets,
+        'lf_metadata_offsets': lf_metadata_offsets,
+        'lf_metadata_ids': lf_metadata_ids,
+        'lf_metadata_p': lf_metadata_p,
+    }
+
+
+def tensorize_examples(df, token_vocab, sf_lf_map, sf_tokenized_lf_map, lf_metadata_counts, metadata_vocab=None,
+                       candidates=None):
+    """
+    :param df: acronym expansion examples (sf, target_lf_idx, trimmed_tokens and optionally section / category)
+    :param token_vocab: unigram token vocabulary
+    :param sf_lf_map: dictionary mapping SFs to original string LFs
+    :param sf_tokenized_lf_map: dictionary mapping SFs to tokenized LFs
+    :param lf_metadata_counts: dictionary mapping LFs to metadata counts.  Used for computing p(metadata|LF)
+    :param metadata_vocab: metadata-specific vocabulary (LMC only)
+    :param candidates: Optional output of tensorize_candidates covering every SF in df.  Otherwise, computed for the
+    unique SFs in df.
+    :return: dictionary of numpy arrays
+
+    Per-example arrays (one row for each row in df, in order):
+    - sf_ids, section_ids, category_ids, target_lf_ids, num_contexts, example_sf_idxs
+    - context_ids: padded to the longest context in df.  Out of vocabulary tokens are -1 (clamped when batched).
+
+    Along with the candidate arrays (see tensorize_candidates) indexed by example_sf_idxs.
+    """
+    N = df.shape[0]
+    sfs = df['sf'].tolist()
+    if candidates is None:
+        candidates = tensorize_candidates(sorted(set(sfs)), token_vocab, sf_lf_map, sf_tokenized_lf_map,
+                                          lf_metadata_counts, metadata_vocab=metadata_vocab)
+    sf_idx_map = {sf: sf_idx for sf_idx, sf in enumerate(candidates['sfs'].tolist())}
+
+    context_id_seqs = [token_vocab.get_ids(tt.split()) for tt in df['trimmed_tokens'].tolist()]
+    num_contexts = np.array([len(seq) for seq in context_id_seqs], dtype=int)
+    context_ids = np.zeros([N, num_contexts.max() if N > 0 else 0], dtype=int)
+    for example_idx, seq in enumerate(context_id_seqs):
+        context_ids[example_idx, :len(seq)] = seq
+    m_vocab = metadata_vocab or token_vocab
+
+    arrays = {
+        'sf_ids': np.array([token_vocab.get_id(sf.lower()) for sf in sfs], dtype=int),
+        'section_ids': _metadata_column_ids(df, 'section', m_vocab),
+        'category_ids': _metadata_column_ids(df, 'category', m_vocab),
+        'target_lf_ids': np.array(df['target_lf_idx'].tolist(), dtype=int),
+        'num_contexts': num_contexts,
+        'context_ids': context_ids,
+        'example_sf_idxs': np.array([sf_idx_map[sf] for sf in sfs], dtype=int),
+    }
+    arrays.update(candidates)
+    return arrays
+
+
+def _tensorized_key(token_vocab, sf_lf_map, sf_tokenized_lf_map, lf_metadata_counts, metadata_vocab):
+    # Cheap identity check which detects when a batcher is reused with different vocabularies or SF-LF maps
+    return (id(token_vocab), token_vocab.size(), id(sf_lf_map), id(sf_tokenized_lf_map), id(lf_metadata_counts),
+            id(metadata_vocab))
+
+
+def _vocab_hash(vocab):
+    if vocab is None:
+        return 'none'
+    return hashlib.md5('\n'.join(vocab.i2w).encode('utf-8')).hexdigest()
+
 
 class AcronymBatcherLoader:
-    def __init__(self, df, batch_size=32):
+    def __init__(self, df, batch_size=32, data_fp=None, bucket_by=None, sf_lf_map=None, candidates=None):
+        """
+        :param df: acronym expansion examples
+        :param batch_size: number of examples per batch
+        :param data_fp: Optional csv from which df was loaded.  If provided, tensorized examples are cached in
+        weights/acronyms/cache keyed by the file, the rows of df, and the vocabularies and SF-LF maps used.
+        :param bucket_by: Optionally group examples into batches by 'sf' or by 'num_outputs' (number of candidate LFs)
+        so that fewer candidates are padded to the longest in the batch.  None batches examples irrespective of SF.
+        :param sf_lf_map: dictionary mapping SFs to original string LFs.  Required for bucket_by='num_outputs'
+        :param candidates: Optional output of tensorize_candidates shared across batchers.  It must have been computed
+        with the same vocabularies and maps later passed to next.  Tensorized examples are then never cached on disk.
+        """
+        assert bucket_by in BUCKET_OPTIONS
+        assert bucket_by != 'num_outputs' or sf_lf_map is not None
         self.batch_size = batch_size
+        self.bucket_by = bucket_by
+        self.sf_lf_map = sf_lf_map
         self.N = df.shape[0]
         self.data = df
+        self.data_fp = data_fp
         self.batch_ct, self.batches = 0, None
+        self.arrays, self.tensorized_for = None, None
+        self.shared_candidates = candidates is not None
+        self.candidates = candidates
 
     def num_batches(self):
         return len(self.batches)
@@ -15,8 +205,11 @@ class AcronymBatcherLoader:
     def has_next(self):
         return self.batch_ct < self.num_batches()
 
+    def get_batch_df(self, batch_ct):
+        return self.data.iloc[self.batches[batch_ct]]
+
     def get_prev_batch(self):
-        return self.batches[self.batch_ct - 1]
+        return self.get_batch_df(self.batch_ct - 1)
 
     def elmo_tokenize(self, tokens, vocab, indexer):
         tokens = list(map(lambda t: Token(t), tokens))
@@ -28,7 +221,7 @@ class AcronymBatcherLoader:
     def bert_next(self, tokenizer, sf_tokenized_lf_map):
         max_lf_len = 10
         max_context_len = 50
-        batch = self.batches[self.batch_ct]
+        batch = self.get_batch_df(self.batch_ct)
         self.batch_ct += 1
         batch_size = batch.shape[0]
         target_lf_ids = np.zeros([batch_size, ], dtype=int)
@@ -58,7 +251,7 @@ class AcronymBatcherLoader:
         return (context_ids, context_token_ct, lf_ids, lf_token_ct, target_lf_ids), num_outputs
 
     def elmo_next(self, vocab, indexer, sf_tokenized_lf_map):
-        batch = self.batches[self.batch_ct]
+        batch = self.get_batch_df(self.batch_ct)
         self.batch_ct += 1
         batch_size = batch.shape[0]
         target_lf_ids = np.zeros([batch_size, ], dtype=int)
@@ -89,81 +282,150 @@ class AcronymBatcherLoader:
 
         return (context_ids, context_token_ct, lf_ids, lf_token_ct, target_lf_ids), num_outputs
 
+    def _cache_fp(self, token_vocab, sf_lf_map, sf_tokenized_lf_map, lf_metadata_counts, metadata_vocab):
+        stat = os.stat(self.data_fp)
+        key = hashlib.md5()
+        key.update(json.dumps([CACHE_VERSION, os.path.abspath(self.data_fp), stat.st_size, stat.st_mtime]).encode())
+        key.update(np.ascontiguousarray(self.data.index.values).tobytes())
+        key.update(_vocab_hash(token_vocab).encode())
+        key.update(_vocab_hash(metadata_vocab).encode())
+        for obj in [sf_lf_map, sf_tokenized_lf_map, lf_metadata_counts]:
+            key.update(json.dumps(obj, sort_keys=True).encode())
+        name = os.path.splitext(os.path.basename(self.data_fp))[0]
+        return os.path.join(CACHE_DIR, '{}_{}.npz'.format(name, key.hexdigest()))
+
+    def tensorize(self, token_vocab, sf_lf_map, sf_tokenized_lf_map, lf_metadata_counts, metadata_vocab=None):
+        """
+        :return: None
+
+        Converts every example into columnar numpy arrays (see tensorize_examples) once so that batching is just
+        slicing.  Arrays are reloaded from the on-disk cache when available.
+        """
+        self.tensorized_for = _tensorized_key(
+            token_vocab, sf_lf_map, sf_tokenized_lf_map, lf_metadata_counts, metadata_vocab)
+        if self.shared_candidates:
+            self.arrays = tensorize_examples(self.data, token_vocab, sf_lf_map, sf_tokenized_lf_map, lf_metadata_counts,
+                                             metadata_vocab=metadata_vocab, candidates=self.candidates)
+            return
+        cache_fp = None
+        if self.data_fp is not None:
+            cache_fp = self._cache_fp(token_vocab, sf_lf_map, sf_tokenized_lf_map, lf_metadata_counts, metadata_vocab)
+            if os.path.exists(cache_fp):
+                with np.load(cache_fp) as arrays:
+                    self.arrays = {k: arrays[k] for k in arrays.files}
+                self.candidates = {k: self.arrays[k] for k in CANDIDATE_KEYS}
+                return
+        self.arrays = tensorize_examples(
+            self.data, token_vocab, sf_lf_map, sf_tokenized_lf_map, lf_metadata_counts, metadata_vocab=metadata_vocab)
+        self.candidates = {k: self.arrays[k] for k in CANDIDATE_KEYS}
+        if cache_fp is not None:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            tmp_fp = '{}.{}.tmp'.format(cache_fp, os.getpid())
+            with open(tmp_fp, 'wb') as fd:
+                np.savez(fd, **self.arrays)
+            os.replace(tmp_fp, cache_fp)
+            print('Cached tensorized examples to {}'.format(cache_fp))
+
     def next(self, token_vocab, sf_lf_map, sf_tokenized_lf_map, lf_metadata_counts, metadata_vocab=None):
-        batch = self.batches[self.batch_ct]
+        tensorized_for = _tensorized_key(
+            token_vocab, sf_lf_map, sf_tokenized_lf_map, lf_metadata_counts, metadata_vocab)
+        if self.arrays is None or tensorized_for != self.tensorized_for:
+            self.tensorize(token_vocab, sf_lf_map, sf_tokenized_lf_map, lf_metadata_counts, metadata_vocab)
+        batch_idxs = self.batches[self.batch_ct]
         self.batch_ct += 1
-        batch_size = batch.shape[0]
-        sf_ids = np.zeros([batch_size, ], dtype=int)
-        section_ids = np.zeros([batch_size, ], dtype=int)
-        category_ids = np.zeros([batch_size, ], dtype=int)
-        num_contexts = np.zeros([batch_size, ], dtype=int)
-        target_lf_ids = np.zeros([batch_size, ], dtype=int)
-        max_context_len = max([len(tt.split()) for tt in batch['trimmed_tokens'].tolist()])
-        num_outputs = [len(sf_tokenized_lf_map[sf]) for sf in batch['sf'].tolist()]
-        context_ids = np.zeros([batch_size, max_context_len])
-        max_output_length = max(num_outputs)
-        max_lf_len = 5
-        lf_ids = np.zeros([batch_size, max_output_length, max_lf_len], dtype=int)
-        lf_token_ct = np.zeros([batch_size, max_output_length])
-        max_num_metadata = metadata_vocab.size() if metadata_vocab is not None else 1
-        actual_max_num_metadata = 0
-        lf_metadata_p = np.zeros([batch_size, max_output_length, max_num_metadata])
-        lf_metadata_ids = np.zeros([batch_size, max_output_length, max_num_metadata], dtype=int)
-        m_vocab = metadata_vocab or token_vocab
-        for batch_idx, (_, row) in enumerate(batch.iterrows()):
-            row = row.to_dict()
-            sf_ids[batch_idx] = token_vocab.get_id(row['sf'].lower())
-            # Find target_sf index in sf_lf_map
-            target_lf_ids[batch_idx] = row['target_lf_idx']
-            context_id_seq = token_vocab.get_ids(row['trimmed_tokens'].split())
-            num_context = len(context_id_seq)
-            context_ids[batch_idx, :num_context] = context_id_seq
-            num_contexts[batch_idx] = num_context
-            candidate_lf_tokenized = sf_tokenized_lf_map[row['sf']]
-            candidate_lf_senses = sf_lf_map[row['sf']]
-            if 'section' in row:
-                section_ids[batch_idx] = m_vocab.get_id(row['section'])
-                if section_ids[batch_idx] < 0:
-                    section_ids[batch_idx] = 0
-                    # print('Not found={}'.format(row['section']))
-            if 'category' in row:
-                category_ids[batch_idx] = m_vocab.get_id(row['category'])
-                if category_ids[batch_idx] < 0:
-                    category_ids[batch_idx] = 0
-                    # print('Not found={}'.format(row['category']))
-
-            for lf_idx, lf_toks in enumerate(candidate_lf_tokenized):
-                lf_id_seq = token_vocab.get_ids(lf_toks)
-                lf_sense = candidate_lf_senses[lf_idx]
-                assert len(lf_id_seq) <= max_lf_len
-                num_toks = len(lf_id_seq)
-                assert num_toks > 0
-                lf_ids[batch_idx, lf_idx, :num_toks] = lf_id_seq
-                lf_token_ct[batch_idx, lf_idx] = num_toks
-
-                if lf_metadata_counts is not None:
-                    if lf_sense in lf_metadata_counts:
-                        lf_m = lf_metadata_counts[lf_sense]
-                        k = 'section' if 'section' in lf_m.keys() else 'category'
-                        lf_m_p, lf_m_name = lf_m['p'], lf_m[k]
-                        metadata_ids = metadata_vocab.get_ids(lf_m_name)
-                        num_m = len(lf_m_p)
-                        actual_max_num_metadata = max(num_m, actual_max_num_metadata)
-                        lf_metadata_p[batch_idx, lf_idx, :num_m] = lf_m_p
-                        lf_metadata_ids[batch_idx, lf_idx, :num_m] = metadata_ids
-                    else:
-                        # raise Exception('Cant find {} in lf metadata counts'.format(lf_sense))
-                        lf_metadata_p[batch_idx, lf_idx, 0] = 1
-
-        actual_max_num_metadata = max(1, actual_max_num_metadata)
-        lf_metadata_ids = lf_metadata_ids[:, :, :actual_max_num_metadata]
-        lf_metadata_p = lf_metadata_p[:, :, :actual_max_num_metadata]
-
-        return (sf_ids, section_ids, category_ids, context_ids, lf_ids, target_lf_ids, lf_token_ct,
-                lf_metadata_ids), [lf_metadata_p], [num_outputs, num_contexts]
+        arrays = self.arrays
+
+        example_sf_idxs = arrays['example_sf_idxs'][batch_idxs]
+        num_outputs = arrays['num_outputs'][example_sf_idxs]
+        max_output_length = num_outputs.max()
+        num_contexts = arrays['num_contexts'][batch_idxs]
+        context_ids = arrays['context_ids'][batch_idxs, :num_contexts.max()]
+        lf_ids = arrays['lf_ids'][example_sf_idxs, :max_output_length]
+        lf_token_ct = arrays['lf_token_ct'][example_sf_idxs, :max_output_length]
+
+        # Gather p(metadata|LF) for the candidate LFs of every example.  Pair positions index the flattened
+        # batch_size x max_output_length grid so the expander can scatter the weighted KL back into it.
+        candidate_example_idxs = np.repeat(np.arange(len(batch_idxs)), num_outputs)
+        candidate_lf_idxs = _ragged_arange(np.zeros_like(num_outputs), num_outputs)
+        pairs = arrays['sf_lf_offsets'][example_sf_idxs][candidate_example_idxs] + candidate_lf_idxs
+        metadata_starts = arrays['lf_metadata_offsets'][pairs]
+        num_metadata = arrays['lf_metadata_offsets'][pairs + 1] - metadata_starts
+        metadata_idxs = _ragged_arange(metadata_starts, num_metadata)
+        lf_metadata_pos = np.repeat(candidate_example_idxs * max_output_length + candidate_lf_idxs, num_metadata)
+        lf_metadata_ids = arrays['lf_metadata_ids'][metadata_idxs]
+        lf_metadata_p = arrays['lf_metadata_p'][metadata_idxs]
+
+        # Row of each candidate in lf_pair_entries (padded candidates point to row 0 and are masked by the expander)
+        lf_pair_ids = arrays['sf_lf_offsets'][example_sf_idxs][:, np.newaxis] + np.arange(max_output_length)
+        lf_pair_ids[np.arange(max_output_length)[np.newaxis, :] >= num_outputs[:, np.newaxis]] = 0
+
+        return (arrays['sf_ids'][batch_idxs], arrays['section_ids'][batch_idxs], arrays['category_ids'][batch_idxs],
+                context_ids, lf_ids, arrays['target_lf_ids'][batch_idxs], lf_token_ct, lf_metadata_ids,
+                lf_metadata_pos, metadata_idxs, lf_pair_ids), [lf_metadata_p], [num_outputs.tolist(), num_contexts]
+
+    def _lf_pair_idxs(self):
+        arrays = self.candidates
+        num_lfs_per_sf = np.diff(arrays['sf_lf_offsets'])
+        pair_sf_idxs = np.repeat(np.arange(len(num_lfs_per_sf)), num_lfs_per_sf)
+        pair_lf_idxs = _ragged_arange(np.zeros_like(num_lfs_per_sf), num_lfs_per_sf)
+        return pair_sf_idxs, pair_lf_idxs
+
+    def lf_pair_entries(self):
+        """
+        :return: lf_ids (num_pairs x MAX_LF_LEN) and lf_token_ct (num_pairs) for every (SF, candidate LF) pair in the
+        candidate arrays.  Row i corresponds to lf_pair_ids == i in the output of next.
+        """
+        pair_sf_idxs, pair_lf_idxs = self._lf_pair_idxs()
+        arrays = self.candidates
+        return arrays['lf_ids'][pair_sf_idxs, pair_lf_idxs], arrays['lf_token_ct'][pair_sf_idxs, pair_lf_idxs]
+
+    def lf_metadata_entries(self):
+        """
+        :return: lf_ids (num_entries x MAX_LF_LEN), lf_token_ct (num_entries) and lf_metadata_ids (num_entries) for
+        every (LF, metadata) entry in the tensorized p(metadata|LF).  Row i corresponds to lf_metadata_idxs == i in
+        the output of next.
+        """
+        arrays = self.candidates
+        pair_sf_idxs, pair_lf_idxs = self._lf_pair_idxs()
+        num_metadata_per_pair = np.diff(arrays['lf_metadata_offsets'])
+        entry_sf_idxs = np.repeat(pair_sf_idxs, num_metadata_per_pair)
+        entry_lf_idxs = np.repeat(pair_lf_idxs, num_metadata_per_pair)
+        return (arrays['lf_ids'][entry_sf_idxs, entry_lf_idxs], arrays['lf_token_ct'][entry_sf_idxs, entry_lf_idxs],
+                arrays['lf_metadata_ids'])
 
     def reset(self, shuffle=True):
+        """
+        :param shuffle: whether to randomize the order of examples
+        :return: None
+
+        Batches are arrays of positions into self.data (and the tensorized arrays) rather than copies of the rows.
+        When bucketing, shuffling randomizes both the examples within each bucket and the order of the batches.
+        """
         self.batch_ct = 0
+        if self.bucket_by is None:
+            order = np.random.permutation(self.N) if shuffle else np.arange(self.N)
+            self.batches = np.array_split(order, self.N // self.batch_size)
+            return
+
+        sfs = self.data['sf'].tolist()
+        if self.bucket_by == 'sf':
+            # Every batch holds a single SF.  Large SFs are split into evenly sized batches of at most batch_size.
+            sf_positions = defaultdict(list)
+            for position, sf in enumerate(sfs):
+                sf_positions[sf].append(position)
+            self.batches = []
+            for sf in sorted(sf_positions):
+                positions = np.array(sf_positions[sf], dtype=int)
+                if shuffle:
+                    positions = np.random.permutation(positions)
+                num_splits = int(np.ceil(len(positions) / float(self.batch_size)))
+                self.batches += np.array_split(positions, num_splits)
+        else:
+            # Sort by number of candidate LFs (random order within ties) and cut contiguous batches so that only
+            # batches straddling two counts are padded.
+            num_outputs = np.array([len(self.sf_lf_map[sf]) for sf in sfs], dtype=int)
+            tiebreak = np.random.rand(self.N) if shuffle else np.arange(self.N)
+            order = np.lexsort((tiebreak, num_outputs))
+            self.batches = np.array_split(order, max(1, self.N // self.batch_size))
         if shuffle:
-            self.data = self.data.sample(frac=1).reset_index(drop=True)
-        self.batches = np.array_split(self.data, self.N // self.batch_size)
+            self.batches = [self.batches[batch_idx] for batch_idx in np.random.permutation(len(self.batches))]
@@ -22,6 +22,7 @@ from acronym_batcher import AcronymBatcherLoader
 from casi_constants import LF_BLACKLIST, LF_MAPPING, SF_BLACKLIST
 from mimic_tokenize import clean_text, create_document_token, create_section_token, get_mimic_stopwords, tokenize_str
 from model_utils import tensor_to_np
+from profile_utils import record_function
 
 
 TOKEN_BLACKLIST = set(string.punctuation).union(get_mimic_stopwords()).union(set(['digitparsed']))
@@ -106,10 +107,11 @@ def eval_tokenize(str, unique_only=False):
     return tokens
 
 
-def load_casi(prev_args, train_frac=1.0, batch_size=32):
+def load_casi(prev_args, train_frac=1.0, batch_size=32, bucket_by=None):
     """
     :param prev_args: argparse instance from pre-trained language model
     :param train_frac: If you want to fine tune the model, this should be about 0.8.
+    :param bucket_by: Optional batching strategy for AcronymBatcherLoader (None, sf, or num_outputs)
     :return: train_batcher, test_batcher, train_df, test_df, sf_lf_map
 
     The sf_lf_map is a dictionary used to get list of candidate LFs (value) for given SF (key)
@@ -136,29 +138,34 @@ def load_casi(prev_args, train_frac=1.0, batch_size=32):
     df = df[df['sf'].isin(mimics_sfs)]
 
     if train_frac == 1.0 or train_frac == 0.0:
-        train_batcher = AcronymBatcherLoader(df, batch_size=32)
-        test_batcher = AcronymBatcherLoader(df, batch_size=batch_size)
+        train_batcher = AcronymBatcherLoader(df, batch_size=32, data_fp=data_fp, bucket_by=bucket_by,
+                                             sf_lf_map=used_sf_lf_map)
+        test_batcher = AcronymBatcherLoader(df, batch_size=batch_size, data_fp=data_fp, bucket_by=bucket_by,
+                                            sf_lf_map=used_sf_lf_map)
         train_df = df
         test_df = df
     else:
         train_df, test_df = train_test_split(df, test_size=1.0 - train_frac)
-        train_batcher = AcronymBatcherLoader(train_df, batch_size=32)
-        test_batcher = AcronymBatcherLoader(test_df, batch_size=batch_size)
+        train_batcher = AcronymBatcherLoader(train_df, batch_size=32, data_fp=data_fp, bucket_by=bucket_by,
+                                             sf_lf_map=used_sf_lf_map)
+        test_batcher = AcronymBatcherLoader(test_df, batch_size=batch_size, data_fp=data_fp, bucket_by=bucket_by,
+                                            sf_lf_map=used_sf_lf_map)
     return train_batcher, test_batcher, train_df, test_df, used_sf_lf_map
 
 
-def load_columbia(prev_args, train_frac=1.0, batch_size=None):
-    return load_rs('columbia', train_frac, batch_size=batch_size)
+def load_columbia(prev_args, train_frac=1.0, batch_size=None, bucket_by=None):
+    return load_rs('columbia', train_frac, batch_size=batch_size, bucket_by=bucket_by)
 
 
-def load_mimic(prev_args, train_frac=1.0, batch_size=None):
-    return load_rs('mimic', train_frac, batch_size=batch_size)
+def load_mimic(prev_args, train_frac=1.0, batch_size=None, bucket_by=None):
+    return load_rs('mimic', train_frac, batch_size=batch_size, bucket_by=bucket_by)
 
 
-def load_rs(dataset, train_frac=1.0, batch_size=None):
+def load_rs(dataset, train_frac=1.0, batch_size=None, bucket_by=None):
     """
     :param dataset: mimic or columbia
     :param train_frac: If you want to fine tune the model, this should be about 0.8.
+    :param bucket_by: Optional batching strategy for AcronymBatcherLoader (None, sf, or num_outputs)
     :return: train_batcher, test_batcher, train_df, test_df, sf_lf_map
 
     The sf_lf_map is a dictionary used to get list of candidate LFs (value) for given SF (key)
@@ -167,8 +174,9 @@ def load_rs(dataset, train_frac=1.0, batch_size=None):
     with open(os.path.join(casi_dir, 'sf_lf_map.json'), 'r') as fd:
         sf_lf_map = json.load(fd)
     used_sf_lf_map = {}
-    df = pd.read_csv(os.path.join(
-        home_dir, 'preprocess/context_extraction/data/{}_rs_dataset_preprocessed_window_10.csv'.format(dataset)))
+    data_fp = os.path.join(
+        home_dir, 'preprocess/context_extraction/data/{}_rs_dataset_preprocessed_window_10.csv'.format(dataset))
+    df = pd.read_csv(data_fp)
     if 'section_mapped' in df.columns:
         df['section'] = df['section_mapped']
     df['section'].fillna('<pad>', inplace=True)
@@ -178,12 +186,16 @@ def load_rs(dataset, train_frac=1.0, batch_size=None):
 
     if train_frac == 1.0 or train_frac == 0.0:
         train_df, test_df = df, df
-        train_batcher = AcronymBatcherLoader(df, batch_size=32)
-        test_batcher = AcronymBatcherLoader(df, batch_size=batch_size)
+        train_batcher = AcronymBatcherLoader(df, batch_size=32, data_fp=data_fp, bucket_by=bucket_by,
+                                             sf_lf_map=used_sf_lf_map)
+        test_batcher = AcronymBatcherLoader(df, batch_size=batch_size, data_fp=data_fp, bucket_by=bucket_by,
+                                            sf_lf_map=used_sf_lf_map)
     else:
         train_df, test_df = train_test_split(df, test_size=1.0 - train_frac)
-        train_batcher = AcronymBatcherLoader(train_df, batch_size=32)
-        test_batcher = AcronymBatcherLoader(test_df, batch_size=batch_size)
+        train_batcher = AcronymBatcherLoader(train_df, batch_size=32, data_fp=data_fp, bucket_by=bucket_by,
+                                             sf_lf_map=used_sf_lf_map)
+        test_batcher = AcronymBatcherLoader(test_df, batch_size=batch_size, data_fp=data_fp, bucket_by=bucket_by,
+                                            sf_lf_map=used_sf_lf_map)
     return train_batcher, test_batcher, train_df, test_df, used_sf_lf_map
 
 
@@ -372,14 +384,23 @@ def process_batch(args, batcher, model, loss_func, token_vocab, metadata_vocab,
     :param token_metadata_counts: dictionary mapping LFs to metadata counts.  Used for computing p(metadata|LF)
     :return: average loss in mini-batch along with other performance metrics
 
-    rel_weight only applies to the LMC model which returns the result of the metadata-token gating function
+    rel_weight only applies to the LMC model which returns the result of the metadata-token gating function.
+    In evaluation mode, the LMC and BSG expanders compute LF Gaussians once per batcher (cache_lf_gaussians) and reuse
+    them across batches.
     """
-    batch_input, batch_p, batch_counts = batcher.next(token_vocab, sf_lf_map, sf_tokenized_lf_map,
-                                                  token_metadata_counts, metadata_vocab=metadata_vocab)
-    batch_input = list(map(lambda x: torch.LongTensor(x).clamp_min_(0).to(args.device), batch_input))
-    batch_p = list(map(lambda x: torch.FloatTensor(x).to(args.device), batch_p))
+    with record_function('batch_building'):
+        batch_input, batch_p, batch_counts = batcher.next(token_vocab, sf_lf_map, sf_tokenized_lf_map,
+                                                      token_metadata_counts, metadata_vocab=metadata_vocab)
+        batch_input = list(map(lambda x: torch.LongTensor(x).clamp_min_(0).to(args.device), batch_input))
+        batch_p = list(map(lambda x: torch.FloatTensor(x).to(args.device), batch_p))
+    cache_kwargs = {}
+    if hasattr(model, 'cache_lf_gaussians'):
+        if not model.training:
+            with record_function('cache_lf_gaussians'):
+                model.cache_lf_gaussians(batcher)
+        cache_kwargs['cache_key'] = batcher.candidates
     full_input = batch_input + batch_counts if args.lm_type == 'bsg' else batch_input + batch_p + batch_counts
-    scores, target, rel_weights = model(*full_input)
+    scores, target, rel_weights = model(*full_input, **cache_kwargs)
     num_correct = len(np.where(tensor_to_np(torch.argmax(scores, 1)) == tensor_to_np(target))[0])
     num_examples = len(batch_counts[0])
     batch_loss = loss_func.forward(scores, target)
@@ -443,7 +464,7 @@ def render_dominant_section_accuracy(train_lf_metadata_counts, val_lf_metadata_c
 
 
 def run_test_epoch(args, test_batcher, model, loss_func, token_vocab, metadata_vocab, sf_tokenized_lf_map,
-               sf_lf_map, token_metadata_counts):
+               sf_lf_map, token_metadata_counts, profiler=None):
     """
     :param args: argparse instance
     :param test_batcher: AcronymBatcherLoader instance
@@ -454,6 +475,7 @@ def run_test_epoch(args, test_batcher, model, loss_func, token_vocab, metadata_v
     :param sf_tokenized_lf_map: dictionary mapping SFs to tokenized LFs
     :param sf_lf_map: dictionary mapping SFs to original string LFs
     :param token_metadata_counts: dictionary mapping LFs to metadata counts.  Used for computing p(metadata|LF)
+    :param profiler: Optional TrainingProfiler which is stepped after every batch
     :return: loss averaged across mini-batches from the test set
     """
     test_batcher.reset(shuffle=False)
@@ -467,6 +489,8 @@ def run_test_epoch(args, test_batcher, model, loss_func, token_vocab, metadata_v
         test_correct += num_correct
         test_examples += num_examples
         test_epoch_loss += batch_loss.item()
+        if profiler is not None:
+            profiler.step()
     sleep(0.1)
     test_loss = test_epoch_loss / float(test_batcher.num_batches())
     test_acc = test_correct / float(test_examples)
@@ -560,6 +584,36 @@ def split_marginals(lf_metadata_counts):
     return train_marginals, val_marginals
 
 
+def tokenize_sf_lf_map(sf_lf_map, token_vocab):
+    """
+    :param sf_lf_map: dictionary mapping SFs to original string LFs
+    :param token_vocab: unigram token vocabulary.  SFs and LF tokens are added to it if not already present.
+    :return: dictionary mapping SFs to tokenized LFs (sf_tokenized_lf_map)
+
+    LFs are tokenized from their canonical forms in shared_data/casi/labeled_sf_lf_map.csv.  lf_tokenizer prefers tokens
+    already in the vocabulary so the result depends on the order in which sf_lf_map is traversed.
+    """
+    casi_dir = os.path.join(home_dir, 'shared_data', 'casi')
+    canonical_lfs = pd.read_csv(os.path.join(casi_dir, 'labeled_sf_lf_map.csv'))
+    canonical_sf_lf_map = dict(canonical_lfs.groupby('target_lf_sense')['target_label'].apply(list))
+
+    sf_tokenized_lf_map = defaultdict(list)
+    prev_vocab_size = token_vocab.size()
+    for sf, lf_list in sf_lf_map.items():
+        token_vocab.add_token(sf.lower())
+        for lf in lf_list:
+            canonical_lf_arr = list(set(canonical_sf_lf_map[lf]))
+            assert len(canonical_lf_arr) == 1
+            canonical_lf = canonical_lf_arr[0]
+            tokens = lf_tokenizer(canonical_lf, token_vocab)
+            sf_tokenized_lf_map[sf].append(tokens)
+            for t in tokens:
+                token_vocab.add_token(t)
+    new_vocab_size = token_vocab.size()
+    print('Added {} tokens to vocabulary from LF targets and SFs.'.format(new_vocab_size - prev_vocab_size))
+    return sf_tokenized_lf_map
+
+
 def target_lf_sense(target_lf, sf, sf_lf_map):
     """
     :param target_lf: exact string to locate in sense inventory
@@ -0,0 +1,232 @@
+import importlib.util
+import json
+from multiprocessing import Pool
+import os
+import sys
+from time import time
+
+import argparse
+import numpy as np
+import pandas as pd
+import torch
+
+home_dir = os.path.expanduser('~/LMC/')
+sys.path.insert(0, os.path.join(home_dir, 'acronyms'))
+sys.path.insert(0, os.path.join(home_dir, 'acronyms', 'modules'))
+sys.path.insert(0, os.path.join(home_dir, 'preprocess'))
+sys.path.insert(0, os.path.join(home_dir, 'preprocess', 'context_extraction'))
+sys.path.insert(0, os.path.join(home_dir, 'utils'))
+from aho_corasick import ShortFormMatcher
+from expander_bundle import load_expander
+from model_utils import render_args
+from note_utils import SectionMapper, note_to_examples
+from serve import MicroBatcher
+
+OUTPUT_COLUMNS = ['note_idx', 'row_id', 'sf', 'start', 'end', 'section', 'lf', 'lf_idx', 'score', 'p']
+PROGRESS_FN = 'progress.json'
+
+# Set in each worker by _init_worker
+_worker_sf_matcher, _worker_section_mapper, _worker_window = None, None, None
+
+
+def _init_worker(sf_matcher, section_vocab, window):
+    global _worker_sf_matcher, _worker_section_mapper, _worker_window
+    _worker_sf_matcher = sf_matcher
+    _worker_section_mapper = SectionMapper(section_vocab)
+    _worker_window = window
+
+
+def _extract(note):
+    note_idx, row_id, text = note
+    if type(text) == float:  # Missing TEXT
+        return []
+    examples = note_to_examples(text, _worker_sf_matcher, section_mapper=_worker_section_mapper, window=_worker_window)
+    for example in examples:
+        example['note_idx'] = note_idx
+        example['row_id'] = row_id
+    return examples
+
+
+def iterate_notes(input_fp, chunk_size, offset=0, id_col='ROW_ID', text_col='TEXT'):
+    """
+    :param input_fp: NOTEEVENTS-shaped csv (with id_col and text_col) or a directory of .txt files (one note per file)
+    :param chunk_size: number of notes to yield at a time
+    :param offset: number of notes (in input order) to skip
+    :return: generator of (start note index, row ids, texts) for consecutive chunks of at most chunk_size notes
+
+    Only a single chunk is held in memory.  For csv inputs, skipped chunks are still parsed because TEXT fields span
+    multiple lines (so line numbers can't be used to seek).
+    """
+    if os.path.isdir(input_fp):
+        fns = sorted(fn for fn in os.listdir(input_fp) if fn.endswith('.txt'))
+        for start_idx in range(offset, len(fns), chunk_size):
+            chunk_fns = fns[start_idx:start_idx + chunk_size]
+            texts = []
+            for fn in chunk_fns:
+                with open(os.path.join(input_fp, fn), 'r') as fd:
+                    texts.append(fd.read())
+            yield start_idx, [fn[:-len('.txt')] for fn in chunk_fns], texts
+        return
+
+    start_idx = 0
+    for chunk_df in pd.read_csv(input_fp, usecols=[id_col, text_col], chunksize=chunk_size):
+        end_idx = start_idx + chunk_df.shape[0]
+        if end_idx > offset:
+            chunk_df = chunk_df.iloc[max(0, offset - start_idx):]
+            yield max(start_idx, offset), chunk_df[id_col].tolist(), chunk_df[text_col].tolist()
+        start_idx = end_idx
+
+
+def rank_examples(examples, scores, sf_lf_map):
+    """
+    :param examples: examples from note_to_examples (with note_idx and row_id)
+    :param scores: MicroBatcher.score output for examples
+    :param sf_lf_map: SF -> candidate LFs
+    :return: DataFrame with OUTPUT_COLUMNS.  The top-scoring LF (and its softmax probability) for every example.
+    """
+    rows = []
+    for example, s in zip(examples, scores):
+        lf_idx = int(np.argmax(s))
+        p = np.exp(s - s[lf_idx])
+        rows.append({
+            'note_idx': example['note_idx'],
+            'row_id': example['row_id'],
+            'sf': example['sf'],
+            'start': example['start'],
+            'end': example['end'],
+            'section': example['section'],
+            'lf': sf_lf_map[example['sf']][lf_idx],
+            'lf_idx': lf_idx,
+            'score': float(s[lf_idx]),
+            'p': float(1.0 / p.sum()),
+        })
+    return pd.DataFrame(rows, columns=OUTPUT_COLUMNS)
+
+
+def write_part(df, out_dir, start_idx):
+    """
+    :param df: output of rank_examples for a chunk of notes
+    :param out_dir: output directory
+    :param start_idx: index of the first note in the chunk (parts are named by it so reruns overwrite, not duplicate)
+    :return: file name of the part
+
+    Writes parquet if pyarrow is available (else gzipped csv) to a temporary file which is then renamed into place.
+    """
+    if importlib.util.find_spec('pyarrow') is not None:
+        fn = 'part-{:012d}.parquet'.format(start_idx)
+        tmp_fp = os.path.join(out_dir, fn + '.tmp')
+        df.to_parquet(tmp_fp, engine='pyarrow', index=False)
+    else:
+        fn = 'part-{:012d}.csv.gz'.format(start_idx)
+        tmp_fp = os.path.join(out_dir, fn + '.tmp')
+        df.to_csv(tmp_fp, index=False, compression='gzip')
+    os.replace(tmp_fp, os.path.join(out_dir, fn))
+    return fn
+
+
+def load_progress(out_dir, args):
+    """
+    :return: progress dictionary saved by save_progress or a fresh one if this is the first run (or -restart)
+
+    On -restart, the parts listed in the previous progress file are removed.  Otherwise, raises an Exception when
+    resuming with a different input, bundle or window since the parts would be inconsistent.
+    """
+    progress_fp = os.path.join(out_dir, PROGRESS_FN)
+    settings = {'input_fp': os.path.abspath(args.input_fp), 'bundle_fp': os.path.abspath(args.bundle_fp),
+                'window': args.window}
+    if not os.path.exists(progress_fp):
+        return {'settings': settings, 'offset': 0, 'num_examples': 0, 'parts': []}
+    with open(progress_fp, 'r') as fd:
+        progress = json.load(fd)
+    if args.restart:
+        for fn in progress['parts']:
+            if os.path.exists(os.path.join(out_dir, fn)):
+                os.remove(os.path.join(out_dir, fn))
+        return {'settings': settings, 'offset': 0, 'num_examples': 0, 'parts': []}
+    if not progress['settings'] == settings:
+        raise Exception('{} was written with settings={}.  Pass -restart to overwrite.'.format(
+            progress_fp, progress['settings']))
+    return progress
+
+
+def save_progress(progress, out_dir):
+    progress_fp = os.path.join(out_dir, PROGRESS_FN)
+    with open(progress_fp + '.tmp', 'w') as fd:
+        json.dump(progress, fd, indent=4)
+    os.replace(progress_fp + '.tmp', progress_fp)
+
+
+def expand_chunk(micro_batcher, examples, batch_size):
+    """
+    :return: MicroBatcher.score output for examples, computed batch_size examples at a time
+    """
+    scores = []
+    for start_idx in range(0, len(examples), batch_size):
+        scores += micro_batcher.score(examples[start_idx:start_idx + batch_size])
+    return scores
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Expand every known SF in a corpus of raw notes.')
+    parser.add_argument('--bundle_fp', required=True, help='Expander bundle (see acronyms/expander_bundle.py).')
+    parser.add_argument('--input_fp', default=os.path.join(home_dir, 'preprocess', 'data', 'mimic', 'NOTEEVENTS.csv'),
+                        help='NOTEEVENTS-shaped csv or a directory of .txt files (one note per file).')
+    parser.add_argument('--id_col', default='ROW_ID')
+    parser.add_argument('--text_col', default='TEXT')
+    parser.add_argument('--out_dir', required=True, help='Directory for the output parts and progress.json.')
+    parser.add_argument('--window', default=10, type=int, help='Context window on either side of each SF.')
+    parser.add_argument('--chunk_size', default=10000, type=int, help='Notes held in memory (and written per part).')
+    parser.add_argument('--batch_size', default=1024, type=int, help='Examples per forward pass.')
+    parser.add_argument('--num_workers', default=None, type=int,
+                        help='Processes for finding SFs and tokenizing notes.  Defaults to all CPUs.')
+    parser.add_argument('--num_threads', default=None, type=int, help='torch.set_num_threads (intra-op parallelism).')
+    parser.add_argument('-restart', default=False, action='store_true', help='Ignore progress.json and start over.')
+
+    args = parser.parse_args()
+    render_args(args)
+    os.makedirs(args.out_dir, exist_ok=True)
+    progress = load_progress(args.out_dir, args)
+    if progress['offset'] > 0:
+        print('Resuming from note {} ({} parts written)'.format(progress['offset'], len(progress['parts'])))
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    expander, bundle = load_expander(args.bundle_fp, device='cpu')
+    micro_batcher = MicroBatcher(expander, bundle)
+    sfs = set(bundle['sf_lf_map'].keys())
+    section_vocab = bundle['metadata_vocab'] or bundle['token_vocab']
+    num_workers = args.num_workers or os.cpu_count()
+    # The automaton is compiled once and shipped to each worker
+    p = Pool(processes=num_workers, initializer=_init_worker,
+             initargs=(ShortFormMatcher(sfs), section_vocab, args.window))
+    print('Expanding {} SFs with a {} expander'.format(len(sfs), bundle['lm_type']))
+
+    def finish(pending):
+        start_idx, num_notes, async_result = pending
+        examples = [example for note_examples in async_result.get() for example in note_examples]
+        if len(examples) > 0:
+            out_df = rank_examples(examples, expand_chunk(micro_batcher, examples, args.batch_size),
+                                   bundle['sf_lf_map'])
+            fn = write_part(out_df, args.out_dir, start_idx)
+            if fn not in progress['parts']:
+                progress['parts'].append(fn)
+        progress['offset'] = start_idx + num_notes
+        progress['num_examples'] += len(examples)
+        save_progress(progress, args.out_dir)
+        print('Expanded {} SFs in notes [{}, {})'.format(len(examples), start_idx, start_idx + num_notes))
+
+    # Extraction for chunk k + 1 runs in the pool while chunk k is scored so that at most 2 chunks are in memory
+    start_time, pending = time(), None
+    for start_idx, row_ids, texts in iterate_notes(
+            args.input_fp, args.chunk_size, offset=progress['offset'], id_col=args.id_col, text_col=args.text_col):
+        notes = zip(range(start_idx, start_idx + len(texts)), row_ids, texts)
+        async_result = p.map_async(_extract, notes, chunksize=max(1, len(texts) // (4 * num_workers)))
+        if pending is not None:
+            finish(pending)
+        pending = (start_idx, len(texts), async_result)
+    if pending is not None:
+        finish(pending)
+    p.close()
+    p.join()
+    print('Done!  {} SF expansions over {} notes in {} seconds.  Output is in {}'.format(
+        progress['num_examples'], progress['offset'], round(time() - start_time, 2), args.out_dir))
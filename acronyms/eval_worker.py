@@ -0,0 +1,164 @@
+from collections import OrderedDict
+from copy import deepcopy
+import csv
+import os
+from queue import Full
+import sys
+import traceback
+
+import argparse
+import torch
+import torch.multiprocessing as mp
+import torch.nn as nn
+
+home_dir = os.path.expanduser('~/LMC/')
+sys.path.insert(0, os.path.join(home_dir, 'acronyms'))
+sys.path.insert(0, os.path.join(home_dir, 'acronyms', 'modules'))
+sys.path.insert(0, os.path.join(home_dir, 'modules', 'bsg'))
+sys.path.insert(0, os.path.join(home_dir, 'modules', 'lmc'))
+sys.path.insert(0, os.path.join(home_dir, 'preprocess'))
+sys.path.insert(0, os.path.join(home_dir, 'utils'))
+from acronym_utils import load_casi, load_columbia, load_mimic, run_test_epoch
+from bsg_acronym_expander import BSGAcronymExpander
+from bsg_model import BSG
+from checkpoint_utils import snapshot_to_cpu
+from error_analysis import analyze
+from evaluate import create_results_dir, load_evaluation_data
+from lmc_acronym_expander import LMCAcronymExpander
+from lmc_model import LMC
+
+
+DATASET_LOADERS = [('casi', load_casi), ('mimic', load_mimic), ('columbia', load_columbia)]
+
+
+def _build_expander(eval_args, prev_args, state_dict, token_vocab, dataset_vocab, metadata_vocab):
+    """
+    :param eval_args: argparse instance for evaluation (lm_type, device)
+    :param prev_args: argparse instance from the language model being trained
+    :param state_dict: snapshot of language model weights
+    :param token_vocab: vocabulary used to train the language model
+    :param dataset_vocab: token_vocab with the SFs and LF tokens of a single dataset added
+    :param metadata_vocab: metadata vocabulary (LMC only)
+    :return: acronym expander wrapping a copy of the language model restored from state_dict
+    """
+    # When using nn.DataParallel(model) it prepends 'module.' to all parameter names in state dict.
+    state_dict = OrderedDict((k[7:] if k[:7] == 'module.' else k, v) for k, v in state_dict.items())
+    if eval_args.lm_type == 'bsg':
+        lm = BSG(prev_args, token_vocab.size())
+        acronym_model = BSGAcronymExpander
+    else:
+        lm = LMC(prev_args, token_vocab.size(), metadata_vocab.size())
+        acronym_model = LMCAcronymExpander
+    lm.load_state_dict(state_dict)
+    return acronym_model(eval_args, lm, dataset_vocab).to(eval_args.device)
+
+
+def _run_worker(eval_args, prev_args, token_vocab, metadata_vocab, metric_cols, metrics_fp, log_fp, queue):
+    """
+    :return: None
+
+    Entry point of the evaluation process.  Datasets, SF-LF maps and batchers are loaded once and reused for every
+    snapshot received through queue.  A None item shuts the worker down.
+    """
+    sys.stdout = sys.stderr = open(log_fp, mode='a', buffering=1)
+    torch.set_num_threads(eval_args.num_threads)
+
+    datasets = []
+    for dataset, dataset_loader in DATASET_LOADERS:
+        # SF and LF tokenization depends on which tokens have already been added so each dataset gets its own copy
+        dataset_vocab = deepcopy(token_vocab)
+        eval_data = load_evaluation_data(prev_args, dataset_vocab, dataset_loader, batch_size=eval_args.batch_size)
+        eval_data['results_dir'] = create_results_dir('{}_{}'.format(eval_args.experiment, dataset))
+        datasets.append((dataset, dataset_vocab, eval_data))
+
+    loss_func = nn.CrossEntropyLoss()
+    metrics_file = open(metrics_fp, mode='a')
+    metrics_writer = csv.writer(metrics_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        state_dict, training_stats = item
+        for dataset, dataset_vocab, eval_data in datasets:
+            try:
+                model = _build_expander(
+                    eval_args, prev_args, state_dict, token_vocab, dataset_vocab, metadata_vocab)
+                args = argparse.Namespace(**vars(eval_args))
+                args.dataset = dataset
+                test_loss, test_acc = run_test_epoch(
+                    args, eval_data['test_batcher'], model, loss_func, dataset_vocab, metadata_vocab,
+                    eval_data['sf_tokenized_lf_map'], eval_data['sf_lf_map'], eval_data['lf_metadata_counts'])
+                metrics = analyze(
+                    args, eval_data['test_batcher'], model, eval_data['sf_lf_map'], loss_func, dataset_vocab,
+                    metadata_vocab, eval_data['sf_tokenized_lf_map'], eval_data['lf_metadata_counts'],
+                    results_dir=eval_data['results_dir'])
+            except Exception:
+                traceback.print_exc()
+                continue
+            metrics.update(training_stats)
+            metrics['dataset'] = dataset
+            metrics['log_loss'] = test_loss
+            metrics['accuracy'] = test_acc
+            row = [metrics[col] for col in metric_cols]
+            metrics_writer.writerow(row)
+            metrics_file.flush()
+            print(metric_cols)
+            print(row)
+    metrics_file.close()
+
+
+class EvaluationWorker:
+    """
+    Runs acronym expansion evaluation (CASI, MIMIC and Columbia) in a separate process while the language model trains.
+
+    The training loop submits CPU snapshots of the model weights which are passed to the worker through shared memory.
+    The worker rebuilds the language model from each snapshot and appends one row per dataset to metrics.csv.  If the
+    worker is still busy with a previous snapshot, the new one is skipped rather than blocking training.
+    """
+    def __init__(self, eval_args, prev_args, token_vocab, metadata_vocab, metric_cols, metrics_fp):
+        """
+        :param eval_args: argparse instance with experiment, lm_type, device, batch_size and num_threads
+        :param prev_args: argparse instance of the language model being trained
+        :param token_vocab: token vocabulary of the language model being trained
+        :param metadata_vocab: metadata vocabulary (LMC only)
+        :param metric_cols: column order of metrics.csv
+        :param metrics_fp: path to metrics.csv
+        """
+        prev_args = argparse.Namespace(**vars(prev_args))
+        if eval_args.lm_type == 'bsg':
+            prev_args.metadata = None
+        log_fp = os.path.join(os.path.dirname(metrics_fp), 'eval_worker.log')
+        ctx = mp.get_context('spawn')
+        self.queue = ctx.Queue(maxsize=1)
+        self.process = ctx.Process(
+            target=_run_worker,
+            args=(eval_args, prev_args, token_vocab, metadata_vocab, metric_cols, metrics_fp, log_fp, self.queue),
+            daemon=True)
+        self.process.start()
+        print('Started evaluation worker (pid={}).  Logging to {}'.format(self.process.pid, log_fp))
+
+    def close(self):
+        """
+        :return: None
+
+        Waits for pending evaluations to finish and shuts down the worker.
+        """
+        self.queue.put(None)
+        self.process.join()
+
+    def submit(self, model, training_stats):
+        """
+        :param model: language model being trained
+        :param training_stats: dictionary of metrics.csv values known to the training loop (i.e. epoch, examples, hours,
+        lm_kl, lm_recon)
+        :return: True if the snapshot was queued for evaluation, False if the worker was busy
+        """
+        if not self.process.is_alive():
+            print('Evaluation worker has exited.  Skipping evaluation.')
+            return False
+        try:
+            self.queue.put_nowait((snapshot_to_cpu(model.state_dict()), training_stats))
+        except Full:
+            print('Evaluation worker is still busy.  Skipping evaluation.')
+            return False
+        return True
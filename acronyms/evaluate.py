@@ -1,4 +1,4 @@
-from collections import Counter, defaultdict
+from collections import Counter
 import json
 import os
 import random
@@ -21,14 +21,15 @@ sys.path.insert(0, os.path.join(home_dir, 'modules', 'bsg'))
 sys.path.insert(0, os.path.join(home_dir, 'modules', 'lmc'))
 sys.path.insert(0, os.path.join(home_dir, 'preprocess'))
 sys.path.insert(0, os.path.join(home_dir, 'utils'))
-from acronym_utils import (load_casi, load_columbia, load_mimic, lf_tokenizer, render_dominant_section_accuracy,
-                           split_marginals, run_test_epoch, run_train_epoch)
+from acronym_utils import (load_casi, load_columbia, load_mimic, render_dominant_section_accuracy, split_marginals,
+                           run_test_epoch, run_train_epoch, tokenize_sf_lf_map)
 from bsg_acronym_expander import BSGAcronymExpander
-from bsg_utils import restore_model as restore_bsg
+from bsg_utils import restore_inference_model as restore_bsg
 from error_analysis import analyze, render_test_statistics
 from lmc_acronym_expander import LMCAcronymExpander
-from lmc_utils import restore_model as lmc_restore
+from lmc_utils import restore_inference_model as lmc_restore
 from model_utils import get_git_revision_hash, render_args
+from profile_utils import add_profile_args, TrainingProfiler
 
 
 def _generate_marginals(df):
@@ -88,12 +89,58 @@ def extract_smoothed_metadata_probs(metadata='section'):
     return lf_metadata_counts
 
 
+def create_results_dir(experiment):
+    """
+    :param experiment: directory name within ~/LMC/weights/acronyms
+    :return: path to (empty) results directory in which error analysis is written
+
+    Clears out any previous output for the same experiment.
+    """
+    weights_dir = os.path.join(home_dir, 'weights', 'acronyms', experiment)
+    if os.path.exists(weights_dir):
+        print('Clearing out previous weights in {}'.format(weights_dir))
+        rmtree(weights_dir)
+    os.mkdir(weights_dir)
+    results_dir = os.path.join(home_dir, 'acronyms', weights_dir, 'results')
+    os.mkdir(results_dir)
+    os.mkdir(os.path.join(results_dir, 'confusion'))
+    return results_dir
+
+
+def load_evaluation_data(prev_args, token_vocab, dataset_loader, train_frac=0.0, batch_size=None, bucket_by=None):
+    """
+    :param prev_args: argparse instance from pre-trained language model
+    :param token_vocab: unigram token vocabulary from pre-trained language model.  SFs and LF tokens are added to it.
+    :param dataset_loader: function to load acronym expansion dataset (i.e. either CASI or Reverse Substitution MIMIC)
+    :param train_frac: fraction of dataset used for fine-tuning.  0.0 means the entire dataset is used for testing.
+    :param batch_size: test set batch size
+    :param bucket_by: Optionally group examples into batches by 'sf' or 'num_outputs' (see AcronymBatcherLoader)
+    :return: dictionary holding the batchers, data frames, SF-LF maps and p(metadata|LF) needed to evaluate a model
+    """
+    train_batcher, test_batcher, train_df, test_df, sf_lf_map = dataset_loader(
+        prev_args, train_frac=train_frac, batch_size=batch_size, bucket_by=bucket_by)
+
+    # Construct smoothed empirical probabilities of metadata conditioned on LF ~ p(metadata|LF)
+    lf_metadata_counts = extract_smoothed_metadata_probs(metadata=prev_args.metadata)
+    sf_tokenized_lf_map = tokenize_sf_lf_map(sf_lf_map, token_vocab)
+    return {
+        'lf_metadata_counts': lf_metadata_counts,
+        'sf_lf_map': sf_lf_map,
+        'sf_tokenized_lf_map': sf_tokenized_lf_map,
+        'test_batcher': test_batcher,
+        'test_df': test_df,
+        'train_batcher': train_batcher,
+        'train_df': train_df
+    }
+
+
 def run_evaluation(args, acronym_model, dataset_loader, restore_func, train_frac=0.0):
     """
     :param args: argparse instance specifying evaluation configuration (including pre-trained model path)
     :param acronym_model: PyTorch model to rank candidate acronym expansions (an instance of model from ./modules/)
     :param dataset_loader: function to load acronym expansion dataset (i.e. either CASI or Reverse Substitution MIMIC)
-    :param restore_func: Function to load pre-trained model weights (different for BSG and LMC)
+    :param restore_func: Function to load pre-trained model weights (different for BSG and LMC).  Should be
+    restore_inference_model which caches the restored checkpoint across calls
     :param train_frac: If you want to fine tune the model, this should be about 0.8.
     Otherwise, default of 0.0 means the entire dataset is used as a test set for evaluation
     :return:
@@ -107,31 +154,13 @@ def run_evaluation(args, acronym_model, dataset_loader, restore_func, train_frac
         prev_args.metadata = None
     else:
         prev_args, lm, token_vocab, metadata_vocab, _, _, _ = restore_func(args.lm_experiment, ckpt=args.ckpt)
-    train_batcher, test_batcher, train_df, test_df, sf_lf_map = dataset_loader(
-        prev_args, train_frac=train_frac, batch_size=args.batch_size)
     args.metadata = prev_args.metadata
-
-    # Construct smoothed empirical probabilities of metadata conditioned on LF ~ p(metadata|LF)
-    lf_metadata_counts = extract_smoothed_metadata_probs(metadata=args.metadata)
-
-    casi_dir = os.path.join(home_dir, 'shared_data', 'casi')
-    canonical_lfs = pd.read_csv(os.path.join(casi_dir, 'labeled_sf_lf_map.csv'))
-    canonical_sf_lf_map = dict(canonical_lfs.groupby('target_lf_sense')['target_label'].apply(list))
-
-    sf_tokenized_lf_map = defaultdict(list)
-    prev_vocab_size = token_vocab.size()
-    for sf, lf_list in sf_lf_map.items():
-        token_vocab.add_token(sf.lower())
-        for lf in lf_list:
-            canonical_lf_arr = list(set(canonical_sf_lf_map[lf]))
-            assert len(canonical_lf_arr) == 1
-            canonical_lf = canonical_lf_arr[0]
-            tokens = lf_tokenizer(canonical_lf, token_vocab)
-            sf_tokenized_lf_map[sf].append(tokens)
-            for t in tokens:
-                token_vocab.add_token(t)
-    new_vocab_size = token_vocab.size()
-    print('Added {} tokens to vocabulary from LF targets and SFs.'.format(new_vocab_size - prev_vocab_size))
+    eval_data = load_evaluation_data(
+        prev_args, token_vocab, dataset_loader, train_frac=train_frac, batch_size=args.batch_size,
+        bucket_by=args.bucket_by)
+    train_batcher, test_batcher = eval_data['train_batcher'], eval_data['test_batcher']
+    test_df, sf_lf_map = eval_data['test_df'], eval_data['sf_lf_map']
+    sf_tokenized_lf_map, lf_metadata_counts = eval_data['sf_tokenized_lf_map'], eval_data['lf_metadata_counts']
 
     render_test_statistics(test_df, sf_lf_map)
 
@@ -144,14 +173,7 @@ def run_evaluation(args, acronym_model, dataset_loader, restore_func, train_frac
         render_dominant_section_accuracy(train_lf_metadata_counts, val_lf_metadata_counts, sf_lf_map)
 
     # Create model experiments directory or clear if it already exists
-    weights_dir = os.path.join(home_dir, 'weights', 'acronyms', args.experiment)
-    if os.path.exists(weights_dir):
-        print('Clearing out previous weights in {}'.format(weights_dir))
-        rmtree(weights_dir)
-    os.mkdir(weights_dir)
-    results_dir = os.path.join(home_dir, 'acronyms', weights_dir, 'results')
-    os.mkdir(results_dir)
-    os.mkdir(os.path.join(results_dir, 'confusion'))
+    results_dir = create_results_dir(args.experiment)
 
     model = acronym_model(args, lm, token_vocab).to(args.device)
 
@@ -162,9 +184,12 @@ def run_evaluation(args, acronym_model, dataset_loader, restore_func, train_frac
     loss_func = nn.CrossEntropyLoss()
     best_weights = model.state_dict()
     best_epoch = 1
+    # Profiles the test batches of the initial (zero-shot) evaluation
+    profiler = TrainingProfiler(args, os.path.dirname(results_dir), name='evaluate_profile')
     lowest_test_loss, highest_test_acc = run_test_epoch(
         args, test_batcher, model, loss_func, token_vocab, metadata_vocab, sf_tokenized_lf_map, sf_lf_map,
-        lf_metadata_counts)
+        lf_metadata_counts, profiler=profiler)
+    profiler.close()
 
     metrics = analyze(args, test_batcher, model, sf_lf_map, loss_func, token_vocab, metadata_vocab, sf_tokenized_lf_map,
                       lf_metadata_counts, results_dir=results_dir)
@@ -216,8 +241,11 @@ if __name__ == '__main__':
     parser.add_argument('--epochs', default=0, type=int)
     parser.add_argument('--lr', default=0.001, type=float)
     parser.add_argument('--window', default=10, type=int)
+    parser.add_argument('--bucket_by', default=None, choices=['sf', 'num_outputs'],
+                        help='Group examples into batches by SF or by number of candidate LFs to reduce padding.')
 
     parser.add_argument('-bootstrap', default=False, action='store_true')
+    add_profile_args(parser)
 
     args = parser.parse_args()
     args.experiment += '_{}'.format(args.dataset)
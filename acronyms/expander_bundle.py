@@ -0,0 +1,136 @@
+import json
+import os
+import sys
+
+import argparse
+import torch
+
+home_dir = os.path.expanduser('~/LMC/')
+sys.path.insert(0, os.path.join(home_dir, 'acronyms'))
+sys.path.insert(0, os.path.join(home_dir, 'acronyms', 'modules'))
+sys.path.insert(0, os.path.join(home_dir, 'modules', 'bsg'))
+sys.path.insert(0, os.path.join(home_dir, 'modules', 'lmc'))
+sys.path.insert(0, os.path.join(home_dir, 'preprocess'))
+sys.path.insert(0, os.path.join(home_dir, 'utils'))
+from acronym_utils import tokenize_sf_lf_map
+from bsg_acronym_expander import BSGAcronymExpander
+from bsg_utils import restore_inference_model as restore_bsg
+from evaluate import extract_smoothed_metadata_probs
+from lmc_acronym_expander import LMCAcronymExpander
+from lmc_utils import restore_inference_model as restore_lmc
+
+
+BUNDLE_FN = 'expander_bundle.pt'
+# Embedding tables which are only ever indexed with LF token ids at inference time.  Only those rows are exported.
+LF_ONLY_PARAMS = {
+    'bsg': ['embeddings_mu.weight', 'embeddings_log_sigma.weight'],
+    'lmc': ['decoder.token_embeddings.weight'],
+}
+EXPANDERS = {'bsg': BSGAcronymExpander, 'lmc': LMCAcronymExpander}
+
+
+def export_bundle(lm_type, lm_experiment, ckpt=None, dtype='float16', out_fp=None):
+    """
+    :param lm_type: bsg or lmc
+    :param lm_experiment: experiment name within ~/LMC/weights/{lm_type}
+    :param ckpt: Optional pre-specified epoch from which to restore checkpoint
+    :param dtype: floating point type in which to store weights (float16, bfloat16, or float32)
+    :param out_fp: where to save bundle.  Defaults to expander_bundle.pt inside the language model weights directory
+    :return: path to saved bundle
+
+    Prunes a pre-trained language model checkpoint to the state required to rank LFs for acronyms:
+    - no optimizer state, training statistics, or token-metadata counts
+    - a token vocabulary with every SF and LF token already added (full CASI sense inventory)
+    - only the rows of LF-side embedding tables which correspond to LF tokens
+    - smoothed p(metadata|LF) marginals (LMC only)
+    """
+    if lm_type == 'bsg':
+        prev_args, lm, token_vocab, _ = restore_bsg(lm_experiment, ckpt=ckpt)
+        metadata_vocab, lf_metadata_counts = None, None
+    else:
+        prev_args, lm, token_vocab, metadata_vocab, _, _, _ = restore_lmc(lm_experiment, ckpt=ckpt)
+        lf_metadata_counts = extract_smoothed_metadata_probs(metadata=prev_args.metadata)
+
+    with open(os.path.join(home_dir, 'shared_data', 'casi', 'sf_lf_map.json'), 'r') as fd:
+        sf_lf_map = json.load(fd)
+    sf_tokenized_lf_map = tokenize_sf_lf_map(sf_lf_map, token_vocab)
+
+    expander = EXPANDERS[lm_type](argparse.Namespace(device='cpu'), lm, token_vocab)
+    lf_token_ids = {0}
+    for lf_tokens in sf_tokenized_lf_map.values():
+        for tokens in lf_tokens:
+            lf_token_ids.update(token_vocab.get_ids(tokens))
+    lf_token_ids = torch.LongTensor(sorted(lf_token_ids))
+
+    save_dtype = getattr(torch, dtype)
+    state_dict, pruned = {}, {}
+    for name, weight in expander.state_dict().items():
+        if weight.is_floating_point():
+            weight = weight.to(save_dtype)
+        if name in LF_ONLY_PARAMS[lm_type]:
+            pruned[name] = {'ids': lf_token_ids, 'rows': weight[lf_token_ids].clone(), 'size': tuple(weight.size())}
+        else:
+            state_dict[name] = weight.clone()
+
+    bundle = {
+        'lm_type': lm_type,
+        'args': {arg: getattr(prev_args, arg) for arg in vars(prev_args)},
+        'state_dict': state_dict,
+        'pruned': pruned,
+        'token_vocab': token_vocab,
+        'metadata_vocab': metadata_vocab,
+        'sf_lf_map': sf_lf_map,
+        'sf_tokenized_lf_map': dict(sf_tokenized_lf_map),
+        'lf_metadata_counts': lf_metadata_counts,
+    }
+
+    if out_fp is None:
+        out_fp = os.path.join(home_dir, 'weights', lm_type, lm_experiment, BUNDLE_FN)
+    print('Saving expander bundle to {}'.format(out_fp))
+    torch.save(bundle, out_fp)
+    return out_fp
+
+
+def load_bundle(bundle_fp):
+    """
+    :param bundle_fp: path to bundle saved by export_bundle
+    :return: bundle dictionary with a dense float32 'state_dict' ready for Expander.from_bundle
+
+    Pruned rows are scattered back into zero-filled tables of the original size.
+    """
+    bundle = torch.load(bundle_fp, map_location=lambda storage, loc: storage)
+    state_dict = {}
+    for name, weight in bundle['state_dict'].items():
+        state_dict[name] = weight.float() if weight.is_floating_point() else weight
+    for name, pruned in bundle.pop('pruned').items():
+        weight = torch.zeros(pruned['size'])
+        weight[pruned['ids']] = pruned['rows'].float()
+        state_dict[name] = weight
+    bundle['state_dict'] = state_dict
+    return bundle
+
+
+def load_expander(bundle_fp, device='cpu'):
+    """
+    :param bundle_fp: path to bundle saved by export_bundle
+    :param device: cpu or cuda
+    :return: expander model in eval mode along with the bundle (vocabularies, SF-LF maps and LF marginals)
+    """
+    bundle = load_bundle(bundle_fp)
+    expander = EXPANDERS[bundle['lm_type']].from_bundle(argparse.Namespace(device=device), bundle)
+    expander.eval()
+    return expander.to(device), bundle
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Export a slim inference bundle for clinical acronym expansion.')
+    parser.add_argument('--lm_experiment', default='baseline-1-13')
+    parser.add_argument('--lm_type', default='bsg', help='bsg or lmc')
+    parser.add_argument('--ckpt', default=None, type=int,
+                        help='Optionally preselect an epoch from which to load pretrained.')
+    parser.add_argument('--dtype', default='float16', help='float16, bfloat16, or float32')
+    parser.add_argument('--out_fp', default=None)
+
+    args = parser.parse_args()
+    bundle_fp = export_bundle(args.lm_type, args.lm_experiment, ckpt=args.ckpt, dtype=args.dtype, out_fp=args.out_fp)
+    print('Bundle size={} MB'.format(round(os.path.getsize(bundle_fp) / float(1 << 20), 2)))
@@ -1,13 +1,17 @@
 import os
 import sys
 
-import numpy as np
+import argparse
 import torch
 import torch.nn as nn
 
 home_dir = os.path.expanduser('~/LMC/')
+sys.path.insert(0, os.path.join(home_dir, 'modules', 'bsg'))
 sys.path.insert(0, os.path.join(home_dir, 'utils'))
+from bsg_model import BSG
 from compute_utils import compute_kl, mask_2D
+from model_utils import expand_embeddings, parameters_state
+from profile_utils import record_function
 
 
 class BSGAcronymExpander(nn.Module):
@@ -21,87 +25,153 @@ class BSGAcronymExpander(nn.Module):
         self.device = args.device
 
         vocab_size = token_vocab.size()
-        prev_vocab_size, embed_dim = bsg_model.embeddings_mu.weight.size()
 
         # In main evaluation script, we add long forms not present in vocabulary so we must expand embedding dimensions
         # Merge weights from pre-trained model to decoder and randomly initialize extra vocabulary items added
-        self.embeddings_mu = nn.Embedding(vocab_size, embedding_dim=embed_dim, padding_idx=0)
-        mu_init = np.random.normal(0, 1, size=(vocab_size, embed_dim))
-        mu_init[:prev_vocab_size, :] = bsg_model.embeddings_mu.weight.detach().numpy()
-        self.embeddings_mu.load_state_dict({'weight': torch.from_numpy(mu_init)})
-        self.embeddings_log_sigma = nn.Embedding(vocab_size, embedding_dim=1, padding_idx=0)
-        log_weights_init = np.random.uniform(low=-3.5, high=-1.5, size=(vocab_size, 1))
-        log_weights_init[:prev_vocab_size, :] = bsg_model.embeddings_log_sigma.weight.detach().numpy()
-        self.embeddings_log_sigma.load_state_dict({'weight': torch.from_numpy(log_weights_init)})
+        self.embeddings_mu = expand_embeddings(bsg_model.embeddings_mu, vocab_size)
+        self.embeddings_log_sigma = expand_embeddings(
+            bsg_model.embeddings_log_sigma, vocab_size, init_func=lambda w: w.uniform_(-3.5, -1.5))
 
         # Merge weights from pre-trained model to encoder and randomly initialize extra vocabulary items added
         self.encoder = bsg_model.encoder
-        encoder_embed_dim = self.encoder.embeddings.weight.size()[-1]
-        encoder_embed_init = np.random.normal(0, 1, size=(vocab_size, encoder_embed_dim))
-        encoder_embed_init[:prev_vocab_size, :] = self.encoder.embeddings.weight.detach().numpy()
-        self.encoder.embeddings = nn.Embedding(vocab_size, embedding_dim=encoder_embed_dim, padding_idx=0)
-        self.encoder.embeddings.load_state_dict({'weight': torch.from_numpy(encoder_embed_init)})
+        self.encoder.embeddings = expand_embeddings(self.encoder.embeddings, vocab_size)
+
+        # Mean prior for every (SF, candidate LF) pair of a tensorized dataset.  See cache_lf_gaussians
+        self.lf_prior_cache = None
+
+    @classmethod
+    def from_bundle(cls, args, bundle):
+        """
+        :param args: argparse instance.  Only args.device is used.
+        :param bundle: dictionary returned by load_bundle in acronyms/expander_bundle.py
+        :return: BSGAcronymExpander restored from an exported inference bundle
+
+        The bundle vocabulary already contains SF and LF tokens so no embeddings need to be expanded.
+        """
+        bsg_model = BSG(argparse.Namespace(**bundle['args']), bundle['token_vocab'].size())
+        expander = cls(args, bsg_model, bundle['token_vocab'])
+        expander.load_state_dict(bundle['state_dict'])
+        return expander
 
     def _compute_priors(self, ids):
         """
-        :param ids:
-        :return:
+        :param ids: LongTensor of token ids
+        :return: prior mu and sigma for every id
         """
         return self.embeddings_mu(ids), self.embeddings_log_sigma(ids).exp()
 
-    def encode_context(self, sf_ids, context_ids, num_contexts):
-        batch_size, num_context_ids = context_ids.size()
+    def _compute_lf_priors(self, lf_ids, normalizer):
+        """
+        :param lf_ids: LongTensor of ... x max_lf_len
+        :param normalizer: ... x 1.  Number of n-grams in each LF
+        :return: mean prior mu and sigma over the n-grams of each LF
+        """
+        lf_mu, lf_sigma = self._compute_priors(lf_ids)
+        return lf_mu.sum(-2) / normalizer, lf_sigma.sum(-2) / normalizer
+
+    def _prior_state(self):
+        return parameters_state(self.embeddings_mu) + parameters_state(self.embeddings_log_sigma)
+
+    def _lf_prior_cache_valid(self, key):
+        if self.training or self.lf_prior_cache is None:
+            return False
+        if key is None or self.lf_prior_cache['key'] is not key:
+            return False
+        return self.lf_prior_cache['prior_state'] == self._prior_state()
+
+    def train(self, mode=True):
+        """
+        Drops the LF prior cache when entering training mode.  Optimizers update p.data in place, which (on older
+        versions of torch) does not bump _version, so parameters_state alone can't detect fine-tuning.
+        """
+        if mode:
+            self.lf_prior_cache = None
+        return super(BSGAcronymExpander, self).train(mode)
+
+    def cache_lf_gaussians(self, batcher):
+        """
+        :param batcher: AcronymBatcherLoader instance which has tensorized its examples.  Batchers which share candidate
+        arrays (see tensorize_candidates) share the cache.
+        :return: None
+
+        In evaluation mode, the mean LF priors are computed once for every (SF, candidate LF) pair in the batcher and
+        forward gathers from this table (by lf_pair_ids).  The table is rebuilt whenever the batcher's candidate arrays
+        change (i.e. a new sf_lf_map) or the prior embeddings change and it is dropped whenever the model enters training
+        mode (i.e. fine-tuning).  forward only uses it for batches of the batcher it was built for.
+        """
+        if self.training or self._lf_prior_cache_valid(key=batcher.candidates):
+            return
+        lf_ids, lf_token_ct = batcher.lf_pair_entries()
+        lf_ids = torch.LongTensor(lf_ids).clamp_min_(0).to(self.device)
+        normalizer = torch.FloatTensor(lf_token_ct).unsqueeze(-1).clamp_min_(1.0).to(self.device)
+        with torch.no_grad():
+            lf_mu, lf_sigma = self._compute_lf_priors(lf_ids, normalizer)
+        self.lf_prior_cache = {
+            'key': batcher.candidates,
+            'prior_state': self._prior_state(),
+            'mu': lf_mu,
+            'sigma': lf_sigma,
+        }
+
+    def encode_context(self, center_ids, context_ids, num_contexts):
+        """
+        :param center_ids: LongTensor of num_views x batch_size.  Pseudo-center word for each view of the SF
+        (the SF itself and, for the MBSGE ensemble, its section and note category)
+        :param context_ids: LongTensor of batch_size x 2 * context_window
+        :param num_contexts: LongTensor of batch_size
+        :return: Gaussian parameters mu (batch_size x embed_dim) and sigma (batch_size x 1) averaged across views
+
+        Views share the same context so they are stacked along the batch dimension and encoded in a single pass.
+        """
+        num_views, batch_size = center_ids.size()
+        _, num_context_ids = context_ids.size()
 
         # Mask padded context ids
         mask_size = torch.Size([batch_size, num_context_ids])
         mask = mask_2D(mask_size, num_contexts).to(self.device)
 
-        sf_mu, sf_sigma = self.encoder(sf_ids, context_ids, mask, token_mask_p=None)
-        return sf_mu, sf_sigma
+        with record_function('encoder'):
+            sf_mu, sf_sigma = self.encoder(
+                center_ids.view(-1), context_ids.repeat(num_views, 1), mask.repeat(num_views, 1), token_mask_p=None)
+        return sf_mu.view(num_views, batch_size, -1).mean(0), sf_sigma.view(num_views, batch_size, -1).mean(0)
 
     def forward(self, sf_ids, section_ids, category_ids, context_ids, lf_ids, target_lf_ids, lf_token_ct,
-                lf_metadata_ids, num_outputs, num_contexts):
+                lf_metadata_ids, lf_metadata_pos, lf_metadata_idxs, lf_pair_ids, num_outputs, num_contexts,
+                cache_key=None):
         """
         :param sf_ids: LongTensor of batch_size
         :param context_ids: LongTensor of batch_size x 2 * context_window
         :param lf_ids: LongTensor of batch_size x max_output_size x max_lf_len
         :param lf_token_ct: batch_size, max_output_size - normalizer for lf_ids
         :param target_lf_ids: LongTensor of batch_size representing which index in lf_ids lies the target LF
+        :param lf_metadata_ids: unused.  p(metadata|LF) only applies to the LMC (as do lf_metadata_pos and
+        lf_metadata_idxs)
+        :param lf_pair_ids: LongTensor of batch_size x max_output_size.  Row of each candidate LF in the batcher's
+        (SF, LF) pairs.  Used to look up cached LF priors (see cache_lf_gaussians)
         :param num_outputs: list representing the number of target LFs for each row in batch.
+        :param cache_key: candidate arrays of the batcher which produced the batch (batcher.candidates).  Cached LF
+        priors are only used if they were built for it.
         :return:
         """
         batch_size, max_output_size, _ = lf_ids.size()
 
         # Next is to get prior representations for each LF in lf_ids
-        lf_mu, lf_sigma = self._compute_priors(lf_ids)
-        # Summarize LFs
-        normalizer = lf_token_ct.unsqueeze(-1).clamp_min(1.0)
-        lf_mu_sum, lf_sigma_sum = lf_mu.sum(-2) / normalizer, lf_sigma.sum(-2) / normalizer
-
-        combined_mu = []
-        combined_sigma = []
+        with record_function('decoder'):
+            if self._lf_prior_cache_valid(cache_key):
+                lf_mu_sum = self.lf_prior_cache['mu'][lf_pair_ids]
+                lf_sigma_sum = self.lf_prior_cache['sigma'][lf_pair_ids]
+            else:
+                normalizer = lf_token_ct.unsqueeze(-1).clamp_min(1.0)
+                lf_mu_sum, lf_sigma_sum = self._compute_lf_priors(lf_ids, normalizer)
 
         # Encode SFs in context
-        sf_mu_tokens, sf_sigma_tokens = self.encode_context(sf_ids, context_ids, num_contexts)
-        combined_mu.append(sf_mu_tokens)
-        combined_sigma.append(sf_sigma_tokens)
-
-        # For MBSGE ensemble method, we leverage section ids and note category ids
+        # For MBSGE ensemble method, we also leverage section ids and note category ids
+        center_ids = [sf_ids]
         if len(section_ids.nonzero()) > 0:
-            sf_mu_sec, sf_sigma_sec = self.encode_context(section_ids, context_ids, num_contexts)
-            combined_mu.append(sf_mu_sec)
-            combined_sigma.append(sf_sigma_sec)
-
+            center_ids.append(section_ids)
         if len(category_ids.nonzero()) > 0:
-            sf_mu_cat, sf_sigma_cat = self.encode_context(category_ids, context_ids, num_contexts)
-            combined_mu.append(sf_mu_cat)
-            combined_sigma.append(sf_sigma_cat)
-
-        combined_mu = torch.cat(list(map(lambda x: x.unsqueeze(1), combined_mu)), axis=1)
-        combined_sigma = torch.cat(list(map(lambda x: x.unsqueeze(1), combined_sigma)), axis=1)
-
-        sf_mu = combined_mu.mean(1)
-        sf_sigma = combined_sigma.mean(1)
+            center_ids.append(category_ids)
+        sf_mu, sf_sigma = self.encode_context(torch.stack(center_ids), context_ids, num_contexts)
 
         # Tile SFs across each LF and flatten both SFs and LFs
         sf_mu_flat = sf_mu.unsqueeze(1).repeat(1, max_output_size, 1).view(batch_size * max_output_size, -1)
@@ -112,7 +182,8 @@ class BSGAcronymExpander(nn.Module):
         output_dim = torch.Size([batch_size, max_output_size])
         output_mask = mask_2D(output_dim, num_outputs).to(self.device)
 
-        kl = compute_kl(sf_mu_flat, sf_sigma_flat, lf_mu_flat, lf_sigma_flat).view(batch_size, max_output_size)
+        with record_function('kl'):
+            kl = compute_kl(sf_mu_flat, sf_sigma_flat, lf_mu_flat, lf_sigma_flat).view(batch_size, max_output_size)
         score = -kl
         score.masked_fill_(output_mask, float('-inf'))
         return score, target_lf_ids, None
@@ -1,13 +1,17 @@
 import os
 import sys
 
-import numpy as np
+import argparse
 import torch
 import torch.nn as nn
 
 home_dir = os.path.expanduser('~/LMC/')
+sys.path.insert(0, os.path.join(home_dir, 'modules', 'lmc'))
 sys.path.insert(0, os.path.join(home_dir, 'utils'))
 from compute_utils import compute_kl, mask_2D
+from lmc_model import LMC
+from model_utils import expand_embeddings, parameters_state
+from profile_utils import record_function
 
 
 class LMCAcronymExpander(nn.Module):
@@ -24,51 +28,99 @@ class LMCAcronymExpander(nn.Module):
         super(LMCAcronymExpander, self).__init__()
 
         token_vocab_size = token_vocab.size()
-        prev_token_vocab_size, encoder_embed_dim = lmc_model.encoder.token_embeddings.weight.size()
+        prev_token_vocab_size = lmc_model.encoder.token_embeddings.weight.size()[0]
+        assert prev_token_vocab_size == lmc_model.decoder.token_embeddings.weight.size()[0]
 
         # In main evaluation script, we add long forms not present in vocabulary so we must expand embedding dimensions
-        # Merge weights from pre-trained model to encoder and randomly initialize extra vocabulary items added
-        prev_encoder_token_embeddings = lmc_model.encoder.token_embeddings.weight.detach().numpy()
+        # Merge weights from pre-trained encoder & decoder and randomly initialize extra vocabulary items added
         self.encoder = lmc_model.encoder
-        self.encoder.token_embeddings = nn.Embedding(token_vocab_size, encoder_embed_dim, padding_idx=0)
-        encoder_init = np.random.normal(0, 1, size=(token_vocab_size, encoder_embed_dim))
-        encoder_init[:prev_token_vocab_size, :] = prev_encoder_token_embeddings
-        self.encoder.token_embeddings.load_state_dict({'weight': torch.from_numpy(encoder_init)})
-
-        # Merge weights from pre-trained model to decoder and randomly initialize extra vocabulary items added
-        prev_token_vocab_size_decoder, decoder_embed_dim = lmc_model.decoder.token_embeddings.weight.size()
-        assert prev_token_vocab_size == prev_token_vocab_size_decoder
-        prev_decoder_token_embeddings = lmc_model.decoder.token_embeddings.weight.detach().numpy()
+        self.encoder.token_embeddings = expand_embeddings(self.encoder.token_embeddings, token_vocab_size)
         self.decoder = lmc_model.decoder
-        self.decoder.token_embeddings = nn.Embedding(token_vocab_size, decoder_embed_dim, padding_idx=0)
-        decoder_init = np.random.normal(0, 1, size=(token_vocab_size, decoder_embed_dim))
-        decoder_init[:prev_token_vocab_size, :] = prev_decoder_token_embeddings
-        self.decoder.token_embeddings.load_state_dict({'weight': torch.from_numpy(decoder_init)})
+        self.decoder.token_embeddings = expand_embeddings(self.decoder.token_embeddings, token_vocab_size)
 
         self.device = args.device
+        # Decoder output for every (LF, metadata) entry of a tensorized dataset.  See cache_lf_gaussians
+        self.lf_marginal_cache = None
+
+    @classmethod
+    def from_bundle(cls, args, bundle):
+        """
+        :param args: argparse instance.  Only args.device is used.
+        :param bundle: dictionary returned by load_bundle in acronyms/expander_bundle.py
+        :return: LMCAcronymExpander restored from an exported inference bundle
+
+        The bundle vocabulary already contains SF and LF tokens so no embeddings need to be expanded.
+        """
+        lmc_model = LMC(argparse.Namespace(**bundle['args']), bundle['token_vocab'].size(),
+                        bundle['metadata_vocab'].size())
+        expander = cls(args, lmc_model, bundle['token_vocab'])
+        expander.load_state_dict(bundle['state_dict'])
+        return expander
 
     def _compute_marginal(self, ids, metadata_ids, normalizer=None):
         """
-        :param ids: LongTensor of batch_size x max_output_size x max_lf_len
-        :param metadata_ids: batch_size x max_output_size x max_num_metadata
-        :param normalizer: batch_size x max_output_size x 1.  Number of n-grams in each LF (used for computing mean)
-        :return: Gaussian parameters mu (batch_size x max_output_size )
+        :param ids: LongTensor of num_pairs x max_lf_len.  LF ids for every (LF, metadata) pair
+        :param metadata_ids: LongTensor of num_pairs
+        :param normalizer: num_pairs x 1.  Number of n-grams in each LF (used for computing mean)
+        :return: Gaussian parameters mu (num_pairs x embed_dim) and sigma (num_pairs x 1)
         """
-        batch_size, max_output, num_metadata = metadata_ids.size()
-        max_lf_ngram = ids.size()[-1]
-        normalizer_tiled_flat = normalizer.unsqueeze(2).repeat(1, 1, num_metadata, 1).view(
-            batch_size * max_output * num_metadata, 1)
-        ids_tiled = ids.unsqueeze(2).repeat(1, 1, num_metadata, 1)
-        ids_tiled_flat = ids_tiled.view(batch_size * max_output * num_metadata, max_lf_ngram)
-        metadata_ids_flat = metadata_ids.reshape(-1)
-        mu_marginal_flat, sigma_marginal_flat = self.decoder(
-            ids_tiled_flat, metadata_ids_flat, normalizer=normalizer_tiled_flat)
-        mu_marginal = mu_marginal_flat.view(batch_size, max_output, num_metadata, -1)
-        sigma_marginal = sigma_marginal_flat.view(batch_size, max_output, num_metadata, -1)
-        return mu_marginal, sigma_marginal
+        return self.decoder(ids, metadata_ids, normalizer=normalizer)
+
+    def _lf_marginal_cache_valid(self, key):
+        if self.training or self.lf_marginal_cache is None:
+            return False
+        if key is None or self.lf_marginal_cache['key'] is not key:
+            return False
+        return self.lf_marginal_cache['decoder_state'] == parameters_state(self.decoder)
+
+    def train(self, mode=True):
+        """
+        Drops the LF Gaussian cache when entering training mode.  Optimizers update p.data in place, which (on older
+        versions of torch) does not bump _version, so parameters_state alone can't detect fine-tuning.
+        """
+        if mode:
+            self.lf_marginal_cache = None
+        return super(LMCAcronymExpander, self).train(mode)
+
+    def cache_lf_gaussians(self, batcher, chunk_size=8192):
+        """
+        :param batcher: AcronymBatcherLoader instance which has tensorized its examples.  Batchers which share candidate
+        arrays (see tensorize_candidates) share the cache.
+        :param chunk_size: number of (LF, metadata) entries to decode at once
+        :return: None
+
+        LF Gaussians depend only on the LF tokens and the metadata, not on the SF context.  In evaluation mode, the
+        decoder is run once for every (LF, metadata) entry in the batcher's p(metadata|LF) and forward gathers from
+        this table (by lf_metadata_idxs) instead of re-running the decoder on every batch.  The table is rebuilt
+        whenever the batcher's candidate arrays change (i.e. a new sf_lf_map) or the decoder weights change and it is
+        dropped whenever the model enters training mode (i.e. fine-tuning).  forward only uses it for batches of the
+        batcher it was built for.
+        """
+        if self.training or self._lf_marginal_cache_valid(key=batcher.candidates):
+            return
+        lf_ids, lf_token_ct, lf_metadata_ids = batcher.lf_metadata_entries()
+        lf_ids = torch.LongTensor(lf_ids).clamp_min_(0).to(self.device)
+        normalizer = torch.FloatTensor(lf_token_ct).unsqueeze(-1).clamp_min_(1.0).to(self.device)
+        lf_metadata_ids = torch.LongTensor(lf_metadata_ids).clamp_min_(0).to(self.device)
+        lf_mu, lf_sigma = [], []
+        with torch.no_grad():
+            for start_idx in range(0, lf_ids.size()[0], chunk_size):
+                end_idx = start_idx + chunk_size
+                mu, sigma = self._compute_marginal(
+                    lf_ids[start_idx:end_idx], lf_metadata_ids[start_idx:end_idx],
+                    normalizer=normalizer[start_idx:end_idx])
+                lf_mu.append(mu)
+                lf_sigma.append(sigma)
+        self.lf_marginal_cache = {
+            'key': batcher.candidates,
+            'decoder_state': parameters_state(self.decoder),
+            'mu': torch.cat(lf_mu, dim=0) if len(lf_mu) > 0 else None,
+            'sigma': torch.cat(lf_sigma, dim=0) if len(lf_sigma) > 0 else None,
+        }
 
     def forward(self, sf_ids, section_ids, category_ids, context_ids, lf_ids, target_lf_ids, lf_token_ct,
-                lf_metadata_ids, lf_metadata_p, num_outputs, num_contexts):
+                lf_metadata_ids, lf_metadata_pos, lf_metadata_idxs, lf_pair_ids, lf_metadata_p, num_outputs,
+                num_contexts, cache_key=None):
         """
         :param sf_ids: LongTensor of batch_size
         :param section_ids: LongTensor of batch_size
@@ -77,14 +129,23 @@ class LMCAcronymExpander(nn.Module):
         :param lf_ids: LongTensor of batch_size x max_output_size x max_lf_len
         :param target_lf_ids: LongTensor of batch_size representing which index in lf_ids lies the target LF
         :param lf_token_ct: LongTensor of batch_size x max_output_size.  N-gram count for each LF (used for masking)
-        :param lf_metadata_ids: batch_size x max_output_size x max_num_metadata. Ids for every metadata LF appears in
-        :param lf_metadata_p: batch_size x max_output_size x max_num_metadata
-        Empirical probability for lf_metadata_ids ~ p(metadata|LF)
+        :param lf_metadata_ids: LongTensor of num_pairs.  Ids for every metadata each candidate LF appears in
+        :param lf_metadata_pos: LongTensor of num_pairs.  Position of each pair's LF in the flattened
+        batch_size x max_output_size grid of candidates
+        :param lf_metadata_idxs: LongTensor of num_pairs.  Row of each pair in the tensorized p(metadata|LF).  Used to
+        look up precomputed LF Gaussians (see cache_lf_gaussians)
+        :param lf_pair_ids: unused.  Row of each candidate LF in the batcher's (SF, LF) pairs (used by the BSG)
+        :param lf_metadata_p: FloatTensor of num_pairs.  Empirical probability for lf_metadata_ids ~ p(metadata|LF)
         :param num_outputs: list representing the number of target LFs for each row in batch.
         Used for masking to avoid returning invalid predictions.
         :param num_contexts: LongTensor of batch_size.  The actual window size of the SF context.
         Many are shorter than target of 2 * context_window.
+        :param cache_key: candidate arrays of the batcher which produced the batch (batcher.candidates).  Cached LF
+        Gaussians are only used if they were built for it.
         :return: scores for each candidate LF, target_lf_ids, rel_weights (output of encoder gating function)
+
+        (LF, metadata) pairs are ragged (see compute_lf_metadata_csr in acronym_batcher.py) so the decoder and KL are
+        only computed for pairs with non-zero p(metadata|LF) rather than for every padded metadata slot.
         """
         batch_size, max_output_size, max_lf_ngram = lf_ids.size()
         _, num_context_ids = context_ids.size()
@@ -93,28 +154,31 @@ class LMCAcronymExpander(nn.Module):
         # Mask padded context ids
         mask_size = torch.Size([batch_size, num_context_ids])
         mask = mask_2D(mask_size, num_contexts).to(self.device)
-        sf_mu, sf_sigma, rel_weights = self.encoder(
-            sf_ids, section_ids, context_ids, mask, center_mask_p=None, context_mask_p=None)
-
-        num_metadata = lf_metadata_ids.size()[-1]
+        with record_function('encoder'):
+            sf_mu, sf_sigma, rel_weights = self.encoder(
+                sf_ids, section_ids, context_ids, mask, center_mask_p=None, context_mask_p=None)
 
-        # Tile SFs across each LF and flatten both SFs and LFs
-        sf_mu_flat = sf_mu.unsqueeze(1).repeat(1, max_output_size * num_metadata, 1).view(
-            batch_size * max_output_size * num_metadata, -1)
-        sf_sigma_flat = sf_sigma.unsqueeze(1).repeat(1, max_output_size * num_metadata, 1).view(
-            batch_size * max_output_size * num_metadata, -1)
+        # Select the SF for each (LF, metadata) pair
+        example_idxs = lf_metadata_pos // max_output_size
+        sf_mu_flat, sf_sigma_flat = sf_mu[example_idxs], sf_sigma[example_idxs]
 
         # Compute E[LF]
-        normalizer = lf_token_ct.unsqueeze(-1).clamp_min(1.0)
-        lf_mu, lf_sigma = self._compute_marginal(lf_ids, lf_metadata_ids, normalizer=normalizer)
-        lf_mu_flat = lf_mu.view(batch_size * max_output_size * num_metadata, -1)
-        lf_sigma_flat = lf_sigma.view(batch_size * max_output_size * num_metadata, 1)
+        with record_function('decoder'):
+            if self._lf_marginal_cache_valid(cache_key) and lf_metadata_idxs.size()[0] > 0:
+                lf_mu_flat = self.lf_marginal_cache['mu'][lf_metadata_idxs]
+                lf_sigma_flat = self.lf_marginal_cache['sigma'][lf_metadata_idxs]
+            else:
+                lf_ids_flat = lf_ids.view(batch_size * max_output_size, max_lf_ngram)[lf_metadata_pos]
+                normalizer = lf_token_ct.view(-1)[lf_metadata_pos].unsqueeze(-1).clamp_min(1.0)
+                lf_mu_flat, lf_sigma_flat = self._compute_marginal(
+                    lf_ids_flat, lf_metadata_ids, normalizer=normalizer)
         output_dim = torch.Size([batch_size, max_output_size])
         output_mask = mask_2D(output_dim, num_outputs).to(self.device)
 
-        kl_marginal = compute_kl(sf_mu_flat, sf_sigma_flat, lf_mu_flat, lf_sigma_flat).view(
-            batch_size, max_output_size, num_metadata)
-        kl = (kl_marginal * lf_metadata_p).sum(2)
+        with record_function('kl'):
+            kl_marginal = compute_kl(sf_mu_flat, sf_sigma_flat, lf_mu_flat, lf_sigma_flat).view(-1)
+            kl = torch.zeros(batch_size * max_output_size, dtype=kl_marginal.dtype, device=kl_marginal.device)
+            kl = kl.index_add_(0, lf_metadata_pos, kl_marginal * lf_metadata_p).view(batch_size, max_output_size)
         score = -kl
 
         score.masked_fill_(output_mask, float('-inf'))
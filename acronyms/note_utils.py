@@ -0,0 +1,163 @@
+import os
+import re
+from string import punctuation
+import sys
+
+import numpy as np
+import pandas as pd
+
+home_dir = os.path.expanduser('~/LMC/')
+sys.path.insert(0, os.path.join(home_dir, 'acronyms'))
+sys.path.insert(0, os.path.join(home_dir, 'preprocess'))
+sys.path.insert(0, os.path.join(home_dir, 'preprocess', 'context_extraction'))
+from acronym_utils import eval_tokenize
+from aho_corasick import ShortFormMatcher
+from compute_sections import HEADER_SEARCH_REGEX
+from mimic_tokenize import create_section_token
+
+HEADER_REGEX = re.compile(HEADER_SEARCH_REGEX, flags=re.M)
+
+
+class SectionMapper:
+    """
+    Maps raw section headers onto section tokens (header=SECTIONNAME) known to the language model.  Mirrors
+    add_section_headers_to_casi: exact matches are used as is.  Otherwise, the curated CASI -> MIMIC mapping is tried.
+    Unknown headers map to <pad>.
+    """
+    def __init__(self, vocab, section_map_fp=None):
+        """
+        :param vocab: vocabulary which holds section tokens (metadata vocabulary for the LMC, token vocabulary for BSG)
+        :param section_map_fp: csv with casi_section and mimic_section columns.  Defaults to the CASI mapping.
+        """
+        self.vocab = vocab
+        if section_map_fp is None:
+            section_map_fp = os.path.join(home_dir, 'shared_data', 'casi', 'casi_mimic_section_map.csv')
+        self.section_map = {}
+        if os.path.exists(section_map_fp):
+            section_map = pd.read_csv(section_map_fp)
+            self.section_map = section_map.set_index('casi_section')['mimic_section'].to_dict()
+
+    def map(self, section):
+        """
+        :param section: raw section header (i.e. 'History of Present Illness:') or None
+        :return: section token in self.vocab or <pad>
+        """
+        if section is None or type(section) == float or len(section.strip()) == 0:
+            return '<pad>'
+        if section.startswith('header='):
+            return section if self.vocab.get_id(section) > -1 else '<pad>'
+        section_stripped = re.sub(r'\s+', ' ', section).strip(punctuation).strip().upper()
+        section_token = create_section_token(section_stripped)
+        if self.vocab.get_id(section_token) > -1:
+            return section_token
+        mapped = self.section_map.get(section_stripped)
+        if mapped is None or type(mapped) == float or len(mapped) == 0:
+            return '<pad>'
+        section_token = create_section_token(mapped)
+        return section_token if self.vocab.get_id(section_token) > -1 else '<pad>'
+
+
+def trim_context(tokens, sf_idx, window=10):
+    """
+    :param tokens: output of eval_tokenize
+    :param sf_idx: index of the SF in tokens
+    :param window: number of tokens to keep on either side of the SF
+    :return: space-delimited window of tokens centered on (and including) the SF, as in preprocess_casi_dataset
+    """
+    start_idx = max(0, sf_idx - window)
+    end_idx = min(sf_idx + window + 1, len(tokens))
+    return ' '.join(tokens[start_idx:end_idx])
+
+
+def context_to_example(sf, context, section=None, section_mapper=None, window=10, sf_occurrence=0):
+    """
+    :param sf: acronym short form (as it appears in sf_lf_map)
+    :param context: raw text containing the SF
+    :param section: Optional raw section header in which the context appears
+    :param section_mapper: SectionMapper instance.  If None, section is used as is.
+    :param window: number of tokens to keep on either side of the SF
+    :param sf_occurrence: which occurrence of the SF in context to expand (0 is the first)
+    :return: dictionary with the columns expected by AcronymBatcherLoader (sf, trimmed_tokens, section, target_lf_idx)
+
+    Tokenizes with the same eval_tokenize and windowing used to preprocess CASI.  Raises a ValueError if the SF cannot
+    be found in the tokenized context.
+    """
+    tokens = eval_tokenize(context)
+    sf_idxs = np.where(np.array(tokens) == sf.lower())[0]
+    if len(sf_idxs) <= sf_occurrence:
+        raise ValueError('Could not find occurrence {} of SF={} in the tokenized context.'.format(sf_occurrence, sf))
+    return {
+        'sf': sf,
+        'trimmed_tokens': trim_context(tokens, sf_idxs[sf_occurrence], window=window),
+        'section': section_mapper.map(section) if section_mapper is not None else (section or '<pad>'),
+        'target_lf_idx': 0,
+    }
+
+
+def find_sf_mentions(text, sfs):
+    """
+    :param text: raw note
+    :param sfs: collection of SFs to look for or a ShortFormMatcher built from them (reuse it across notes)
+    :return: list of (sf, start, end) character spans for every whole-word, case-sensitive SF mention in text
+
+    The longest SF wins when several start at the same position.
+    """
+    sf_matcher = sfs if isinstance(sfs, ShortFormMatcher) else ShortFormMatcher(sfs)
+    return [(m.short_form, m.form_start, m.form_end) for m in sf_matcher.finditer(text)]
+
+
+def find_section_headers(text):
+    """
+    :param text: raw note
+    :return: list of (start, header) for every section header matched by compute_sections.HEADER_SEARCH_REGEX (in order
+    of appearance)
+    """
+    return [(m.start(1), m.group(1)) for m in HEADER_REGEX.finditer(text)]
+
+
+def note_to_examples(text, sfs, section_mapper=None, window=10):
+    """
+    :param text: raw note
+    :param sfs: collection of SFs to expand (i.e. the keys of sf_lf_map) or a ShortFormMatcher built from them
+    :param section_mapper: SectionMapper instance.  If None, raw headers are used as is.
+    :param window: number of tokens to keep on either side of each SF
+    :return: list of examples (see context_to_example) with the character span (start, end) of each mention
+
+    The note is tokenized once.  Each mention is aligned to the token which starts at its character offset, i.e. its
+    index is the number of tokens in the text which precedes it.  Lowercase homographs of an SF (i.e. "ms" before "MS")
+    therefore don't shift later mentions.  Mentions which can't be aligned (i.e. inside a [**...**] pattern) are
+    skipped.  Each mention is assigned the last section header which precedes it (only known sections count when
+    section_mapper is provided).
+    """
+    mentions = find_sf_mentions(text, sfs)
+    if len(mentions) == 0:
+        return []
+    tokens = eval_tokenize(text)
+    headers = find_section_headers(text)
+    if section_mapper is not None:
+        # Ignore lines such as 'Dose: 5mg' which look like headers but aren't known sections
+        headers = [(start, section_mapper.map(header)) for start, header in headers]
+        headers = [(start, section) for start, section in headers if not section == '<pad>']
+    header_starts = [start for start, _ in headers]
+
+    examples = []
+    prev_start, prefix_len = 0, 0
+    for sf, start, end in mentions:
+        # Tokenize only the text between consecutive mentions.  Cleaning regexes can occasionally behave differently
+        # at a segment boundary, so fall back to tokenizing the full prefix when the SF is not where we expect it.
+        sf_idx = prefix_len + len(eval_tokenize(text[prev_start:start]))
+        if sf_idx >= len(tokens) or not tokens[sf_idx] == sf.lower():
+            sf_idx = len(eval_tokenize(text[:start]))
+        prev_start, prefix_len = start, sf_idx
+        if sf_idx >= len(tokens) or not tokens[sf_idx] == sf.lower():
+            continue
+        header_idx = np.searchsorted(header_starts, start, side='left') - 1
+        examples.append({
+            'sf': sf,
+            'trimmed_tokens': trim_context(tokens, sf_idx, window=window),
+            'section': headers[header_idx][1] if header_idx >= 0 else '<pad>',
+            'target_lf_idx': 0,
+            'start': start,
+            'end': end,
+        })
+    return examples
@@ -0,0 +1,300 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import os
+from queue import Empty, Queue
+from socketserver import ThreadingMixIn
+import sys
+from threading import Event, Thread
+from time import time
+
+import argparse
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+
+home_dir = os.path.expanduser('~/LMC/')
+sys.path.insert(0, os.path.join(home_dir, 'acronyms'))
+sys.path.insert(0, os.path.join(home_dir, 'acronyms', 'modules'))
+sys.path.insert(0, os.path.join(home_dir, 'preprocess'))
+sys.path.insert(0, os.path.join(home_dir, 'preprocess', 'context_extraction'))
+sys.path.insert(0, os.path.join(home_dir, 'utils'))
+from acronym_batcher import AcronymBatcherLoader, tensorize_candidates
+from acronym_utils import process_batch
+from aho_corasick import ShortFormMatcher
+from expander_bundle import load_expander
+from model_utils import render_args, tensor_to_np
+from note_utils import SectionMapper, context_to_example, note_to_examples
+
+
+class PendingRequest:
+    def __init__(self, examples):
+        self.examples = examples
+        self.scores = None
+        self.error = None
+        self.done = Event()
+
+
+class MicroBatcher:
+    """
+    Groups examples from concurrent requests into a single forward pass.
+
+    A background thread waits for the first pending request and then keeps collecting requests until either
+    max_batch_size examples are queued or max_wait_ms have elapsed.  Candidate arrays (see tensorize_candidates) are
+    computed once for every SF in the bundle so that cached LF Gaussians are reused across micro-batches.
+    """
+    def __init__(self, expander, bundle, max_batch_size=64, max_wait_ms=5.0):
+        """
+        :param expander: acronym expander in eval mode
+        :param bundle: dictionary returned by load_expander (vocabularies, SF-LF maps and p(metadata|LF))
+        :param max_batch_size: number of examples beyond which a micro-batch is closed early
+        :param max_wait_ms: latency budget for collecting a micro-batch after its first request arrives
+        """
+        self.expander = expander
+        self.bundle = bundle
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.args = argparse.Namespace(lm_type=bundle['lm_type'], device='cpu')
+        self.loss_func = nn.CrossEntropyLoss()
+        self.candidates = tensorize_candidates(
+            sorted(bundle['sf_tokenized_lf_map'].keys()), bundle['token_vocab'], bundle['sf_lf_map'],
+            bundle['sf_tokenized_lf_map'], bundle['lf_metadata_counts'], metadata_vocab=bundle['metadata_vocab'])
+        self.queue = Queue()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.num_batches, self.num_examples = 0, 0
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def submit(self, examples):
+        """
+        :param examples: list of examples (see note_utils.context_to_example)
+        :return: list of numpy arrays.  Scores for each candidate LF (in sf_lf_map order) of each example
+        """
+        if len(examples) == 0:
+            return []
+        request = PendingRequest(examples)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.scores
+
+    def _collect(self, first_request):
+        requests, num_examples = [first_request], len(first_request.examples)
+        deadline = time() + self.max_wait
+        while num_examples < self.max_batch_size:
+            timeout = deadline - time()
+            if timeout <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=timeout)
+            except Empty:
+                break
+            if request is None:
+                self.queue.put(None)  # Stop after serving what has already been collected
+                break
+            requests.append(request)
+            num_examples += len(request.examples)
+        return requests
+
+    def _run(self):
+        while True:
+            request = self.queue.get()
+            if request is None:
+                break
+            requests = self._collect(request)
+            try:
+                scores = self.score([example for r in requests for example in r.examples])
+                offset = 0
+                for r in requests:
+                    r.scores = scores[offset:offset + len(r.examples)]
+                    offset += len(r.examples)
+            except Exception as e:
+                for r in requests:
+                    r.error = e
+            for r in requests:
+                r.done.set()
+
+    def score(self, examples):
+        """
+        :param examples: list of examples (see note_utils.context_to_example)
+        :return: list of numpy arrays.  Scores for each candidate LF (in sf_lf_map order) of each example
+        """
+        df = pd.DataFrame(examples, columns=['sf', 'trimmed_tokens', 'section', 'target_lf_idx'])
+        batcher = AcronymBatcherLoader(df, batch_size=df.shape[0], candidates=self.candidates)
+        batcher.reset(shuffle=False)
+        bundle = self.bundle
+        with torch.no_grad():
+            _, _, _, scores, _ = process_batch(
+                self.args, batcher, self.expander, self.loss_func, bundle['token_vocab'], bundle['metadata_vocab'],
+                bundle['sf_lf_map'], bundle['sf_tokenized_lf_map'], bundle['lf_metadata_counts'])
+        scores = tensor_to_np(scores)
+        self.num_batches += 1
+        self.num_examples += len(examples)
+        return [scores[example_idx, :len(bundle['sf_lf_map'][example['sf']])]
+                for example_idx, example in enumerate(examples)]
+
+
+class ExpansionService:
+    """
+    Turns JSON requests into examples, scores them through the MicroBatcher, and ranks candidate LFs.
+
+    Accepted request bodies:
+    - {"text": raw note} --> every SF mention in the note is expanded (with its character span)
+    - {"sf": SF, "context": raw text containing the SF, "section": optional raw header, "sf_occurrence": optional}
+    - {"examples": [list of the above SF requests]}
+    Each may also specify "top_k" (defaults to every candidate).
+    """
+    def __init__(self, micro_batcher, window=10):
+        self.micro_batcher = micro_batcher
+        self.bundle = micro_batcher.bundle
+        self.window = window
+        section_vocab = self.bundle['metadata_vocab'] or self.bundle['token_vocab']
+        self.section_mapper = SectionMapper(section_vocab)
+        self.sfs = set(self.bundle['sf_lf_map'].keys())
+        self.sf_matcher = ShortFormMatcher(self.sfs)
+
+    def _sf_example(self, request):
+        sf = request.get('sf')
+        if sf not in self.sfs:
+            raise ValueError('Unknown SF={}'.format(sf))
+        if 'context' not in request:
+            raise ValueError('SF requests must provide a context.')
+        return context_to_example(sf, request['context'], section=request.get('section'),
+                                  section_mapper=self.section_mapper, window=self.window,
+                                  sf_occurrence=int(request.get('sf_occurrence', 0)))
+
+    def _rank(self, example, scores, top_k=None):
+        lfs = self.bundle['sf_lf_map'][example['sf']]
+        p = np.exp(scores - scores.max())
+        p /= p.sum()
+        order = np.argsort(-scores, kind='mergesort')[:top_k]
+        expansion = {
+            'sf': example['sf'],
+            'section': example['section'],
+            'candidates': [{'lf': lfs[lf_idx], 'score': float(scores[lf_idx]), 'p': float(p[lf_idx])}
+                           for lf_idx in order]
+        }
+        if 'start' in example:
+            expansion['start'], expansion['end'] = int(example['start']), int(example['end'])
+        return expansion
+
+    def expand(self, request):
+        """
+        :param request: decoded JSON request body
+        :return: dictionary with a ranked list of candidate LFs for every SF in the request
+        """
+        if not isinstance(request, dict):
+            raise ValueError('Request body must be a JSON object.')
+        top_k = request.get('top_k')
+        if top_k is not None:
+            top_k = int(top_k)
+        if 'text' in request:
+            examples = note_to_examples(request['text'], self.sf_matcher, section_mapper=self.section_mapper,
+                                        window=self.window)
+        elif 'examples' in request:
+            examples = [self._sf_example(r) for r in request['examples']]
+        else:
+            examples = [self._sf_example(request)]
+        scores = self.micro_batcher.submit(examples)
+        return {'expansions': [self._rank(example, s, top_k=top_k) for example, s in zip(examples, scores)]}
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ExpansionHandler(BaseHTTPRequestHandler):
+    def _send_json(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/health':
+            self._send_json(404, {'error': 'Not found'})
+            return
+        micro_batcher = self.server.service.micro_batcher
+        self._send_json(200, {
+            'status': 'ok',
+            'lm_type': micro_batcher.bundle['lm_type'],
+            'num_sfs': len(self.server.service.sfs),
+            'num_batches': micro_batcher.num_batches,
+            'num_examples': micro_batcher.num_examples,
+        })
+
+    def do_POST(self):
+        if self.path != '/expand':
+            self._send_json(404, {'error': 'Not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            response = self.server.service.expand(request)
+        except (ValueError, TypeError) as e:  # Includes malformed JSON
+            self._send_json(400, {'error': str(e)})
+            return
+        except Exception as e:
+            self._send_json(500, {'error': str(e)})
+            return
+        self._send_json(200, response)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super(ExpansionHandler, self).log_message(format, *args)
+
+
+def build_server(bundle_fp, host='127.0.0.1', port=8008, window=10, max_batch_size=64, max_wait_ms=5.0,
+                 verbose=False):
+    """
+    :return: HTTP server (not yet serving) with a started MicroBatcher attached
+
+    Loads the expander bundle exactly once.  Call serve_forever on the result, and micro_batcher.stop on shutdown.
+    """
+    start_time = time()
+    expander, bundle = load_expander(bundle_fp, device='cpu')
+    print('Loaded {} expander in {} seconds'.format(bundle['lm_type'], round(time() - start_time, 2)))
+    micro_batcher = MicroBatcher(expander, bundle, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+    micro_batcher.start()
+    server = ThreadingHTTPServer((host, port), ExpansionHandler)
+    server.service = ExpansionService(micro_batcher, window=window)
+    server.verbose = verbose
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Long-running clinical acronym expansion service (CPU).')
+    parser.add_argument('--bundle_fp', required=True, help='Expander bundle (see acronyms/expander_bundle.py).')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=8008, type=int)
+    parser.add_argument('--window', default=10, type=int, help='Context window on either side of each SF.')
+    parser.add_argument('--max_batch_size', default=64, type=int,
+                        help='Close a micro-batch early once it holds this many examples.')
+    parser.add_argument('--max_wait_ms', default=5.0, type=float,
+                        help='Latency budget for collecting concurrent requests into a micro-batch.')
+    parser.add_argument('--num_threads', default=None, type=int, help='torch.set_num_threads (intra-op parallelism).')
+    parser.add_argument('-verbose', default=False, action='store_true', help='Log every request.')
+
+    args = parser.parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    render_args(args)
+
+    server = build_server(args.bundle_fp, host=args.host, port=args.port, window=args.window,
+                          max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms, verbose=args.verbose)
+    print('Serving acronym expansions on http://{}:{} (POST /expand, GET /health)'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('Shutting down...')
+    finally:
+        server.server_close()
+        server.service.micro_batcher.stop()
@@ -0,0 +1,236 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import json
+import os
+import sys
+from threading import Lock
+from time import time
+
+import argparse
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+
+home_dir = os.path.expanduser('~/LMC/')
+sys.path.insert(0, os.path.join(home_dir, 'acronyms'))
+sys.path.insert(0, os.path.join(home_dir, 'acronyms', 'modules'))
+sys.path.insert(0, os.path.join(home_dir, 'benchmarks'))
+sys.path.insert(0, os.path.join(home_dir, 'modules', 'bsg'))
+sys.path.insert(0, os.path.join(home_dir, 'modules', 'lmc'))
+sys.path.insert(0, os.path.join(home_dir, 'preprocess'))
+sys.path.insert(0, os.path.join(home_dir, 'utils'))
+from acronym_batcher import AcronymBatcherLoader, tensorize_candidates
+from acronym_utils import preprocess_casi_dataset, process_batch, tokenize_sf_lf_map
+from bench_utils import compare_results, load_results, save_results, summarize_times
+from bsg_utils import restore_inference_model as restore_bsg
+from evaluate import extract_smoothed_metadata_probs
+from expander_bundle import EXPANDERS, load_expander
+from lmc_utils import restore_inference_model as restore_lmc
+from model_utils import render_args
+
+
+def load_model(args):
+    """
+    :param args: argparse instance with either bundle_fp or lm_type and lm_experiment
+    :return: expander in eval mode on CPU and a dictionary with the vocabularies, SF-LF maps and p(metadata|LF)
+    """
+    if args.bundle_fp is not None:
+        expander, bundle = load_expander(args.bundle_fp, device='cpu')
+        return expander, bundle
+
+    if args.lm_type == 'bsg':
+        prev_args, lm, token_vocab, _ = restore_bsg(args.lm_experiment, ckpt=args.ckpt)
+        metadata_vocab, lf_metadata_counts = None, None
+    else:
+        prev_args, lm, token_vocab, metadata_vocab, _, _, _ = restore_lmc(args.lm_experiment, ckpt=args.ckpt)
+        lf_metadata_counts = extract_smoothed_metadata_probs(metadata=prev_args.metadata)
+    with open(os.path.join(home_dir, 'shared_data', 'casi', 'sf_lf_map.json'), 'r') as fd:
+        sf_lf_map = json.load(fd)
+    sf_tokenized_lf_map = tokenize_sf_lf_map(sf_lf_map, token_vocab)
+    expander = EXPANDERS[args.lm_type](argparse.Namespace(device='cpu'), lm, token_vocab)
+    expander.eval()
+    return expander, {
+        'lm_type': args.lm_type,
+        'token_vocab': token_vocab,
+        'metadata_vocab': metadata_vocab,
+        'sf_lf_map': sf_lf_map,
+        'sf_tokenized_lf_map': sf_tokenized_lf_map,
+        'lf_metadata_counts': lf_metadata_counts,
+    }
+
+
+def load_casi_contexts(sf_tokenized_lf_map, window=10):
+    """
+    :param sf_tokenized_lf_map: SFs for which the model has candidate LFs
+    :param window: context window with which CASI was preprocessed
+    :return: DataFrame of preprocessed CASI examples (sf, target_lf_idx, trimmed_tokens, section)
+    """
+    data_fp = os.path.join(home_dir, 'shared_data', 'casi', 'preprocessed_dataset_window_{}.csv'.format(window))
+    if not os.path.exists(data_fp):
+        print('Need to preprocess dataset first...')
+        preprocess_casi_dataset(window=window)
+    df = pd.read_csv(data_fp)
+    if 'section_mapped' in df.columns:
+        df['section'] = df['section_mapped']
+    df = df[df['sf'].isin(list(sf_tokenized_lf_map.keys()))]
+    return df[['sf', 'target_lf_idx', 'trimmed_tokens', 'section']].reset_index(drop=True)
+
+
+def generate_synthetic_contexts(num_examples, bundle, window=10, seed=1992):
+    """
+    :param num_examples: number of examples to generate
+    :param bundle: dictionary returned by load_model
+    :param window: target window on either side of the SF
+    :param seed: random seed
+    :return: DataFrame in the format of load_casi_contexts with random SFs, targets, sections and context words
+
+    Context tokens are drawn uniformly from the token vocabulary so that every token is in-vocabulary.  Context lengths
+    are uniform between 1 and 2 * window (truncation at section and document boundaries).
+    """
+    rng = np.random.RandomState(seed)
+    token_vocab, metadata_vocab = bundle['token_vocab'], bundle['metadata_vocab']
+    sf_tokenized_lf_map = bundle['sf_tokenized_lf_map']
+    sfs = sorted(sf_tokenized_lf_map.keys())
+    vocab_end = token_vocab.section_start_vocab_id or token_vocab.size()
+    rows = []
+    for _ in range(num_examples):
+        sf = sfs[rng.randint(len(sfs))]
+        context_ids = rng.randint(1, vocab_end, size=rng.randint(1, 2 * window + 1))
+        if metadata_vocab is not None and metadata_vocab.size() > 1:
+            section = metadata_vocab.get_token(rng.randint(1, metadata_vocab.size()))
+        else:
+            section = '<pad>'
+        rows.append({
+            'sf': sf,
+            'target_lf_idx': rng.randint(len(sf_tokenized_lf_map[sf])),
+            'trimmed_tokens': ' '.join(token_vocab.get_tokens(context_ids)),
+            'section': section
+        })
+    return pd.DataFrame(rows)
+
+
+class RequestReplayer:
+    """
+    Scores batches of SF contexts with a single expander shared across threads.  Each request builds its batch from
+    raw rows (AcronymBatcherLoader.next) and runs the same process_batch used by evaluate.py under torch.no_grad, so the
+    measured latency covers tensorization and the forward pass.  As in acronyms/serve.py, candidate arrays are computed
+    once for every SF so that LF Gaussians cached by the expander are shared across requests.
+    """
+    def __init__(self, expander, bundle):
+        self.expander = expander
+        self.bundle = bundle
+        self.args = argparse.Namespace(lm_type=bundle['lm_type'], device='cpu')
+        self.loss_func = nn.CrossEntropyLoss()
+        self.candidates = tensorize_candidates(
+            sorted(bundle['sf_tokenized_lf_map'].keys()), bundle['token_vocab'], bundle['sf_lf_map'],
+            bundle['sf_tokenized_lf_map'], bundle['lf_metadata_counts'], metadata_vocab=bundle['metadata_vocab'])
+
+    def score(self, batch_df):
+        """
+        :param batch_df: DataFrame of examples in a single request
+        :return: latency in milliseconds
+        """
+        start_time = time()
+        batcher = AcronymBatcherLoader(batch_df, batch_size=batch_df.shape[0], candidates=self.candidates)
+        batcher.reset(shuffle=False)
+        with torch.no_grad():
+            process_batch(self.args, batcher, self.expander, self.loss_func, self.bundle['token_vocab'],
+                          self.bundle['metadata_vocab'], self.bundle['sf_lf_map'], self.bundle['sf_tokenized_lf_map'],
+                          self.bundle['lf_metadata_counts'])
+        return (time() - start_time) * 1000.0
+
+    def replay(self, df, batch_size, concurrency, num_requests, warmup=5, seed=1992):
+        """
+        :param df: DataFrame of examples to replay (sampled with replacement into requests)
+        :param batch_size: number of examples per request
+        :param concurrency: number of threads submitting requests at once
+        :param num_requests: number of timed requests
+        :param warmup: number of untimed requests (run serially before timing starts)
+        :return: summary statistics of per-request latency along with examples/sec and requests/sec
+        """
+        rng = np.random.RandomState(seed)
+        requests = [df.iloc[rng.randint(df.shape[0], size=batch_size)] for _ in range(warmup + num_requests)]
+        for batch_df in requests[:warmup]:
+            self.score(batch_df)
+
+        latencies, lock = [], Lock()
+
+        def run(batch_df):
+            latency = self.score(batch_df)
+            with lock:
+                latencies.append(latency)
+
+        start_time = time()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(run, requests[warmup:]))
+        seconds = time() - start_time
+
+        stats = summarize_times(latencies)
+        stats['batch_size'] = batch_size
+        stats['concurrency'] = concurrency
+        stats['examples_per_sec'] = round(num_requests * batch_size / seconds, 2)
+        stats['requests_per_sec'] = round(num_requests / seconds, 2)
+        return stats
+
+
+def _parse_int_list(value):
+    return [int(x) for x in value.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Latency and throughput of clinical acronym expansion on CPU.')
+    parser.add_argument('--bundle_fp', default=None, help='Expander bundle (see acronyms/expander_bundle.py).  '
+                                                          'Otherwise, restores --lm_experiment.')
+    parser.add_argument('--lm_experiment', default='baseline-1-13')
+    parser.add_argument('--lm_type', default='bsg', help='bsg or lmc')
+    parser.add_argument('--ckpt', default=None, type=int,
+                        help='Optionally preselect an epoch from which to load pretrained.')
+    parser.add_argument('--contexts', default='casi', help='casi or synthetic')
+    parser.add_argument('--num_synthetic', default=5000, type=int, help='Number of synthetic contexts to generate.')
+    parser.add_argument('--window', default=10, type=int)
+    parser.add_argument('--batch_sizes', default='1,8,32,128', type=_parse_int_list)
+    parser.add_argument('--concurrency', default='1,4', type=_parse_int_list,
+                        help='Number of threads submitting requests concurrently.')
+    parser.add_argument('--num_requests', default=200, type=int, help='Timed requests per configuration.')
+    parser.add_argument('--warmup', default=5, type=int)
+    parser.add_argument('--num_threads', default=None, type=int, help='torch.set_num_threads (intra-op parallelism).')
+    parser.add_argument('--seed', default=1992, type=int)
+    parser.add_argument('--out_fp', default=None, help='Defaults to benchmarks/results/acronym_latency_<time>.json')
+    parser.add_argument('--baseline', default=None, help='Optionally compare against this results file.')
+    parser.add_argument('--threshold', default=0.1, type=float)
+
+    args = parser.parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    if args.out_fp is None:
+        args.out_fp = os.path.join(home_dir, 'benchmarks', 'results', 'acronym_latency_{}.json'.format(
+            datetime.now().strftime('%Y%m%d_%H%M%S')))
+    render_args(args)
+
+    start_time = time()
+    expander, bundle = load_model(args)
+    print('Loaded {} expander in {} seconds'.format(bundle['lm_type'], round(time() - start_time, 2)))
+    if args.contexts == 'casi':
+        df = load_casi_contexts(bundle['sf_tokenized_lf_map'], window=args.window)
+    elif args.contexts == 'synthetic':
+        df = generate_synthetic_contexts(args.num_synthetic, bundle, window=args.window, seed=args.seed)
+    else:
+        raise Exception('Didn\'t recognize contexts={}'.format(args.contexts))
+    print('Replaying {} {} contexts across {} SFs'.format(df.shape[0], args.contexts, df['sf'].nunique()))
+
+    replayer = RequestReplayer(expander, bundle)
+    results = {}
+    for batch_size in args.batch_sizes:
+        for concurrency in args.concurrency:
+            name = '{}_{}[b={},c={}]'.format(bundle['lm_type'], args.contexts, batch_size, concurrency)
+            results[name] = replayer.replay(df, batch_size, concurrency, args.num_requests, warmup=args.warmup,
+                                            seed=args.seed)
+            print('{}: p50={}ms, p95={}ms, p99={}ms, examples/sec={}'.format(
+                name, results[name]['median_ms'], results[name]['p95_ms'], results[name]['p99_ms'],
+                results[name]['examples_per_sec']))
+
+    save_results(results, args.out_fp, args=args, device='cpu')
+    if args.baseline is not None:
+        regressions = compare_results(load_results(args.baseline), load_results(args.out_fp), threshold=args.threshold)
+        sys.exit(1 if len(regressions) > 0 else 0)
@@ -0,0 +1,156 @@
+from collections import OrderedDict
+from datetime import datetime
+import json
+import os
+import platform
+import sys
+from time import time
+
+import numpy as np
+import torch
+
+home_dir = os.path.expanduser('~/LMC/')
+sys.path.insert(0, os.path.join(home_dir, 'utils'))
+from model_utils import get_git_revision_hash
+
+# Summary statistics which can be compared against a baseline
+METRICS = ['mean_ms', 'median_ms', 'min_ms', 'p95_ms', 'p99_ms']
+
+
+def _sync(device):
+    if device is not None and 'cuda' in str(device):
+        torch.cuda.synchronize()
+
+
+def summarize_times(times_ms):
+    """
+    :param times_ms: list of per-iteration (or per-request) timings in milliseconds
+    :return: OrderedDict of summary statistics
+    """
+    times = np.array(times_ms)
+    return OrderedDict([
+        ('repeats', len(times)),
+        ('mean_ms', round(float(times.mean()), 4)),
+        ('std_ms', round(float(times.std()), 4)),
+        ('min_ms', round(float(times.min()), 4)),
+        ('median_ms', round(float(np.percentile(times, 50)), 4)),
+        ('p95_ms', round(float(np.percentile(times, 95)), 4)),
+        ('p99_ms', round(float(np.percentile(times, 99)), 4)),
+        ('max_ms', round(float(times.max()), 4)),
+    ])
+
+
+def time_case(run_fn, warmup=3, repeats=20, device=None):
+    """
+    :param run_fn: no-argument callable which executes one iteration of the workload
+    :param warmup: number of untimed iterations (allocator, LSTM workspace and OpenMP thread pool warm-up)
+    :param repeats: number of timed iterations
+    :param device: Optional device on which run_fn executes.  Timings synchronize with CUDA devices.
+    :return: OrderedDict of summary statistics over the timed iterations in milliseconds
+    """
+    for _ in range(warmup):
+        run_fn()
+    _sync(device)
+    times = []
+    for _ in range(repeats):
+        start_time = time()
+        run_fn()
+        _sync(device)
+        times.append((time() - start_time) * 1000.0)
+    return summarize_times(times)
+
+
+def environment_info(device=None):
+    """
+    :param device: device on which the benchmarks ran
+    :return: dictionary describing the machine and library versions so that results are only compared like for like
+    """
+    try:
+        git_hash = get_git_revision_hash()
+    except Exception:  # Not run from within the repository (or git is unavailable)
+        git_hash = None
+    return {
+        'git_hash': git_hash,
+        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'hostname': platform.node(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'torch': torch.__version__,
+        'num_threads': torch.get_num_threads(),
+        'device': str(device),
+    }
+
+
+def save_results(results, out_fp, args=None, device=None):
+    """
+    :param results: dictionary of case name --> summary statistics returned by time_case
+    :param out_fp: json file to write
+    :param args: Optional argparse instance used to generate the results
+    :param device: device on which the benchmarks ran
+    :return: None
+    """
+    out_dir = os.path.dirname(out_fp)
+    if len(out_dir) > 0 and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    output = {
+        'environment': environment_info(device=device),
+        'args': {} if args is None else vars(args),
+        'results': results
+    }
+    print('Saving benchmark results to {}'.format(out_fp))
+    with open(out_fp, 'w') as fd:
+        json.dump(output, fd, indent=2)
+
+
+def load_results(fp):
+    """
+    :param fp: json file written by save_results
+    :return: full contents (environment, args, and results)
+    """
+    with open(fp, 'r') as fd:
+        return json.load(fd, object_pairs_hook=OrderedDict)
+
+
+def compare_results(baseline, current, threshold=0.1, metric='median_ms'):
+    """
+    :param baseline: output of load_results for the stored baseline
+    :param current: output of load_results (or the same structure) for the new run
+    :param threshold: relative slowdown (i.e. 0.1 = 10%) beyond which a case is flagged as a regression
+    :param metric: summary statistic to compare.  The median is the least sensitive to scheduling noise.
+    :return: list of names of the regressed cases
+
+    Prints a table with the baseline and current timings of every case present in both runs.  Cases present in only
+    one of the two are listed but never flagged.
+    """
+    baseline_env, current_env = baseline['environment'], current['environment']
+    for k in ['hostname', 'torch', 'num_threads', 'device']:
+        if baseline_env.get(k) != current_env.get(k):
+            print('Warning: {} differs between baseline ({}) and current run ({}).  Timings may not be '
+                  'comparable.'.format(k, baseline_env.get(k), current_env.get(k)))
+
+    baseline_results, current_results = baseline['results'], current['results']
+    regressions = []
+    name_width = max([len(name) for name in list(baseline_results.keys()) + list(current_results.keys())] + [4])
+    print('{}  {:>12}  {:>12}  {:>8}'.format('case'.ljust(name_width), 'baseline', 'current', 'change'))
+    for name, stats in current_results.items():
+        if name not in baseline_results:
+            print('{}  {:>12}  {:>12.3f}  {:>8}'.format(name.ljust(name_width), '-', stats[metric], 'new'))
+            continue
+        prev, curr = baseline_results[name][metric], stats[metric]
+        change = (curr - prev) / max(prev, 1e-8)
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('{}  {:>12.3f}  {:>12.3f}  {:>+7.1f}%{}'.format(name.ljust(name_width), prev, curr, change * 100, flag))
+    for name in baseline_results:
+        if name not in current_results:
+            print('{}  {:>12.3f}  {:>12}  {:>8}'.format(
+                name.ljust(name_width), baseline_results[name][metric], '-', 'missing'))
+
+    if len(regressions) > 0:
+        print('{} case(s) regressed by more than {}% ({}).'.format(len(regressions), round(threshold * 100, 1), metric))
+    else:
+        print('No regressions above {}% ({}).'.format(round(threshold * 100, 1), metric))
+    return regressions
@@ -0,0 +1,377 @@
+from argparse import Namespace
+from collections import OrderedDict
+from copy import deepcopy
+from datetime import datetime
+import os
+import sys
+
+import argparse
+import numpy as np
+import torch
+
+home_dir = os.path.expanduser('~/LMC/')
+sys.path.insert(0, os.path.join(home_dir, 'benchmarks'))
+sys.path.insert(0, os.path.join(home_dir, 'modules', 'bsg'))
+sys.path.insert(0, os.path.join(home_dir, 'modules', 'lmc'))
+sys.path.insert(0, os.path.join(home_dir, 'preprocess'))
+sys.path.insert(0, os.path.join(home_dir, 'utils'))
+from bench_utils import compare_results, load_results, METRICS, save_results, time_case
+from bsg_batcher import BSGBatchLoader
+from bsg_encoder import BSGEncoder
+from compute_sections import enumerate_metadata_ids_multi_bsg
+from compute_utils import compute_kl, mask_2D
+from lmc_decoder import LMCDecoder
+from lmc_encoder import LMCEncoder
+from lmc_main import _prepare_data
+from lmc_prebatch import DistributedDataset
+from model_utils import render_args
+from synthetic_corpus import zipf_probs
+from vocab import Vocab
+
+LATENT_DIM = 100  # Output dimension of BSG and LMC encoders and decoders
+
+
+def build_synthetic_ids(num_tokens=500000, vocab_size=20000, num_sections=50, num_categories=10,
+                        mean_section_len=40, mean_doc_sections=8, seed=1992):
+    """
+    :param num_tokens: approximate length of the flattened ids array
+    :param vocab_size: number of word types (Zipfian distributed)
+    :param num_sections: number of distinct section header pseudo-tokens
+    :param num_categories: number of distinct note type (category) pseudo-tokens
+    :param mean_section_len: mean number of words per section (Poisson distributed)
+    :param mean_doc_sections: mean number of sections per document (Poisson distributed, at least 1)
+    :param seed: random seed
+    :return: ids array and vocabulary laid out exactly like the output of preprocess/tokens_to_ids.py
+
+    Each document is [document=<category>] followed by sections of [header=<section>] + words.  Section and category
+    pseudo-tokens are appended to the end of the vocabulary (section_start_vocab_id and category_start_vocab_id).
+    """
+    rng = np.random.RandomState(seed)
+    word_p = zipf_probs(vocab_size - 1)
+    section_start_id = vocab_size
+    category_start_id = vocab_size + num_sections
+
+    chunks = []
+    total_len = 0
+    while total_len < num_tokens:
+        chunks.append([category_start_id + rng.randint(num_categories)])
+        for _ in range(max(1, rng.poisson(mean_doc_sections))):
+            section_len = rng.poisson(mean_section_len) + 1
+            chunks.append([section_start_id + rng.randint(num_sections)])
+            chunks.append(rng.choice(vocab_size - 1, size=section_len, p=word_p) + 1)
+            total_len += section_len + 1
+        total_len += 1
+    ids = np.concatenate(chunks).astype(int)
+
+    support = np.bincount(ids, minlength=category_start_id + num_categories)
+    vocab = Vocab()
+    for id in range(1, vocab_size):
+        vocab.add_token('w{}'.format(id), token_support=support[id])
+    vocab.section_start_vocab_id = vocab.size()
+    for sec in range(num_sections):
+        vocab.add_token('header=SECTION{}'.format(sec), token_support=support[section_start_id + sec])
+    vocab.category_start_vocab_id = vocab.size()
+    for cat in range(num_categories):
+        vocab.add_token('document=CATEGORY{}'.format(cat), token_support=support[category_start_id + cat])
+    assert vocab.section_start_vocab_id == section_start_id and vocab.category_start_vocab_id == category_start_id
+    return ids, vocab
+
+
+def prepare_bsg_data(ids, vocab):
+    """
+    :return: ids (with metadata positions set to -1), section ids, category ids, and metadata positions as computed in
+    bsg_main.py
+    """
+    ids = ids.copy()
+    sec_id_range = np.arange(vocab.section_start_vocab_id, vocab.category_start_vocab_id)
+    cat_id_range = np.arange(vocab.category_start_vocab_id, vocab.size())
+    sec_pos_idxs = np.where(np.isin(ids, sec_id_range))[0]
+    cat_pos_idxs = np.where(np.isin(ids, cat_id_range))[0]
+    sec_ids, cat_ids = enumerate_metadata_ids_multi_bsg(ids, sec_pos_idxs, cat_pos_idxs)
+    all_metadata_pos_idxs = np.concatenate([sec_pos_idxs, cat_pos_idxs])
+    ids[all_metadata_pos_idxs] = -1
+    return ids, sec_ids, cat_ids, all_metadata_pos_idxs
+
+
+def synthetic_wp_conversions(token_vocab_size, metadata_vocab_size, seed=1992):
+    """
+    :return: stand-in for lmc_prebatch.create_tokenizer_maps which does not require the pre-trained BertTokenizer.
+    Every unigram maps to 1-3 WordPieces and every metadata type to a single (special) WordPiece.
+    """
+    rng = np.random.RandomState(seed)
+    special_to_wp = {'[PAD]': 0, '[CLS]': 1, '[SEP]': 2, '[UNK]': 3, '[MASK]': 4}
+    wp_vocab_size = 30000
+    token_to_wp = [rng.randint(len(special_to_wp), wp_vocab_size, size=rng.randint(1, 4)).tolist()
+                   for _ in range(token_vocab_size)]
+    meta_to_wp = [[wp_vocab_size + id] for id in range(metadata_vocab_size)]
+    return {'token_to_wp': token_to_wp, 'meta_to_wp': meta_to_wp, 'special_to_wp': special_to_wp}
+
+
+def rebatch(batches, batch_size):
+    """
+    :param batches: shuffled center word indices grouped into batches (of any size)
+    :param batch_size: new batch size
+    :return: the same center word indices grouped into batches of batch_size
+    """
+    flat = batches.reshape(-1)
+    num_batches = len(flat) // batch_size
+    return flat[:num_batches * batch_size].reshape(num_batches, batch_size)
+
+
+class BenchmarkData:
+    """
+    Synthetic corpus plus the data structures built by bsg_main.py and lmc_main.py from it.  Built once and shared by
+    every case and grid point.
+    """
+    def __init__(self, args):
+        print('Generating synthetic ids of length ~{} with vocabulary size={}...'.format(
+            args.num_tokens, args.vocab_size))
+        ids, vocab = build_synthetic_ids(num_tokens=args.num_tokens, vocab_size=args.vocab_size, seed=args.seed)
+        self.vocab = vocab
+        self.bsg_ids, self.sec_ids, self.cat_ids, self.bsg_metadata_pos_idxs = prepare_bsg_data(ids, vocab)
+
+        lmc_args = Namespace(metadata='section', metadata_samples=args.metadata_samples, bert=False,
+                             batch_size=max(args.batch_sizes), window=max(args.windows))
+        self.lmc_kwargs = _prepare_data(lmc_args, deepcopy(vocab), ids.copy())
+        self.lmc_kwargs['wp_conversions'] = synthetic_wp_conversions(
+            self.lmc_kwargs['token_vocab'].size(), self.lmc_kwargs['metadata_vocab'].size(), seed=args.seed)
+        self.lmc_batches = self.lmc_kwargs['batches']
+        # Compute and cache the BSG negative sampling distribution outside of timing (after the LMC vocabulary is copied
+        # since lmc_main.py truncates metadata from the vocabulary before computing its own)
+        self.vocab.neg_sample(size=(1,))
+
+    def bsg_batcher(self, batch_size):
+        return BSGBatchLoader(len(self.bsg_ids), self.bsg_metadata_pos_idxs, batch_size=batch_size)
+
+    def bsg_batch(self, batch_size, window):
+        batcher = self.bsg_batcher(batch_size)
+        return batcher.next(self.bsg_ids, self.sec_ids, self.cat_ids, self.vocab, window)
+
+    def lmc_dataset(self, batch_size, window, bert=False):
+        kwargs = dict(self.lmc_kwargs)
+        kwargs.update({'batches': rebatch(self.lmc_batches, batch_size), 'window_size': window, 'bert': bert})
+        return DistributedDataset(**kwargs)
+
+
+def bench_bsg_batcher(data, batch_size, window, device):
+    batcher = data.bsg_batcher(batch_size)
+
+    def run():
+        batcher.batch_ct %= batcher.num_batches()
+        batcher.next(data.bsg_ids, data.sec_ids, data.cat_ids, data.vocab, window)
+    return run
+
+
+def bench_lmc_batcher(data, batch_size, window, device):
+    dataset = data.lmc_dataset(batch_size, window)
+    state = {'batch_ct': 0}
+
+    def run():
+        dataset.get_batch(state['batch_ct'] % len(dataset))
+        state['batch_ct'] += 1
+    return run
+
+
+def bench_lmc_bert_batcher(data, batch_size, window, device):
+    dataset = data.lmc_dataset(batch_size, window, bert=True)
+    state = {'batch_ct': 0}
+
+    def run():
+        dataset.get_bert_batch(state['batch_ct'] % len(dataset))
+        state['batch_ct'] += 1
+    return run
+
+
+def _kl_inputs(batch_size, window, var_dim, device):
+    # Same shapes as the flattened center-context pairs in BSG._max_margin
+    rows = batch_size * window * 2
+    mu_a, mu_b = torch.randn(rows, LATENT_DIM).to(device), torch.randn(rows, LATENT_DIM).to(device)
+    sigma_a, sigma_b = (torch.rand(rows, var_dim) + 0.1).to(device), (torch.rand(rows, var_dim) + 0.1).to(device)
+    return mu_a, sigma_a, mu_b, sigma_b
+
+
+def bench_kl_spherical(data, batch_size, window, device):
+    mu_a, sigma_a, mu_b, sigma_b = _kl_inputs(batch_size, window, 1, device)
+    return lambda: compute_kl(mu_a, sigma_a, mu_b, sigma_b, device=device)
+
+
+def bench_kl_diagonal(data, batch_size, window, device):
+    mu_a, sigma_a, mu_b, sigma_b = _kl_inputs(batch_size, window, LATENT_DIM, device)
+    return lambda: compute_kl(mu_a, sigma_a, mu_b, sigma_b, device=device)
+
+
+def _bsg_encoder_inputs(data, batch_size, window, device):
+    center_ids, _, _, context_ids, _, window_sizes = data.bsg_batch(batch_size, window)
+    center_ids = torch.LongTensor(center_ids).to(device)
+    context_ids = torch.LongTensor(context_ids).to(device)
+    mask = mask_2D(context_ids.size(), window_sizes).to(device)
+    encoder = BSGEncoder(data.vocab.size()).to(device)
+    encoder.train()
+    return encoder, center_ids, context_ids, mask
+
+
+def bench_bsg_encoder_forward(data, batch_size, window, device):
+    encoder, center_ids, context_ids, mask = _bsg_encoder_inputs(data, batch_size, window, device)
+    return lambda: encoder(center_ids, context_ids, mask.clone())  # The encoder masks context tokens in place
+
+
+def bench_bsg_encoder_backward(data, batch_size, window, device):
+    encoder, center_ids, context_ids, mask = _bsg_encoder_inputs(data, batch_size, window, device)
+
+    def run():
+        encoder.zero_grad()
+        mu, sigma = encoder(center_ids, context_ids, mask.clone())
+        (mu.sum() + sigma.sum()).backward()
+    return run
+
+
+def _lmc_batch(data, batch_size, window, device):
+    batch = data.lmc_dataset(batch_size, window).get_batch(0)
+    window_sizes = batch[-1]
+    return [t.to(device) for t in batch[:-1]] + [window_sizes]
+
+
+def _lmc_encoder_inputs(data, batch_size, window, device):
+    center_ids, center_metadata_ids, context_ids, _, _, _, window_sizes = _lmc_batch(data, batch_size, window, device)
+    mask = mask_2D(context_ids.size(), window_sizes).to(device)
+    encoder = LMCEncoder(data.lmc_kwargs['token_vocab_size'], data.lmc_kwargs['metadata_vocab'].size()).to(device)
+    encoder.train()
+    return encoder, center_ids, center_metadata_ids, context_ids, mask
+
+
+def bench_lmc_encoder_forward(data, batch_size, window, device):
+    encoder, center_ids, center_metadata_ids, context_ids, mask = _lmc_encoder_inputs(
+        data, batch_size, window, device)
+    return lambda: encoder(center_ids, center_metadata_ids, context_ids, mask.clone())
+
+
+def bench_lmc_encoder_backward(data, batch_size, window, device):
+    encoder, center_ids, center_metadata_ids, context_ids, mask = _lmc_encoder_inputs(
+        data, batch_size, window, device)
+
+    def run():
+        encoder.zero_grad()
+        mu, sigma, _ = encoder(center_ids, center_metadata_ids, context_ids, mask.clone())
+        (mu.sum() + sigma.sum()).backward()
+    return run
+
+
+def bench_lmc_decoder_forward(data, batch_size, window, device):
+    # Marginal decoding of every context word paired with its Monte Carlo metadata samples (LMC._compute_marginal)
+    _, _, context_ids, context_metadata_ids, _, _, _ = _lmc_batch(data, batch_size, window, device)
+    context_ids_tiled = context_ids.unsqueeze(-1).repeat(1, 1, context_metadata_ids.size()[-1])
+    decoder = LMCDecoder(data.lmc_kwargs['token_vocab_size'], data.lmc_kwargs['metadata_vocab'].size()).to(device)
+    decoder.train()
+    return lambda: decoder(context_ids_tiled, context_metadata_ids)
+
+
+def bench_mask_2D(data, batch_size, window, device):
+    window_sizes = data.bsg_batch(batch_size, window)[-1]
+    target_size = torch.Size([batch_size, window * 2])
+    return lambda: mask_2D(target_size, window_sizes)
+
+
+# Name --> (builder, whether the case runs on args.device or always on CPU)
+CASES = OrderedDict([
+    ('bsg_batcher', (bench_bsg_batcher, False)),
+    ('lmc_batcher', (bench_lmc_batcher, False)),
+    ('lmc_bert_batcher', (bench_lmc_bert_batcher, False)),
+    ('kl_spherical', (bench_kl_spherical, True)),
+    ('kl_diagonal', (bench_kl_diagonal, True)),
+    ('bsg_encoder_forward', (bench_bsg_encoder_forward, True)),
+    ('bsg_encoder_backward', (bench_bsg_encoder_backward, True)),
+    ('lmc_encoder_forward', (bench_lmc_encoder_forward, True)),
+    ('lmc_encoder_backward', (bench_lmc_encoder_backward, True)),
+    ('lmc_decoder_forward', (bench_lmc_decoder_forward, True)),
+    ('mask_2D', (bench_mask_2D, False)),
+])
+
+
+def run_benchmarks(args):
+    """
+    :param args: argparse instance (see run subcommand)
+    :return: OrderedDict of '<case>[b=<batch_size>,w=<window>]' --> summary statistics
+    """
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+    data = BenchmarkData(args)
+    results = OrderedDict()
+    for case in args.cases:
+        builder, on_device = CASES[case]
+        case_device = device if on_device else torch.device('cpu')
+        for batch_size in args.batch_sizes:
+            for window in args.windows:
+                name = '{}[b={},w={}]'.format(case, batch_size, window)
+                if case == 'kl_diagonal':
+                    # kl_diag materializes two batch_size * 2 * window x dim x dim covariance matrices
+                    covar_mb = 2 * batch_size * window * 2 * LATENT_DIM * LATENT_DIM * 4 / float(1 << 20)
+                    if covar_mb > args.max_kl_diag_mb:
+                        print('Skipping {}: covariance matrices need {} MB (> --max_kl_diag_mb)'.format(
+                            name, round(covar_mb)))
+                        continue
+                run_fn = builder(data, batch_size, window, case_device)
+                results[name] = time_case(run_fn, warmup=args.warmup, repeats=args.repeats, device=case_device)
+                print('{}: median={}ms, p95={}ms'.format(name, results[name]['median_ms'], results[name]['p95_ms']))
+    return results
+
+
+def _parse_int_list(value):
+    return [int(x) for x in value.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Microbenchmarks for batch construction, KL kernels, encoders and decoders.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    run_parser = subparsers.add_parser('run', help='Run benchmarks on a synthetic corpus and save results as json.')
+    run_parser.add_argument('--cases', default=','.join(CASES.keys()), help='Comma-separated subset of {}'.format(
+        ', '.join(CASES.keys())))
+    run_parser.add_argument('--batch_sizes', default='128,1024', type=_parse_int_list)
+    run_parser.add_argument('--windows', default='5,10', type=_parse_int_list)
+    run_parser.add_argument('--warmup', default=3, type=int)
+    run_parser.add_argument('--repeats', default=20, type=int)
+    run_parser.add_argument('--num_tokens', default=500000, type=int, help='Length of synthetic ids array.')
+    run_parser.add_argument('--vocab_size', default=20000, type=int)
+    run_parser.add_argument('--metadata_samples', default=3, type=int)
+    run_parser.add_argument('--max_kl_diag_mb', default=2048, type=int,
+                            help='Skip diagonal KL grid points whose covariance matrices exceed this size.')
+    run_parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    run_parser.add_argument('--num_threads', default=None, type=int, help='torch.set_num_threads (for CPU runs).')
+    run_parser.add_argument('--seed', default=1992, type=int)
+    run_parser.add_argument('--out_fp', default=None, help='Defaults to benchmarks/results/microbenchmarks_<time>.json')
+    run_parser.add_argument('--baseline', default=None, help='Optionally compare against this results file.')
+    run_parser.add_argument('--threshold', default=0.1, type=float)
+
+    compare_parser = subparsers.add_parser('compare', help='Flag regressions of a results file against a baseline.')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', default=0.1, type=float,
+                                help='Relative slowdown beyond which a case is flagged (0.1 = 10%%).')
+    compare_parser.add_argument('--metric', default='median_ms', choices=METRICS)
+
+    args = parser.parse_args()
+    if args.command is None:
+        parser.error('Please specify a command: run or compare')
+
+    if args.command == 'compare':
+        regressions = compare_results(
+            load_results(args.baseline), load_results(args.current), threshold=args.threshold, metric=args.metric)
+        sys.exit(1 if len(regressions) > 0 else 0)
+
+    args.cases = args.cases.split(',')
+    for case in args.cases:
+        if case not in CASES:
+            parser.error('Unknown case={}.  Choose from {}'.format(case, ', '.join(CASES.keys())))
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    if args.out_fp is None:
+        args.out_fp = os.path.join(home_dir, 'benchmarks', 'results', 'microbenchmarks_{}.json'.format(
+            datetime.now().strftime('%Y%m%d_%H%M%S')))
+    render_args(args)
+
+    results = run_benchmarks(args)
+    save_results(results, args.out_fp, args=args, device=args.device)
+    if args.baseline is not None:
+        regressions = compare_results(load_results(args.baseline), load_results(args.out_fp), threshold=args.threshold)
+        sys.exit(1 if len(regressions) > 0 else 0)
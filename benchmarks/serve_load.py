@@ -0,0 +1,170 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import json
+import os
+import sys
+from threading import Lock
+from time import time
+from urllib.request import Request, urlopen
+
+import argparse
+import numpy as np
+import pandas as pd
+
+home_dir = os.path.expanduser('~/LMC/')
+sys.path.insert(0, os.path.join(home_dir, 'benchmarks'))
+sys.path.insert(0, os.path.join(home_dir, 'preprocess'))
+sys.path.insert(0, os.path.join(home_dir, 'utils'))
+from bench_utils import compare_results, load_results, save_results, summarize_times
+from model_utils import render_args
+from synthetic_corpus import generate_noteevents
+
+
+def load_casi_requests(examples_per_request=1, window=10):
+    """
+    :param examples_per_request: number of (SF, context, section) examples in each request
+    :param window: context window with which CASI was preprocessed
+    :return: list of request bodies built from the raw CASI contexts
+    """
+    data_fp = os.path.join(home_dir, 'shared_data', 'casi', 'preprocessed_dataset_window_{}.csv'.format(window))
+    if not os.path.exists(data_fp):
+        raise Exception('Please preprocess CASI first (see acronyms/acronym_utils.py::preprocess_casi_dataset)')
+    df = pd.read_csv(data_fp)
+    examples = []
+    for row in df[['sf', 'context', 'section']].to_dict('records'):
+        examples.append({
+            'sf': row['sf'],
+            'context': row['context'],
+            'section': None if type(row['section']) == float else row['section']
+        })
+    if examples_per_request == 1:
+        return examples
+    return [{'examples': examples[start_idx:start_idx + examples_per_request]}
+            for start_idx in range(0, len(examples), examples_per_request)]
+
+
+def generate_note_requests(num_notes, sfs, mentions_per_note=5, mean_doc_tokens=200, seed=1992):
+    """
+    :param num_notes: number of raw notes to generate
+    :param sfs: SFs to inject into the notes
+    :param mentions_per_note: number of SF mentions inserted at random word boundaries of each note
+    :param mean_doc_tokens: average length of each synthetic note
+    :return: list of {'text': note} request bodies
+
+    Notes come from the synthetic NOTEEVENTS generator so they contain section headers, de-identification patterns and
+    digits in the same format as MIMIC-III.
+    """
+    rng = np.random.RandomState(seed)
+    texts = generate_noteevents(num_notes, vocab_size=5000, mean_doc_tokens=mean_doc_tokens, seed=seed)['TEXT']
+    requests = []
+    for text in texts.tolist():
+        words = text.split(' ')
+        for _ in range(mentions_per_note):
+            words.insert(rng.randint(len(words) + 1), sfs[rng.randint(len(sfs))])
+        requests.append({'text': ' '.join(words)})
+    return requests
+
+
+def post(url, body, timeout=60):
+    data = json.dumps(body).encode('utf-8')
+    request = Request(url, data=data, headers={'Content-Type': 'application/json'})
+    with urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def run_load(url, requests, concurrency, num_requests, warmup=5, seed=1992):
+    """
+    :param url: address of POST /expand
+    :param requests: request bodies to sample from (with replacement)
+    :param concurrency: number of client threads with one request in flight each
+    :param num_requests: number of timed requests
+    :param warmup: number of untimed requests (sent serially before timing starts)
+    :return: summary statistics of per-request latency along with requests/sec and expansions/sec
+    """
+    rng = np.random.RandomState(seed)
+    bodies = [requests[rng.randint(len(requests))] for _ in range(warmup + num_requests)]
+    for body in bodies[:warmup]:
+        post(url, body)
+
+    latencies, num_expansions, num_errors, lock = [], [0], [0], Lock()
+
+    def send(body):
+        start_time = time()
+        try:
+            response = post(url, body)
+        except Exception as e:
+            with lock:
+                num_errors[0] += 1
+            print('Request failed: {}'.format(e))
+            return
+        latency = (time() - start_time) * 1000.0
+        with lock:
+            latencies.append(latency)
+            num_expansions[0] += len(response['expansions'])
+
+    start_time = time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(send, bodies[warmup:]))
+    seconds = time() - start_time
+
+    if len(latencies) == 0:
+        raise Exception('Every request failed.  Is the server running at {}?'.format(url))
+    stats = summarize_times(latencies)
+    stats['concurrency'] = concurrency
+    stats['errors'] = num_errors[0]
+    stats['requests_per_sec'] = round(len(latencies) / seconds, 2)
+    stats['expansions_per_sec'] = round(num_expansions[0] / seconds, 2)
+    return stats
+
+
+def _parse_int_list(value):
+    return [int(x) for x in value.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Local load generator for acronyms/serve.py.')
+    parser.add_argument('--url', default='http://127.0.0.1:8008')
+    parser.add_argument('--requests', default='casi', help='casi ((SF, context, section) requests) or notes '
+                                                           '(raw synthetic notes)')
+    parser.add_argument('--examples_per_request', default=1, type=int, help='CASI examples batched per request.')
+    parser.add_argument('--num_notes', default=200, type=int)
+    parser.add_argument('--mentions_per_note', default=5, type=int)
+    parser.add_argument('--concurrency', default='1,4,16', type=_parse_int_list)
+    parser.add_argument('--num_requests', default=500, type=int, help='Timed requests per concurrency level.')
+    parser.add_argument('--warmup', default=5, type=int)
+    parser.add_argument('--seed', default=1992, type=int)
+    parser.add_argument('--out_fp', default=None, help='Defaults to benchmarks/results/serve_load_<time>.json')
+    parser.add_argument('--baseline', default=None, help='Optionally compare against this results file.')
+    parser.add_argument('--threshold', default=0.1, type=float)
+
+    args = parser.parse_args()
+    if args.out_fp is None:
+        args.out_fp = os.path.join(home_dir, 'benchmarks', 'results', 'serve_load_{}.json'.format(
+            datetime.now().strftime('%Y%m%d_%H%M%S')))
+    render_args(args)
+
+    print('Server status: {}'.format(urlopen(args.url + '/health').read().decode('utf-8')))
+    if args.requests == 'casi':
+        requests = load_casi_requests(examples_per_request=args.examples_per_request)
+    elif args.requests == 'notes':
+        with open(os.path.join(home_dir, 'shared_data', 'casi', 'sf_lf_map.json'), 'r') as fd:
+            sfs = sorted(json.load(fd).keys())
+        requests = generate_note_requests(
+            args.num_notes, sfs, mentions_per_note=args.mentions_per_note, seed=args.seed)
+    else:
+        raise Exception('Didn\'t recognize requests={}'.format(args.requests))
+    print('Replaying {} distinct {} requests'.format(len(requests), args.requests))
+
+    results = {}
+    for concurrency in args.concurrency:
+        name = 'serve_{}[e={},c={}]'.format(args.requests, args.examples_per_request, concurrency)
+        results[name] = run_load(args.url + '/expand', requests, concurrency, args.num_requests, warmup=args.warmup,
+                                 seed=args.seed)
+        print('{}: p50={}ms, p95={}ms, p99={}ms, requests/sec={}, expansions/sec={}'.format(
+            name, results[name]['median_ms'], results[name]['p95_ms'], results[name]['p99_ms'],
+            results[name]['requests_per_sec'], results[name]['expansions_per_sec']))
+
+    save_results(results, args.out_fp, args=args)
+    if args.baseline is not None:
+        regressions = compare_results(load_results(args.baseline), load_results(args.out_fp), threshold=args.threshold)
+        sys.exit(1 if len(regressions) > 0 else 0)
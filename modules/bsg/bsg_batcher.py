@@ -80,8 +80,10 @@ class BSGBatchLoader:
         self.batch_ct += 1
         return center_ids, sec_ids, cat_ids, context_ids, neg_ids, window_sizes
 
-    def reset(self):
+    def reset(self, seed=None):
         """
+        :param seed: Optional seed for the shuffle.  The same seed always yields the same batches which allows for an
+        epoch to be resumed from its batch cursor (self.batch_ct).
         :return: None
 
         Each index in ids of length N represents a training example (center word)
@@ -91,6 +93,7 @@ class BSGBatchLoader:
         batch_idxs = np.array(list(set(np.arange(self.N)) - set(self.metadata_idxs)))
         num_batches = len(batch_idxs) // self.batch_size
         truncated_N = self.batch_size * num_batches
-        np.random.shuffle(batch_idxs)
+        rng = np.random if seed is None else np.random.RandomState(seed)
+        rng.shuffle(batch_idxs)
         self.batch_ct = 0
         self.batches = batch_idxs[:truncated_N].reshape(num_batches, self.batch_size)
@@ -15,14 +15,15 @@ sys.path.insert(0, os.path.join(home_dir, 'acronyms'))
 sys.path.insert(0, os.path.join(home_dir, 'acronyms', 'modules'))
 sys.path.insert(0, os.path.join(home_dir, 'preprocess'))
 sys.path.insert(0, os.path.join(home_dir, 'utils'))
-from acronym_utils import load_mimic, load_casi, load_columbia
-from bsg_acronym_expander import BSGAcronymExpander
 from bsg_batcher import BSGBatchLoader
 from bsg_model import BSG
 from bsg_utils import restore_model, save_checkpoint
+from checkpoint_utils import AsyncCheckpointWriter, capture_rng_state, restore_rng_state
 from compute_sections import enumerate_metadata_ids_multi_bsg
-from evaluate import run_evaluation
-from model_utils import block_print, enable_print, get_git_revision_hash, render_args, render_num_params
+from eval_worker import EvaluationWorker
+from model_utils import get_git_revision_hash, render_args, render_num_params
+from profile_utils import add_profile_args, record_function, TrainingProfiler
+from telemetry_utils import TrainingTelemetry
 
 
 if __name__ == '__main__':
@@ -36,8 +37,18 @@ if __name__ == '__main__':
     parser.add_argument('--batch_size', default=1024, type=int)
     parser.add_argument('--epochs', default=5, type=int)
     parser.add_argument('--lr', default=0.001, type=float)
+    parser.add_argument('--seed', default=1992, type=int, help='Seeds RNGs and determines the shuffle for each epoch.')
     parser.add_argument('--window', default=10, type=int)
 
+    # Evaluation Arguments
+    parser.add_argument('--eval_device', default='cpu', help='Device on which the evaluation worker runs.')
+    parser.add_argument('--eval_threads', default=4, type=int, help='Number of CPU threads for evaluation worker.')
+    parser.add_argument('--telemetry_interval', default=1000, type=int, help=(
+        'Number of batches between throughput records written to telemetry.jsonl.  0 disables telemetry.'))
+    parser.add_argument('--telemetry_sample_interval', default=100, type=int, help=(
+        'On GPU, time the phases of one in every this many batches (timing requires synchronizing with the device).'))
+    add_profile_args(parser)
+
     # Model Hyperparameters
     parser.add_argument('--hidden_dim', default=64, type=int, help='hidden dimension for encoder')
     parser.add_argument('--input_dim', default=100, type=int, help='embedding dimemsions for encoder')
@@ -50,6 +61,8 @@ if __name__ == '__main__':
     args = parser.parse_args()
     args.git_hash = get_git_revision_hash()
     render_args(args)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
 
     # Load Data
     debug_str = '_mini' if args.debug else ''
@@ -101,13 +114,13 @@ if __name__ == '__main__':
     batcher = BSGBatchLoader(len(ids), all_metadata_pos_idxs, batch_size=args.batch_size)
 
     # Instantiate PyTorch BSG Model
+    resume_state = None
     if args.restore:
         print('Restoring from latest checkpoint...')
-        epoch_shift = 7  # TODO determine from checkpoints
-        _, model, _, optimizer_state = restore_model(args.experiment)
+        _, model, _, optimizer_state, resume_state = restore_model(args.experiment, with_resume_state=True)
+        print('Resuming training at epoch={}, batch={}'.format(resume_state['epoch'], resume_state['batch']))
         model = model.to(device_str)
     else:
-        epoch_shift = 0
         model = BSG(args, vocab.size()).to(device_str)
         optimizer_state = None
     render_num_params(model, vocab.size())
@@ -132,33 +145,64 @@ if __name__ == '__main__':
     metrics_file = open(os.path.join(weights_dir, 'metrics.csv'), mode='a')
     metrics_writer = csv.writer(metrics_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
     metrics_writer.writerow(metric_cols)
-    metrics_file.flush()
+    metrics_file.close()
+
+    # Acronym expansion is evaluated in a separate process on in-memory snapshots of the model weights
+    eval_args = argparse.Namespace(experiment=args.experiment, lm_type='bsg', device=args.eval_device,
+                                   batch_size=args.batch_size, num_threads=args.eval_threads)
+    evaluation_worker = EvaluationWorker(
+        eval_args, args, vocab, None, metric_cols, os.path.join(weights_dir, 'metrics.csv'))
+
+    # Checkpoints are serialized on a background thread so that training is not blocked on disk I/O
+    checkpoint_writer = AsyncCheckpointWriter()
+    telemetry = TrainingTelemetry(
+        weights_dir, interval=args.telemetry_interval, sample_interval=args.telemetry_sample_interval)
+    profiler = TrainingProfiler(args, weights_dir)
 
     start_time = time()
 
     # Make sure it's calculating gradients
     model.train()  # just sets .requires_grad = True
-    for epoch in range(1 + epoch_shift, args.epochs + epoch_shift + 1):
+    start_epoch = 1 if resume_state is None else resume_state['epoch']
+    for epoch in range(start_epoch, args.epochs + 1):
         sleep(0.1)  # Make sure logging is synchronous with tqdm progress bar
         print('Starting Epoch={}'.format(epoch))
-        batcher.reset()
-        num_batches = batcher.num_batches()
+        epoch_seed = args.seed + epoch
         epoch_joint_loss, epoch_kl_loss, epoch_recon_loss = 0.0, 0.0, 0.0
-        for i in tqdm(range(num_batches)):
+        start_batch = 0
+        if resume_state is not None and epoch == start_epoch:
+            # Continue from the exact batch (and random state) at which the checkpoint was written
+            epoch_seed = resume_state.get('epoch_seed', epoch_seed)
+            start_batch = resume_state['batch']
+            epoch_joint_loss, epoch_kl_loss, epoch_recon_loss = resume_state.get('epoch_losses', (0.0, 0.0, 0.0))
+            if 'rng' in resume_state:
+                restore_rng_state(resume_state['rng'])
+        batcher.reset(seed=epoch_seed)
+        batcher.batch_ct = start_batch
+        num_batches = batcher.num_batches()
+        telemetry.start_epoch(epoch)
+        for i in tqdm(range(start_batch, num_batches), initial=start_batch, total=num_batches):
             # Reset gradients
             optimizer.zero_grad()
 
-            batch_ids = batcher.next(ids, sec_ids, cat_ids, vocab, args.window)
+            with record_function('batch_building'):
+                batch_ids = batcher.next(ids, sec_ids, cat_ids, vocab, args.window)
+            num_tokens = args.batch_size + sum(batch_ids[-1])  # center words + context words (window_sizes)
+            telemetry.lap('batch_wait')
             batch_ids = list(map(lambda x: torch.LongTensor(x).to(device_str), batch_ids))
+            telemetry.lap('h2d')
 
             kl_loss, recon_loss = model(*batch_ids)
             joint_loss = kl_loss + recon_loss
+            telemetry.lap('forward')
             joint_loss.backward()  # backpropagate loss
+            telemetry.lap('backward')
 
             epoch_kl_loss += kl_loss.item()
             epoch_recon_loss += recon_loss.item()
             epoch_joint_loss += joint_loss.item()
             optimizer.step()
+            telemetry.lap('step')
 
             checkpoint_interval = 10000
             if (i + 1) % checkpoint_interval == 0:
@@ -173,32 +217,26 @@ if __name__ == '__main__':
                                }
                 print(losses_dict)
                 checkpoint_fp = os.path.join(weights_dir, 'checkpoint_{}.pth'.format(epoch))
-                save_checkpoint(args, model, optimizer, vocab, losses_dict, checkpoint_fp=checkpoint_fp)
-
-                experiments = [(load_casi, 'casi'), (load_mimic, 'mimic'), (load_columbia, 'columbia')]
-                for loader, dataset in experiments:
-                    args.lm_type = 'bsg'
-                    args.lm_experiment = args.experiment
-                    args.ckpt = None
-                    args.device = device_str
-                    prev_epoch_ct = args.epochs
-                    args.epochs = 0
-                    block_print()
-                    metrics = run_evaluation(args, BSGAcronymExpander, loader, restore_model, train_frac=0)
-                    enable_print()
-                    args.epochs = prev_epoch_ct
-                    metrics['dataset'] = dataset
-                    metrics['hours'] = duration_in_hours
-                    metrics['examples'] = full_example_ct
-                    metrics['epoch'] = epoch
-                    metrics['lm_recon'] = losses_dict['losses']['recon']
-                    metrics['lm_kl'] = losses_dict['losses']['kl']
-                    row = [metrics[col] for col in metric_cols]
-                    metrics_writer.writerow(row)
-                    print(metric_cols)
-                    print(row)
-                    metrics_file.flush()
+                checkpoint_resume_state = {
+                    'epoch': epoch,
+                    'batch': i + 1,
+                    'epoch_seed': epoch_seed,
+                    'epoch_losses': (epoch_joint_loss, epoch_kl_loss, epoch_recon_loss),
+                    'rng': capture_rng_state()
+                }
+                save_checkpoint(args, model, optimizer, vocab, losses_dict, checkpoint_fp=checkpoint_fp,
+                                checkpoint_writer=checkpoint_writer, resume_state=checkpoint_resume_state)
+                evaluation_worker.submit(model, {
+                    'epoch': epoch,
+                    'examples': full_example_ct,
+                    'hours': duration_in_hours,
+                    'lm_kl': losses_dict['losses']['kl'],
+                    'lm_recon': losses_dict['losses']['recon']
+                })
+            telemetry.end_batch(i, args.batch_size, num_tokens)
+            profiler.step()
 
+        telemetry.end_epoch(num_batches)
         epoch_joint_loss /= float(batcher.num_batches())
         epoch_kl_loss /= float(batcher.num_batches())
         epoch_recon_loss /= float(batcher.num_batches())
@@ -210,5 +248,9 @@ if __name__ == '__main__':
         # Serializing everything from model weights and optimizer state, to to loss function and arguments
         losses_dict = {'losses': {'joint': epoch_joint_loss, 'kl': epoch_kl_loss, 'recon': epoch_recon_loss}}
         checkpoint_fp = os.path.join(weights_dir, 'checkpoint_{}.pth'.format(epoch))
-        save_checkpoint(args, model, optimizer, vocab, losses_dict, checkpoint_fp=checkpoint_fp)
-    metrics_file.close()
+        checkpoint_resume_state = {'epoch': epoch + 1, 'batch': 0, 'rng': capture_rng_state()}
+        save_checkpoint(args, model, optimizer, vocab, losses_dict, checkpoint_fp=checkpoint_fp,
+                        checkpoint_writer=checkpoint_writer, resume_state=checkpoint_resume_state)
+    profiler.close()
+    checkpoint_writer.close()
+    evaluation_worker.close()
@@ -9,6 +9,7 @@ home_dir = os.path.expanduser('~/LMC/')
 sys.path.insert(0, os.path.join(home_dir, 'utils'))
 from bsg_encoder import BSGEncoder
 from compute_utils import compute_kl, mask_2D
+from profile_utils import record_function
 
 
 class BSG(nn.Module):
@@ -104,12 +105,16 @@ class BSG(nn.Module):
             input_sample = torch.multinomial(self.input_weights, batch_size, replacement=True).to(self.device)
             center_ids = center_id_candidates.gather(0, input_sample.unsqueeze(0)).squeeze(0)
 
-        mu_q, sigma_q = self.encoder(center_ids, context_ids, mask, token_mask_p=self.mask_p)
-        mu_p, sigma_p = self._compute_priors(token_ids)
+        with record_function('encoder'):
+            mu_q, sigma_q = self.encoder(center_ids, context_ids, mask, token_mask_p=self.mask_p)
 
-        pos_mu_p, pos_sigma_p = self._compute_priors(context_ids)
-        neg_mu_p, neg_sigma_p = self._compute_priors(neg_context_ids)
+        with record_function('decoder'):
+            mu_p, sigma_p = self._compute_priors(token_ids)
+            pos_mu_p, pos_sigma_p = self._compute_priors(context_ids)
+            neg_mu_p, neg_sigma_p = self._compute_priors(neg_context_ids)
 
-        kl = compute_kl(mu_q, sigma_q, mu_p, sigma_p).mean()
-        max_margin = self._max_margin(mu_q, sigma_q, pos_mu_p, pos_sigma_p, neg_mu_p, neg_sigma_p, mask).mean()
+        with record_function('kl'):
+            kl = compute_kl(mu_q, sigma_q, mu_p, sigma_p).mean()
+        with record_function('hinge'):
+            max_margin = self._max_margin(mu_q, sigma_q, pos_mu_p, pos_sigma_p, neg_mu_p, neg_sigma_p, mask).mean()
         return kl, max_margin
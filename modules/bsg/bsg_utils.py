@@ -1,62 +1,98 @@
+from copy import deepcopy
 import os
 import sys
 
 import argparse
-import torch
 
 home_dir = os.path.expanduser('~/LMC/')
 sys.path.insert(0, os.path.join(home_dir, 'modules', 'bsg'))
+sys.path.insert(0, os.path.join(home_dir, 'utils'))
 from bsg_model import BSG
+from checkpoint_utils import (find_checkpoint, get_resume_state, load_checkpoint_state, load_inference_state,
+                              resolve_static_artifacts, save_checkpoint_state, save_static_artifacts)
 
 
-def restore_model(restore_name, ckpt=None):
+def _build_model(checkpoint_state, verbose=False):
+    """
+    :param checkpoint_state: checkpoint dictionary with static artifacts resolved (see resolve_static_artifacts)
+    :param verbose: print the training arguments
+    :return: args, BSG model with the checkpoint weights and vocab
+
+    The checkpoint state is not modified (it may be shared, see load_inference_state) so the arguments and vocabulary,
+    which acronym expanders add SF and LF tokens to, are copied.
+    """
+    args = argparse.ArgumentParser()
+    for k, v in deepcopy(checkpoint_state['args']).items():
+        if verbose:
+            print('{}={}'.format(k, v))
+        setattr(args, k, v)
+    vocab = deepcopy(checkpoint_state['vocab'])
+    vae_model = BSG(args, vocab.size())
+    vae_model.load_state_dict(checkpoint_state['model_state_dict'])
+    return args, vae_model, vocab
+
+
+def restore_model(restore_name, ckpt=None, with_resume_state=False):
     """
     :param restore_name: Directory name within ~/LMC/weights/bsg where model weights are serialized
+    :param with_resume_state: If True, also return the state needed to continue training from the exact batch at which
+    the checkpoint was written (see get_resume_state)
     :return: state of the previously trained model, including model weights, training arguments, and vocabularies used
     """
     checkpoint_dir = os.path.join(home_dir, 'weights', 'bsg', restore_name)
-    checkpoint_fns = os.listdir(checkpoint_dir)
-    checkpoint_fns = list(filter(lambda x: 'results' not in x and 'metrics' not in x, checkpoint_fns))
-    max_checkpoint_epoch, latest_checkpoint_idx = -1, -1
-    for cidx, checkpoint_fn in enumerate(checkpoint_fns):
-        checkpoint_epoch = int(checkpoint_fn.split('_')[-1].split('.')[0])
-        if ckpt is not None and checkpoint_epoch == int(ckpt):
-            latest_checkpoint_idx = cidx
-            break
-        if 'best' in checkpoint_fn and ckpt is None:  # Always select 'best' if it exists in weights directory
-            latest_checkpoint_idx = cidx
-            break
-        max_checkpoint_epoch = max(max_checkpoint_epoch, checkpoint_epoch)
-        if checkpoint_epoch == max_checkpoint_epoch:
-            latest_checkpoint_idx = cidx
-    latest_checkpoint_fn = os.path.join(checkpoint_dir, checkpoint_fns[latest_checkpoint_idx])
+    latest_checkpoint_fn, max_checkpoint_epoch = find_checkpoint(checkpoint_dir, ckpt=ckpt)
     print('Loading model from {}'.format(latest_checkpoint_fn))
-    if not torch.cuda.is_available():
-        checkpoint_state = torch.load(latest_checkpoint_fn, map_location=lambda storage, loc: storage)
-    else:
-        checkpoint_state = torch.load(latest_checkpoint_fn)
-    vocab = checkpoint_state['vocab']
+    checkpoint_state = load_checkpoint_state(latest_checkpoint_fn)
+    resolve_static_artifacts(checkpoint_dir, checkpoint_state)
     print('Previous checkpoint at epoch={}...'.format(max_checkpoint_epoch))
     for k, v in checkpoint_state['losses'].items():
         print('{}={}'.format(k, v))
-    args = argparse.ArgumentParser()
-    for k, v in checkpoint_state['args'].items():
-        print('{}={}'.format(k, v))
-        setattr(args, k, v)
-    vae_model = BSG(args, vocab.size())
-    vae_model.load_state_dict(checkpoint_state['model_state_dict'])
+    args, vae_model, vocab = _build_model(checkpoint_state, verbose=True)
     optimizer_state = checkpoint_state['optimizer_state_dict']
+    if with_resume_state:
+        return args, vae_model, vocab, optimizer_state, get_resume_state(latest_checkpoint_fn, checkpoint_state)
     return args, vae_model, vocab, optimizer_state
 
 
-def save_checkpoint(args, model, optimizer, token_vocab, losses_dict, checkpoint_fp=None, metadata_vocab=None):
+def restore_inference_model(restore_name, ckpt=None):
+    """
+    :param restore_name: Directory name within ~/LMC/weights/bsg where model weights are serialized
+    :param ckpt: Optional pre-specified epoch from which to restore checkpoint
+    :return: same as restore_model except that optimizer state is not loaded (None is returned in its place)
+
+    Fast restore path for evaluation and serving.  The checkpoint is read at most once per process (see
+    load_inference_state) and every call returns a fresh model and vocabulary which the caller is free to modify.
+    """
+    checkpoint_dir = os.path.join(home_dir, 'weights', 'bsg', restore_name)
+    checkpoint_fp, checkpoint_state = load_inference_state(checkpoint_dir, ckpt=ckpt)
+    print('Loading model for inference from {}'.format(checkpoint_fp))
+    args, vae_model, vocab = _build_model(checkpoint_state)
+    return args, vae_model, vocab, None
+
+
+def save_checkpoint(args, model, optimizer, token_vocab, losses_dict, checkpoint_fp=None, metadata_vocab=None,
+                    checkpoint_writer=None, resume_state=None):
+    """
+    :param checkpoint_writer: Optional AsyncCheckpointWriter.  If provided, serialization happens in the background.
+    Otherwise, the checkpoint is written synchronously.
+    :param resume_state: Optional dictionary with the epoch, batch cursor, shuffle seed and RNG states required to
+    resume training mid-epoch
+
+    The vocabulary is written once per experiment next to the checkpoints and only referenced by file name.
+    """
     # Serializing everything from model weights and optimizer state, to to loss function and arguments
     state_dict = {'model_state_dict': model.state_dict()}
     state_dict.update(losses_dict)
     state_dict.update({'optimizer_state_dict': optimizer.state_dict()})
     args_dict = {'args': {arg: getattr(args, arg) for arg in vars(args)}}
     state_dict.update(args_dict)
-    state_dict.update({'vocab': token_vocab})
+    artifacts = save_static_artifacts(os.path.dirname(checkpoint_fp), {'vocab': token_vocab})
+    state_dict.update({'artifacts': artifacts})
+    if resume_state is not None:
+        state_dict.update({'resume': resume_state})
     # Serialize model and statistics
     print('Saving model state to {}'.format(checkpoint_fp))
-    torch.save(state_dict, checkpoint_fp)
+    if checkpoint_writer is None:
+        save_checkpoint_state(state_dict, checkpoint_fp)
+    else:
+        checkpoint_writer.save(state_dict, checkpoint_fp)
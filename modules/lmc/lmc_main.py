@@ -19,14 +19,15 @@ sys.path.insert(0, os.path.join(home_dir, 'acronyms'))
 sys.path.insert(0, os.path.join(home_dir, 'acronyms/modules'))
 sys.path.insert(0, os.path.join(home_dir, 'preprocess'))
 sys.path.insert(0, os.path.join(home_dir, 'utils'))
-from acronym_utils import load_mimic, load_casi, load_columbia
+from checkpoint_utils import AsyncCheckpointWriter, capture_rng_state, restore_rng_state
 from compute_sections import enumerate_metadata_ids_lmc
-from evaluate import run_evaluation
-from lmc_acronym_expander import LMCAcronymExpander
+from eval_worker import EvaluationWorker
 from lmc_model import LMC, LMCBERT
-from lmc_prebatch import create_tokenizer_maps, DistributedDataset, generate_metadata_samples
+from lmc_prebatch import create_tokenizer_maps, DistributedDataset, generate_metadata_samples, ResumableSampler
 from lmc_utils import restore_model, save_checkpoint
-from model_utils import block_print, enable_print, get_git_revision_hash, render_args, render_num_params
+from model_utils import get_git_revision_hash, render_args, render_num_params
+from profile_utils import add_profile_args, TrainingProfiler
+from telemetry_utils import TrainingTelemetry
 from vocab import Vocab
 
 
@@ -121,6 +122,17 @@ if __name__ == '__main__':
     parser.add_argument('--epochs', default=5, type=int)
     parser.add_argument('--lr', default=0.001, type=float)
     parser.add_argument('--num_gpu', default=1, type=int)
+    parser.add_argument('--num_workers', default=4, type=int, help='DataLoader workers.')
+    parser.add_argument('--seed', default=1992, type=int, help='Seeds RNGs and determines the shuffle for each epoch.')
+
+    # Evaluation Arguments
+    parser.add_argument('--eval_device', default='cpu', help='Device on which the evaluation worker runs.')
+    parser.add_argument('--eval_threads', default=4, type=int, help='Number of CPU threads for evaluation worker.')
+    parser.add_argument('--telemetry_interval', default=1000, type=int, help=(
+        'Number of batches between throughput records written to telemetry.jsonl.  0 disables telemetry.'))
+    parser.add_argument('--telemetry_sample_interval', default=100, type=int, help=(
+        'On GPU, time the phases of one in every this many batches (timing requires synchronizing with the device).'))
+    add_profile_args(parser)
 
     # Model Hyperparameters
     parser.add_argument('-bert', default=False, action='store_true')
@@ -136,6 +148,9 @@ if __name__ == '__main__':
     if args.debug:  # Mini dataset may have fewer than 200 examples
         args.batch_size = 200
     render_args(args)
+    # Seeding makes data preparation (batches and metadata samples) reproducible when restoring from a checkpoint
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
 
     # Load Data
     debug_str = '_mini' if args.debug else ''
@@ -165,15 +180,16 @@ if __name__ == '__main__':
 
     kwargs = _prepare_data(args, token_vocab, ids)
     dataset = DistributedDataset(**kwargs)
-    data_loader = DataLoader(dataset, batch_size=1, shuffle=True, num_workers=4)
+    sampler = ResumableSampler(len(dataset))
+    data_loader = DataLoader(dataset, batch_size=1, sampler=sampler, num_workers=args.num_workers)
 
     # Instantiate PyTorch LMC Model
+    resume_state = None
     if args.restore:
         print('Restoring from latest checkpoint...')
-        epoch_shift = 5  # TODO determine from checkpoints
-        _, model, _, _, _, optimizer_state, _ = restore_model(args.experiment)
+        _, model, _, _, _, optimizer_state, _, resume_state = restore_model(args.experiment, with_resume_state=True)
+        print('Resuming training at epoch={}, batch={}'.format(resume_state['epoch'], resume_state['batch']))
     else:
-        epoch_shift = 0
         model = model_prototype(  # Either LMC or LMCBERT
             args, kwargs['token_vocab_size'], metadata_vocab_size=kwargs['metadata_vocab'].size())
         optimizer_state = None
@@ -205,34 +221,71 @@ if __name__ == '__main__':
     metrics_file = open(os.path.join(weights_dir, 'metrics.csv'), mode='a')
     metrics_writer = csv.writer(metrics_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
     metrics_writer.writerow(metric_cols)
-    metrics_file.flush()
+    metrics_file.close()
+
+    # Acronym expansion is evaluated in a separate process on in-memory snapshots of the model weights
+    evaluation_worker = None
+    if not args.bert:  # Acronym expanders are only implemented for the standard LMC model
+        eval_args = argparse.Namespace(experiment=args.experiment, lm_type='lmc', device=args.eval_device,
+                                       batch_size=128, num_threads=args.eval_threads)
+        evaluation_worker = EvaluationWorker(eval_args, args, token_vocab, kwargs['metadata_vocab'], metric_cols,
+                                             os.path.join(weights_dir, 'metrics.csv'))
+
+    # Checkpoints are serialized on a background thread so that training is not blocked on disk I/O
+    checkpoint_writer = AsyncCheckpointWriter()
+    telemetry = TrainingTelemetry(
+        weights_dir, interval=args.telemetry_interval, sample_interval=args.telemetry_sample_interval)
+    profiler = TrainingProfiler(args, weights_dir)
+    window_sizes_idx = 5 if args.bert else -1  # Position of window_sizes within the batch tensors
 
     start_time = time()
 
     # Make sure it's calculating gradients
     model.train()  # just sets .requires_grad = True
-    for epoch in range(1 + epoch_shift, args.epochs + epoch_shift + 1):
+    start_epoch = 1 if resume_state is None else resume_state['epoch']
+    for epoch in range(start_epoch, args.epochs + 1):
         sleep(0.1)  # Make sure logging is synchronous with tqdm progress bar
         print('Starting Epoch={}'.format(epoch))
-        num_batches = len(data_loader)
+        epoch_seed = args.seed + epoch
         epoch_joint_loss, epoch_kl_loss, epoch_recon_loss = 0.0, 0.0, 0.0
-        for i, batch_ids in tqdm(enumerate(data_loader), total=num_batches):
+        start_batch = 0
+        if resume_state is not None and epoch == start_epoch:
+            # Continue from the exact batch (and random state) at which the checkpoint was written
+            epoch_seed = resume_state.get('epoch_seed', epoch_seed)
+            start_batch = resume_state['batch']
+            epoch_joint_loss, epoch_kl_loss, epoch_recon_loss = resume_state.get('epoch_losses', (0.0, 0.0, 0.0))
+            if 'rng' in resume_state:
+                restore_rng_state(resume_state['rng'])
+        # Batch contents are seeded by (epoch_seed, batch index) so workers rebuild the same batches on resume
+        dataset.set_epoch(epoch_seed)
+        sampler.set_epoch(epoch_seed, start_batch=start_batch)
+        num_batches = len(dataset)
+        data_iter = iter(data_loader)
+        telemetry.start_epoch(epoch, data_iter=data_iter)
+        for i, batch_ids in tqdm(enumerate(data_iter, start_batch), initial=start_batch, total=num_batches):
+            telemetry.lap('batch_wait')
+            num_examples = batch_ids[0].size(1)
+            num_tokens = num_examples + batch_ids[window_sizes_idx].sum().item()
             # Reset gradients
             optimizer.zero_grad()
             batch_ids = list(map(lambda x: x[0].to(args.device), batch_ids))
+            telemetry.lap('h2d')
             kl_loss, recon_loss = model(*batch_ids, num_metadata_samples=args.metadata_samples)
             if len(kl_loss.size()) > 0:
                 kl_loss = kl_loss.mean(0)
             if len(recon_loss.size()) > 0:
                 recon_loss = recon_loss.mean(0)
             joint_loss = kl_loss + recon_loss
+            telemetry.lap('forward')
             joint_loss.backward()  # backpropagate loss
+            telemetry.lap('backward')
             clip_grad_norm_(trainable_params, 1.0)
             optimizer.step()
 
             epoch_kl_loss += kl_loss.item()
             epoch_recon_loss += recon_loss.item()
             epoch_joint_loss += joint_loss.item()
+            telemetry.lap('step')
 
             checkpoint_interval = 10000
             if (i + 1) % checkpoint_interval == 0:
@@ -248,37 +301,30 @@ if __name__ == '__main__':
                 print(losses_dict)
                 checkpoint_fp = os.path.join(weights_dir, 'checkpoint_{}.pth'.format(epoch))
                 if epoch < 10:
+                    checkpoint_resume_state = {
+                        'epoch': epoch,
+                        'batch': i + 1,
+                        'epoch_seed': epoch_seed,
+                        'epoch_losses': (epoch_joint_loss, epoch_kl_loss, epoch_recon_loss),
+                        'rng': capture_rng_state()
+                    }
                     save_checkpoint(args, model, optimizer, token_vocab, losses_dict, kwargs['token_metadata_counts'],
-                                    checkpoint_fp=checkpoint_fp, metadata_vocab=kwargs['metadata_vocab'])
-
-                experiments = [(load_casi, 'casi'), (load_mimic, 'mimic'), (load_columbia, 'columbia')]
-                prev_epoch_ct = args.epochs
-                prev_batch_size = args.batch_size
-                for loader, dataset in experiments:
-                    args.lm_type = 'lmc'
-                    args.lm_experiment = args.experiment
-                    args.ckpt = None
-                    args.device = device_str
-                    args.epochs = 0
-                    args.dataset = dataset
-                    args.batch_size = 128
-                    block_print()
-                    metrics = run_evaluation(args, LMCAcronymExpander, loader, restore_model, train_frac=0)
-                    enable_print()
-                    metrics['dataset'] = dataset
-                    metrics['hours'] = duration_in_hours
-                    metrics['examples'] = full_example_ct
-                    metrics['epoch'] = epoch
-                    metrics['lm_recon'] = losses_dict['losses']['recon']
-                    metrics['lm_kl'] = losses_dict['losses']['kl']
-                    row = [metrics[col] for col in metric_cols]
-                    metrics_writer.writerow(row)
-                    print(metric_cols)
-                    print(row)
-                    metrics_file.flush()
-                args.batch_size = prev_batch_size
-                args.epochs = prev_epoch_ct
-
+                                    checkpoint_fp=checkpoint_fp, metadata_vocab=kwargs['metadata_vocab'],
+                                    bert_tokenizer=kwargs['bert_tokenizer'], checkpoint_writer=checkpoint_writer,
+                                    resume_state=checkpoint_resume_state)
+
+                if evaluation_worker is not None:
+                    evaluation_worker.submit(model, {
+                        'epoch': epoch,
+                        'examples': full_example_ct,
+                        'hours': duration_in_hours,
+                        'lm_kl': losses_dict['losses']['kl'],
+                        'lm_recon': losses_dict['losses']['recon']
+                    })
+            telemetry.end_batch(i, num_examples, num_tokens)
+            profiler.step()
+
+        telemetry.end_epoch(num_batches)
         epoch_joint_loss /= float(num_batches)
         epoch_kl_loss /= float(num_batches)
         epoch_recon_loss /= float(num_batches)
@@ -291,6 +337,16 @@ if __name__ == '__main__':
         losses_dict = {'losses': {'joint': epoch_joint_loss, 'kl': epoch_kl_loss, 'recon': epoch_recon_loss}}
         checkpoint_fp = os.path.join(weights_dir, 'checkpoint_{}.pth'.format(epoch))
         if epoch < 10:  # Epoch >= 10 usually only happens when debugging in which we case we don't want to keep saving
+            checkpoint_resume_state = {
+                'epoch': epoch + 1,
+                'batch': 0,
+                'rng': capture_rng_state()
+            }
             save_checkpoint(args, model, optimizer, token_vocab, losses_dict, kwargs['token_metadata_counts'],
-                            checkpoint_fp=checkpoint_fp, metadata_vocab=kwargs['metadata_vocab'])
-    metrics_file.close()
+                            checkpoint_fp=checkpoint_fp, metadata_vocab=kwargs['metadata_vocab'],
+                            bert_tokenizer=kwargs['bert_tokenizer'], checkpoint_writer=checkpoint_writer,
+                            resume_state=checkpoint_resume_state)
+    profiler.close()
+    checkpoint_writer.close()
+    if evaluation_worker is not None:
+        evaluation_worker.close()
@@ -9,6 +9,7 @@ sys.path.insert(0, os.path.join(home_dir, 'utils'))
 from compute_utils import compute_kl, mask_2D
 from lmc_decoder import LMCDecoder, LMCDecoderBERT
 from lmc_encoder import LMCEncoder, LMCEncoderBERT
+from profile_utils import record_function
 
 
 class LMCBERT(nn.Module):
@@ -46,8 +47,9 @@ class LMCBERT(nn.Module):
         mask = mask_2D(mask_size, num_contexts).to(device)
 
         # Compute center words
-        mu_center_q, sigma_center_q, _ = self.encoder(
-            input_ids=context_ids, attention_mask=context_mask, token_type_ids=context_token_type_ids)
+        with record_function('encoder'):
+            mu_center_q, sigma_center_q, _ = self.encoder(
+                input_ids=context_ids, attention_mask=context_mask, token_type_ids=context_token_type_ids)
         mu_center_tiled_q = mu_center_q.unsqueeze(1).repeat(1, num_context_ids, 1)
         sigma_center_tiled_q = sigma_center_q.unsqueeze(1).repeat(1, num_context_ids, 1)
         mu_center_flat_q = mu_center_tiled_q.view(batch_size * num_context_ids, -1)
@@ -67,8 +69,9 @@ class LMCBERT(nn.Module):
         decoder_type_ids[:batch_size, -center_sep_idx:] = 1
         decoder_type_ids[batch_size:, -other_sep_idx:] = 1
 
-        mu_joint, sigma_joint = self.decoder(
-            input_ids=joint_ids, attention_mask=joint_mask, token_type_ids=decoder_type_ids)
+        with record_function('decoder'):
+            mu_joint, sigma_joint = self.decoder(
+                input_ids=joint_ids, attention_mask=joint_mask, token_type_ids=decoder_type_ids)
 
         mu_center, sigma_center = mu_joint[:batch_size], sigma_joint[:batch_size]
         s = batch_size * (num_context_ids + 1)
@@ -76,16 +79,18 @@ class LMCBERT(nn.Module):
         mu_neg_flat, sigma_neg_flat = mu_joint[s:], sigma_joint[s:]
 
         # Compute KL-divergence between center words and negative and reshape
-        kl_pos_flat = compute_kl(mu_center_flat_q, sigma_center_flat_q, mu_pos_flat, sigma_pos_flat)
-        kl_neg_flat = compute_kl(mu_center_flat_q, sigma_center_flat_q, mu_neg_flat, sigma_neg_flat)
-        kl_pos = kl_pos_flat.view(batch_size, num_context_ids)
-        kl_neg = kl_neg_flat.view(batch_size, num_context_ids)
-
-        hinge_loss = (kl_pos - kl_neg + 1.0).clamp_min_(0)
-        hinge_loss.masked_fill_(mask, 0)
-        hinge_loss = hinge_loss.sum(1)
-
-        recon_loss = compute_kl(mu_center_q, sigma_center_q, mu_center, sigma_center).squeeze(-1)
+        with record_function('hinge'):
+            kl_pos_flat = compute_kl(mu_center_flat_q, sigma_center_flat_q, mu_pos_flat, sigma_pos_flat)
+            kl_neg_flat = compute_kl(mu_center_flat_q, sigma_center_flat_q, mu_neg_flat, sigma_neg_flat)
+            kl_pos = kl_pos_flat.view(batch_size, num_context_ids)
+            kl_neg = kl_neg_flat.view(batch_size, num_context_ids)
+
+            hinge_loss = (kl_pos - kl_neg + 1.0).clamp_min_(0)
+            hinge_loss.masked_fill_(mask, 0)
+            hinge_loss = hinge_loss.sum(1)
+
+        with record_function('kl'):
+            recon_loss = compute_kl(mu_center_q, sigma_center_q, mu_center, sigma_center).squeeze(-1)
         return hinge_loss.mean(), recon_loss.mean()
 
 
@@ -130,16 +135,18 @@ class LMC(nn.Module):
         assert m_samples == num_metadata_samples
 
         # Compute center words
-        mu_center_q, sigma_center_q, _ = self.encoder(center_ids, center_metadata_ids, context_ids, mask)
+        with record_function('encoder'):
+            mu_center_q, sigma_center_q, _ = self.encoder(center_ids, center_metadata_ids, context_ids, mask)
         mu_center_tiled_q = mu_center_q.unsqueeze(1).repeat(1, num_context_ids * m_samples, 1)
         sigma_center_tiled_q = sigma_center_q.unsqueeze(1).repeat(1, num_context_ids * m_samples, 1)
         mu_center_flat_q = mu_center_tiled_q.view(batch_size * num_context_ids * m_samples, -1)
         sigma_center_flat_q = sigma_center_tiled_q.view(batch_size * num_context_ids * m_samples, -1)
 
         # Compute decoded representations of (w, d), E(c), E(n)
-        mu_center, sigma_center = self.decoder(center_ids, center_metadata_ids)
-        mu_pos, sigma_pos = self._compute_marginal(context_ids, context_metadata_ids)
-        mu_neg, sigma_neg = self._compute_marginal(neg_ids, neg_metadata_ids)
+        with record_function('decoder'):
+            mu_center, sigma_center = self.decoder(center_ids, center_metadata_ids)
+            mu_pos, sigma_pos = self._compute_marginal(context_ids, context_metadata_ids)
+            mu_neg, sigma_neg = self._compute_marginal(neg_ids, neg_metadata_ids)
 
         # Flatten positive context
         mu_pos_flat = mu_pos.view(batch_size * num_context_ids * m_samples, -1)
@@ -150,14 +157,16 @@ class LMC(nn.Module):
         sigma_neg_flat = sigma_neg.view(batch_size * num_context_ids * m_samples, -1)
 
         # Compute KL-divergence between center words and negative and reshape
-        kl_pos_flat = compute_kl(mu_center_flat_q, sigma_center_flat_q, mu_pos_flat, sigma_pos_flat)
-        kl_neg_flat = compute_kl(mu_center_flat_q, sigma_center_flat_q, mu_neg_flat, sigma_neg_flat)
-        kl_pos = kl_pos_flat.view(batch_size, num_context_ids, m_samples).mean(-1)
-        kl_neg = kl_neg_flat.view(batch_size, num_context_ids, m_samples).mean(-1)
-
-        hinge_loss = (kl_pos - kl_neg + 1.0).clamp_min_(0)
-        hinge_loss.masked_fill_(mask, 0)
-        hinge_loss = hinge_loss.sum(1)
-
-        recon_loss = compute_kl(mu_center_q, sigma_center_q, mu_center, sigma_center).squeeze(-1)
+        with record_function('hinge'):
+            kl_pos_flat = compute_kl(mu_center_flat_q, sigma_center_flat_q, mu_pos_flat, sigma_pos_flat)
+            kl_neg_flat = compute_kl(mu_center_flat_q, sigma_center_flat_q, mu_neg_flat, sigma_neg_flat)
+            kl_pos = kl_pos_flat.view(batch_size, num_context_ids, m_samples).mean(-1)
+            kl_neg = kl_neg_flat.view(batch_size, num_context_ids, m_samples).mean(-1)
+
+            hinge_loss = (kl_pos - kl_neg + 1.0).clamp_min_(0)
+            hinge_loss.masked_fill_(mask, 0)
+            hinge_loss = hinge_loss.sum(1)
+
+        with record_function('kl'):
+            recon_loss = compute_kl(mu_center_q, sigma_center_q, mu_center, sigma_center).squeeze(-1)
         return hinge_loss.mean(), recon_loss.mean()
@@ -1,27 +1,30 @@
 import itertools
+import os
+import sys
 
 import numpy as np
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 from tqdm import tqdm
 
+home_dir = os.path.expanduser('~/LMC/')
+sys.path.insert(0, os.path.join(home_dir, 'utils'))
+from profile_utils import record_function
 
-def _get_metadata_id_sample(token_metadata_samples, token_id):
+
+def _get_metadata_id_sample(token_metadata_samples, token_id, u):
     """
     :param token_metadata_samples: dict for each token_id containing metadata samples drawn from p(metadata|token_id)
     :param token_id: key for token_metadata_samples
+    :param u: uniform random number in [0, 1) which selects one of the precomputed samples
     :return: a list of sampled metadata ids drawn from empirical distribution p(metadata|token)
 
     We precompute Monte Carlo samples to avoid having to do it online within the main training script.
     All random samples are pre-computed before training and the sampling procedure merely involves selecting
-    the next sample in token_metadata_samples[token_id].  This leads to a substantial speedup.
+    a sample in token_metadata_samples[token_id].  This leads to a substantial speedup.
     """
-    counter, sids = token_metadata_samples[token_id]
-    sid = sids[counter]
-    token_metadata_samples[token_id][0] += 1
-    if token_metadata_samples[token_id][0] >= len(sids):
-        token_metadata_samples[token_id] = [0, sids]
-    return sid
+    sids = token_metadata_samples[token_id]
+    return sids[int(u * len(sids))]
 
 
 class DistributedDataset(Dataset):
@@ -32,15 +35,37 @@ class DistributedDataset(Dataset):
 
     Kwargs contains the flattened ids file, vocabulary data structures necessary for converting tokens to ids,
     as well as empirical distributions / samples from p(metadata|token).
+
+    All randomness within a batch (negative samples and the choice of metadata samples) is drawn from a generator
+    seeded by the epoch seed and batch_ct.  Batches are therefore identical regardless of which DataLoader worker
+    builds them, which lets -restore resume an epoch exactly with num_workers > 0.
     """
     def __init__(self, **kwargs):
         self.kwargs = kwargs
+        self.epoch_seed = 0
 
     def __getitem__(self, batch_ct):
-        if self.kwargs['bert']:
-            return self.get_bert_batch(batch_ct)
-        else:
-            return self.get_batch(batch_ct)
+        with record_function('batch_building'):  # Only appears in profiler traces when --num_workers=0
+            if self.kwargs['bert']:
+                return self.get_bert_batch(batch_ct)
+            else:
+                return self.get_batch(batch_ct)
+
+    def _batch_rng(self, batch_ct):
+        """
+        :param batch_ct: index into kwargs['batches']
+        :return: RandomState which is a deterministic function of the epoch seed and batch_ct
+        """
+        return np.random.RandomState([self.epoch_seed, batch_ct])
+
+    def set_epoch(self, epoch_seed):
+        """
+        :param epoch_seed: seed for the epoch (same as the one passed to ResumableSampler.set_epoch)
+        :return: None
+
+        Must be called before iter(data_loader) so that the workers spawned for the epoch receive the new seed.
+        """
+        self.epoch_seed = epoch_seed
 
     def get_batch(self, batch_ct):
         """
@@ -57,11 +82,13 @@ class DistributedDataset(Dataset):
         batch_idxs = self.kwargs['batches'][batch_ct, :]
         batch_size = len(batch_idxs)
 
-        neg_ids = np.random.choice(np.arange(len(neg_sample_p)), size=(batch_size, 2 * window_size), p=neg_sample_p)
+        rng = self._batch_rng(batch_ct)
+        neg_ids = rng.choice(np.arange(len(neg_sample_p)), size=(batch_size, 2 * window_size), p=neg_sample_p)
+        sample_u = rng.random_sample(size=(batch_size, 2 * window_size, 2))
         center_ids = ids[batch_idxs]
         context_ids = np.zeros([batch_size, (window_size * 2)], dtype=int)
 
-        num_metadata = token_metadata_samples[1][1].shape[1]
+        num_metadata = token_metadata_samples[1].shape[1]
         center_metadata_ids = np.zeros([batch_size, ], dtype=int)
         context_metadata_ids = np.zeros([batch_size, (window_size * 2), num_metadata], dtype=int)
         neg_metadata_ids = np.zeros([batch_size, (window_size * 2), num_metadata], dtype=int)
@@ -74,8 +101,8 @@ class DistributedDataset(Dataset):
             window_sizes.append(len(example_context_ids))
             for idx, context_id in enumerate(example_context_ids):
                 n_id = neg_ids[batch_idx, idx]
-                c_sids = _get_metadata_id_sample(token_metadata_samples, context_id)
-                n_sids = _get_metadata_id_sample(token_metadata_samples, n_id)
+                c_sids = _get_metadata_id_sample(token_metadata_samples, context_id, sample_u[batch_idx, idx, 0])
+                n_sids = _get_metadata_id_sample(token_metadata_samples, n_id, sample_u[batch_idx, idx, 1])
                 context_metadata_ids[batch_idx, idx, :] = c_sids
                 neg_metadata_ids[batch_idx, idx, :] = n_sids
 
@@ -133,9 +160,11 @@ class DistributedDataset(Dataset):
         batch_size = len(batch_idxs)
         center_ids = ids[batch_idxs]
 
-        neg_ids = np.random.choice(np.arange(len(neg_sample_p)), size=(batch_size, 2 * window_size), p=neg_sample_p)
+        rng = self._batch_rng(batch_ct)
+        neg_ids = rng.choice(np.arange(len(neg_sample_p)), size=(batch_size, 2 * window_size), p=neg_sample_p)
+        sample_u = rng.random_sample(size=(batch_size, 2 * window_size, 2))
 
-        num_metadata = token_metadata_samples[1][1].shape[-1]
+        num_metadata = token_metadata_samples[1].shape[-1]
         max_single_len = num_metadata + 2 + 5  # 2 for special tokens, 5 for max # of wps for unigram
         max_encoder_len = int((window_size * 2 + 1) * 2.5) + 2  # max avg of 2.5 wps ids per unigram in context window
 
@@ -194,8 +223,8 @@ class DistributedDataset(Dataset):
                 n_id = neg_ids[batch_idx, idx]
                 n_wp_ids = token_to_wp[n_id]
 
-                p_sids = _get_metadata_id_sample(token_metadata_samples, context_id)
-                n_sids = _get_metadata_id_sample(token_metadata_samples, n_id)
+                p_sids = _get_metadata_id_sample(token_metadata_samples, context_id, sample_u[batch_idx, idx, 0])
+                n_sids = _get_metadata_id_sample(token_metadata_samples, n_id, sample_u[batch_idx, idx, 1])
 
                 p_wp_sids = list(map(lambda x: meta_to_wp[x][0], p_sids))
                 n_wp_sids = list(map(lambda x: meta_to_wp[x][0], n_sids))
@@ -224,6 +253,33 @@ class DistributedDataset(Dataset):
         return len(self.kwargs['batches'])
 
 
+class ResumableSampler(Sampler):
+    """
+    Shuffles batch indices with an explicit per-epoch seed so that an interrupted epoch can be resumed from the exact
+    batch at which it stopped.  Replaces shuffle=True in the DataLoader.
+    """
+    def __init__(self, num_batches):
+        self.num_batches = num_batches
+        self.epoch_seed = 0
+        self.start_batch = 0
+
+    def __iter__(self):
+        order = np.random.RandomState(self.epoch_seed).permutation(self.num_batches)
+        return iter(order[self.start_batch:].tolist())
+
+    def __len__(self):
+        return self.num_batches - self.start_batch
+
+    def set_epoch(self, epoch_seed, start_batch=0):
+        """
+        :param epoch_seed: seed which determines the order of batches for the epoch
+        :param start_batch: number of batches in the epoch already trained on (skipped)
+        :return: None
+        """
+        self.epoch_seed = epoch_seed
+        self.start_batch = start_batch
+
+
 def create_tokenizer_maps(bert_tokenizer, token_vocab, metadata_vocab):
     """
     :param bert_tokenizer: Pre-trained HuggingFace WordPiece tokenizer
@@ -301,7 +357,7 @@ def generate_metadata_samples(token_metadata_counts, metadata_vocab, sample=5):
 
     We precompute Monte Carlo samples to avoid having to do it online within the main training script.
     All random samples are pre-computed before training and the sampling procedure merely involves selecting
-    the next sample in token_metadata_samples[token_id].  This leads to a substantial speedup.
+    a sample in token_metadata_samples[token_id].  This leads to a substantial speedup.
     """
     token_metadata_samples = {}
     smooth_counts = np.zeros([metadata_vocab.size()])
@@ -313,6 +369,5 @@ def generate_metadata_samples(token_metadata_counts, metadata_vocab, sample=5):
         smooth_counts[sids] += sp
         smooth_p = smooth_counts / smooth_counts.sum()
         rand_sids = np.random.choice(all_metadata_ids, size=size, replace=True, p=smooth_p)
-        start_idx = 0
-        token_metadata_samples[k] = [start_idx, rand_sids]
+        token_metadata_samples[k] = rand_sids
     return token_metadata_samples
@@ -1,49 +1,31 @@
 from collections import OrderedDict
+from copy import deepcopy
 import os
 import sys
 
 import argparse
-import torch
 
 home_dir = os.path.expanduser('~/LMC/')
 sys.path.insert(0, os.path.join(home_dir, 'modules', 'lmc'))
+sys.path.insert(0, os.path.join(home_dir, 'utils'))
+from checkpoint_utils import (find_checkpoint, get_resume_state, load_checkpoint_state, load_inference_state,
+                              resolve_static_artifacts, save_checkpoint_state, save_static_artifacts)
 from lmc_model import LMC
 
 
-def restore_model(restore_name, ckpt=None):
+def _build_model(checkpoint_state, verbose=False):
     """
-    :param restore_name: Directory name within ~/LMC/weights/lmc where model weights are serialized
-    :param ckpt: Optional pre-specified epoch from which to restore checkpoint
-    :return: state of the previously trained model, including model weights, training arguments, and vocabularies used
+    :param checkpoint_state: checkpoint dictionary with static artifacts resolved (see resolve_static_artifacts)
+    :param verbose: print the training arguments
+    :return: args, LMC model with the checkpoint weights, token_vocab, metadata_vocab and bert_tokenizer
+
+    The checkpoint state is not modified (it may be shared, see load_inference_state) so the arguments and token
+    vocabulary, which acronym expanders add SF and LF tokens to, are copied.
     """
-    checkpoint_dir = os.path.join(home_dir, 'weights', 'lmc', restore_name)
-    checkpoint_fns = os.listdir(checkpoint_dir)
-    checkpoint_fns = list(filter(lambda x: 'results' not in x and 'metrics' not in x, checkpoint_fns))
-    max_checkpoint_epoch, latest_checkpoint_idx = -1, -1
-    for cidx, checkpoint_fn in enumerate(checkpoint_fns):
-        checkpoint_epoch = int(checkpoint_fn.split('_')[-1].split('.')[0])
-        if ckpt is not None and checkpoint_epoch == int(ckpt):
-            latest_checkpoint_idx = cidx
-            break
-        if 'best' in checkpoint_fn and ckpt is None:  # Always select 'best' if it exists in weights directory
-            latest_checkpoint_idx = cidx
-            break
-        max_checkpoint_epoch = max(max_checkpoint_epoch, checkpoint_epoch)
-        if checkpoint_epoch == max_checkpoint_epoch:
-            latest_checkpoint_idx = cidx
-    latest_checkpoint_fn = os.path.join(checkpoint_dir, checkpoint_fns[latest_checkpoint_idx])
-    print('Loading model from {}'.format(latest_checkpoint_fn))
-    if not torch.cuda.is_available():
-        checkpoint_state = torch.load(latest_checkpoint_fn, map_location=lambda storage, loc: storage)
-    else:
-        checkpoint_state = torch.load(latest_checkpoint_fn)
-    token_vocab, metadata_vocab = checkpoint_state['token_vocab'], checkpoint_state['metadata_vocab']
-    print('Previous checkpoint at epoch={}...'.format(max_checkpoint_epoch))
-    for k, v in checkpoint_state['losses'].items():
-        print('{}={}'.format(k, v))
     args = argparse.ArgumentParser()
-    for k, v in checkpoint_state['args'].items():
-        print('{}={}'.format(k, v))
+    for k, v in deepcopy(checkpoint_state['args']).items():
+        if verbose:
+            print('{}={}'.format(k, v))
         setattr(args, k, v)
     new_state_dict = OrderedDict()
     # When using nn.DataParallel(model) it prepends 'module.' to all parameter names in state dict.
@@ -54,6 +36,7 @@ def restore_model(restore_name, ckpt=None):
             name = k[7:]  # remove `module.`
         new_state_dict[name] = v
 
+    token_vocab, metadata_vocab = deepcopy(checkpoint_state['token_vocab']), checkpoint_state['metadata_vocab']
     token_vocab_size = token_vocab.size()
     bert_tokenizer = None
     if hasattr(args, 'bert') and args.bert:
@@ -62,23 +45,82 @@ def restore_model(restore_name, ckpt=None):
 
     lmc_model = LMC(args, token_vocab_size, metadata_vocab.size())
     lmc_model.load_state_dict(new_state_dict)
+    return args, lmc_model, token_vocab, metadata_vocab, bert_tokenizer
+
+
+def restore_model(restore_name, ckpt=None, with_resume_state=False):
+    """
+    :param restore_name: Directory name within ~/LMC/weights/lmc where model weights are serialized
+    :param ckpt: Optional pre-specified epoch from which to restore checkpoint
+    :param with_resume_state: If True, also return the state needed to continue training from the exact batch at which
+    the checkpoint was written (see get_resume_state)
+    :return: state of the previously trained model, including model weights, training arguments, and vocabularies used
+    """
+    checkpoint_dir = os.path.join(home_dir, 'weights', 'lmc', restore_name)
+    latest_checkpoint_fn, max_checkpoint_epoch = find_checkpoint(checkpoint_dir, ckpt=ckpt)
+    print('Loading model from {}'.format(latest_checkpoint_fn))
+    checkpoint_state = load_checkpoint_state(latest_checkpoint_fn)
+    resolve_static_artifacts(checkpoint_dir, checkpoint_state)
+    print('Previous checkpoint at epoch={}...'.format(max_checkpoint_epoch))
+    for k, v in checkpoint_state['losses'].items():
+        print('{}={}'.format(k, v))
+    args, lmc_model, token_vocab, metadata_vocab, bert_tokenizer = _build_model(checkpoint_state, verbose=True)
 
     optimizer_state = checkpoint_state['optimizer_state_dict']
     token_metadata_counts = checkpoint_state['token_metadata_counts']
+    if with_resume_state:
+        return (args, lmc_model, token_vocab, metadata_vocab, bert_tokenizer, optimizer_state, token_metadata_counts,
+                get_resume_state(latest_checkpoint_fn, checkpoint_state))
     return args, lmc_model, token_vocab, metadata_vocab, bert_tokenizer, optimizer_state, token_metadata_counts
 
 
+def restore_inference_model(restore_name, ckpt=None):
+    """
+    :param restore_name: Directory name within ~/LMC/weights/lmc where model weights are serialized
+    :param ckpt: Optional pre-specified epoch from which to restore checkpoint
+    :return: same as restore_model except that optimizer state is not loaded (None is returned in its place)
+
+    Fast restore path for evaluation and serving.  The checkpoint is read at most once per process (see
+    load_inference_state) and every call returns a fresh model and vocabularies which the caller is free to modify.
+    """
+    checkpoint_dir = os.path.join(home_dir, 'weights', 'lmc', restore_name)
+    checkpoint_fp, checkpoint_state = load_inference_state(checkpoint_dir, ckpt=ckpt)
+    print('Loading model for inference from {}'.format(checkpoint_fp))
+    args, lmc_model, token_vocab, metadata_vocab, bert_tokenizer = _build_model(checkpoint_state)
+    return (args, lmc_model, token_vocab, metadata_vocab, bert_tokenizer, None,
+            checkpoint_state['token_metadata_counts'])
+
+
 def save_checkpoint(args, model, optimizer, token_vocab, losses_dict, token_metadata_counts=None,
-                    checkpoint_fp=None, metadata_vocab=None, bert_tokenizer=None):
+                    checkpoint_fp=None, metadata_vocab=None, bert_tokenizer=None, checkpoint_writer=None,
+                    resume_state=None):
+    """
+    :param checkpoint_writer: Optional AsyncCheckpointWriter.  If provided, serialization happens in the background.
+    Otherwise, the checkpoint is written synchronously.
+    :param resume_state: Optional dictionary with the epoch, batch cursor, shuffle seed and RNG states required to
+    resume training mid-epoch
+
+    Vocabularies, metadata counts and the tokenizer are written once per experiment next to the checkpoints and only
+    referenced by file name.
+    """
     # Serializes everything from model weights and optimizer state, to loss function and arguments
-    state_dict = {'model_state_dict': model.state_dict(), 'token_metadata_counts': token_metadata_counts}
+    state_dict = {'model_state_dict': model.state_dict()}
     state_dict.update(losses_dict)
     state_dict.update({'optimizer_state_dict': optimizer.state_dict()})
     args_dict = {'args': {arg: getattr(args, arg) for arg in vars(args)}}
     state_dict.update(args_dict)
-    state_dict.update({'token_vocab': token_vocab})
-    state_dict.update({'metadata_vocab': metadata_vocab})
-    state_dict.update({'bert_tokenizer': bert_tokenizer})
+    artifacts = save_static_artifacts(os.path.dirname(checkpoint_fp), {
+        'token_vocab': token_vocab,
+        'metadata_vocab': metadata_vocab,
+        'bert_tokenizer': bert_tokenizer,
+        'token_metadata_counts': token_metadata_counts
+    })
+    state_dict.update({'artifacts': artifacts})
+    if resume_state is not None:
+        state_dict.update({'resume': resume_state})
     # Serialize model and statistics
     print('Saving model state to {}'.format(checkpoint_fp))
-    torch.save(state_dict, checkpoint_fp)
+    if checkpoint_writer is None:
+        save_checkpoint_state(state_dict, checkpoint_fp)
+    else:
+        checkpoint_writer.save(state_dict, checkpoint_fp)
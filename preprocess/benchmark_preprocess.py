@@ -0,0 +1,180 @@
+import json
+from multiprocessing import Pool
+import os
+import sys
+from threading import Event, Thread
+from time import time
+
+import argparse
+import pandas as pd
+
+home_dir = os.path.expanduser('~/LMC/')
+sys.path.insert(0, os.path.join(home_dir, 'preprocess'))
+sys.path.insert(0, os.path.join(home_dir, 'utils'))
+from compute_sections import count_section_headers, extract_headers
+import mimic_tokenize
+from model_utils import render_args
+from subsample_tokens import subsample_tokens
+from synthetic_corpus import generate_noteevents
+from telemetry_utils import get_peak_rss_mb
+from tokens_to_ids import convert_tokens_to_ids
+
+
+def _current_rss_mb():
+    """
+    :return: current resident set size (MB) of this process.  None if /proc is unavailable (i.e. macOS)
+    """
+    try:
+        with open('/proc/self/statm', 'r') as fd:
+            return int(fd.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / float(1 << 20)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class StageTimer:
+    """
+    Measures wall time and peak resident memory of a single preprocessing stage.
+
+    The peak RSS of the main process is sampled by a background thread since ru_maxrss cannot be reset between stages.
+    Pool workers are accounted for with ru_maxrss of (terminated) children, which is a running max across stages.
+    """
+    def __init__(self, name, sample_interval=0.05):
+        self.name = name
+        self.sample_interval = sample_interval
+        self.peak_rss = None
+        self.stop_event = Event()
+        self.thread = Thread(target=self._sample, daemon=True)
+        self.start_time = None
+        self.seconds = None
+
+    def _sample(self):
+        while True:
+            rss = _current_rss_mb()
+            if rss is not None:
+                self.peak_rss = rss if self.peak_rss is None else max(self.peak_rss, rss)
+            if self.stop_event.wait(self.sample_interval):
+                break
+
+    def __enter__(self):
+        self.start_time = time()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time() - self.start_time
+        self.stop_event.set()
+        self.thread.join()
+        return False
+
+    def result(self, num_docs, num_tokens=None, num_bytes=None):
+        """
+        :param num_docs: number of documents processed by the stage
+        :param num_tokens: Optional number of tokens processed by the stage
+        :param num_bytes: Optional number of raw text bytes processed by the stage
+        :return: dictionary of wall time, throughput and peak memory
+        """
+        seconds = max(self.seconds, 1e-8)
+        _, peak_children_rss = get_peak_rss_mb()
+        result = {
+            'stage': self.name,
+            'seconds': round(self.seconds, 3),
+            'docs_per_sec': round(num_docs / seconds, 2),
+            'tokens_per_sec': None if num_tokens is None else round(num_tokens / seconds, 2),
+            'mb_per_sec': None if num_bytes is None else round(num_bytes / float(1 << 20) / seconds, 3),
+            'peak_rss_mb': None if self.peak_rss is None else round(self.peak_rss, 1),
+            'peak_rss_workers_mb': peak_children_rss,
+        }
+        print('{stage}: {seconds}s.  docs/sec={docs_per_sec}, tokens/sec={tokens_per_sec}, MB/sec={mb_per_sec}.  '
+              'Peak RSS={peak_rss_mb} MB (workers={peak_rss_workers_mb} MB)'.format(**result))
+        return result
+
+
+def run_benchmark(df, num_workers=None, min_section_count=10, min_token_count=10, subsample_param=0.001,
+                  split_sentences=False):
+    """
+    :param df: DataFrame with the columns of MIMIC-III NOTEEVENTS.csv (at least CATEGORY and TEXT)
+    :param num_workers: processes for the stages which use a multiprocessing Pool (defaults to all CPUs)
+    :param min_section_count: compute_sections.py --min_count
+    :param min_token_count: subsample_tokens.py --min_token_count
+    :param subsample_param: subsample_tokens.py --subsample_param
+    :param split_sentences: mimic_tokenize.py -split_sentences
+    :return: list of per-stage results
+
+    Runs compute_sections -> mimic_tokenize -> subsample_tokens -> tokens_to_ids in memory (no intermediate files).
+    """
+    texts = df['TEXT'].tolist()
+    categories = df['CATEGORY'].tolist()
+    num_docs = len(texts)
+    num_bytes = sum(len(text) for text in texts)
+    results = []
+
+    with StageTimer('compute_sections') as timer:
+        p = Pool(processes=num_workers)
+        sections = p.map(extract_headers, texts)
+        p.close()
+        p.join()  # Reap workers so that their peak memory is reflected in ru_maxrss of children
+        section_counts, _ = count_section_headers(sections)
+    results.append(timer.result(num_docs, num_bytes=num_bytes))
+
+    # Frequent sections are read from a module-level global so that Pool workers (forked below) inherit them
+    mimic_tokenize.SECTION_NAMES = list(set([s for s, ct in section_counts.items() if ct >= min_section_count]))
+    processor = (mimic_tokenize.preprocess_mimic_split_sentences if split_sentences
+                 else mimic_tokenize.preprocess_mimic)
+    with StageTimer('mimic_tokenize') as timer:
+        p = Pool(processes=num_workers)
+        parsed_docs = p.map(processor, zip(categories, texts))
+        p.close()
+        p.join()
+        token_counts = mimic_tokenize.count_tokens(parsed_docs)
+    num_tokens = sum(token_counts.values()) - token_counts['__ALL__']
+    results.append(timer.result(num_docs, num_tokens=num_tokens, num_bytes=num_bytes))
+
+    with StageTimer('subsample_tokens') as timer:
+        subsampled_docs, vocab = subsample_tokens(
+            parsed_docs, token_counts, min_token_count=min_token_count, subsample_param=subsample_param)
+    results.append(timer.result(num_docs, num_tokens=num_tokens))
+
+    with StageTimer('tokens_to_ids') as timer:
+        ids = convert_tokens_to_ids(subsampled_docs, vocab)
+    results.append(timer.result(num_docs, num_tokens=len(ids)))
+
+    print('Corpus: {} documents, {} MB of text, {} tokens, {} ids after subsampling, vocabulary size={}'.format(
+        num_docs, round(num_bytes / float(1 << 20), 2), num_tokens, len(ids), vocab.size()))
+    return results
+
+
+if __name__ == '__main__':
+    arguments = argparse.ArgumentParser('End-to-end benchmark of the MIMIC-III preprocessing pipeline.')
+    arguments.add_argument('--mimic_fp', default=None, help=(
+        'Optional NOTEEVENTS-formatted csv.  If not provided, a synthetic corpus is generated '
+        '(see synthetic_corpus.py).'))
+    arguments.add_argument('--num_docs', default=2000, type=int, help='Number of synthetic notes to generate.')
+    arguments.add_argument('--mean_doc_tokens', default=400, type=int)
+    arguments.add_argument('--vocab_size', default=50000, type=int)
+    arguments.add_argument('--seed', default=1992, type=int)
+    arguments.add_argument('--num_workers', default=None, type=int)
+    arguments.add_argument('--min_count', default=10, type=int, help='Minimum count of a frequent section header.')
+    arguments.add_argument('--min_token_count', default=10, type=int)
+    arguments.add_argument('--subsample_param', default=0.001, type=float)
+    arguments.add_argument('-split_sentences', default=False, action='store_true')
+    arguments.add_argument('--out_fp', default=None, help='Optionally save per-stage results as json.')
+
+    args = arguments.parse_args()
+    render_args(args)
+
+    if args.mimic_fp is None:
+        print('Generating {} synthetic notes...'.format(args.num_docs))
+        start_time = time()
+        df = generate_noteevents(
+            args.num_docs, vocab_size=args.vocab_size, mean_doc_tokens=args.mean_doc_tokens, seed=args.seed)
+        print('Took {} seconds'.format(round(time() - start_time, 2)))
+    else:
+        df = pd.read_csv(os.path.expanduser(args.mimic_fp))
+
+    results = run_benchmark(
+        df, num_workers=args.num_workers, min_section_count=args.min_count, min_token_count=args.min_token_count,
+        subsample_param=args.subsample_param, split_sentences=args.split_sentences)
+    if args.out_fp is not None:
+        print('Saving results to {}'.format(args.out_fp))
+        with open(args.out_fp, 'w') as fd:
+            json.dump({'args': vars(args), 'results': results}, fd, indent=2)
@@ -116,6 +116,20 @@ def extract_headers(text):
     return list(map(lambda match: match.upper().strip().strip(':'), matches))
 
 
+def count_section_headers(sections):
+    """
+    :param sections: list of section headers extracted from each document (output of extract_headers)
+    :return: dictionary of section header counts along with the total number of headers
+    """
+    all_counts = 0
+    section_counts = defaultdict(int)
+    for section_arr in sections:
+        for section in section_arr:
+            section_counts[section] += 1
+            all_counts += 1
+    return section_counts, all_counts
+
+
 if __name__ == '__main__':
     arguments = argparse.ArgumentParser('MIMIC-III Section Header Extraction Script.')
     arguments.add_argument('-debug', default=False, action='store_true')
@@ -139,12 +153,7 @@ if __name__ == '__main__':
     print('Took {} seconds'.format(end_time - start_time))
 
     print('Done!  Now extracting counts...')
-    all_counts = 0
-    section_counts = defaultdict(int)
-    for section_arr in sections:
-        for section in section_arr:
-            section_counts[section] += 1
-            all_counts += 1
+    section_counts, all_counts = count_section_headers(sections)
     print('Located {} section headers in all {} documents'.format(all_counts, len(texts)))
 
     df = pd.DataFrame(section_counts.items(), columns=['section', 'count'])
@@ -0,0 +1,191 @@
+from collections import deque
+
+
+def is_word_char(char):
+    """
+    :param char: single character
+    :return: True if char matches \\w (as in the re module for str patterns)
+    """
+    return char.isalnum() or char == '_'
+
+
+def is_boundary(text, idx):
+    """
+    :param text: string
+    :param idx: position in [0, len(text)]
+    :return: True if \\b matches at idx
+    """
+    prev_word = idx > 0 and is_word_char(text[idx - 1])
+    next_word = idx < len(text) and is_word_char(text[idx])
+    return prev_word != next_word
+
+
+class AhoCorasick:
+    """
+    Multi-pattern string matching automaton.  After construction, every (possibly overlapping) occurrence of every
+    pattern in a text is found in a single pass over the text.  Transitions are plain dicts and lists so the automaton
+    can be pickled and shared with worker processes.
+    """
+    def __init__(self, patterns):
+        """
+        :param patterns: list of non-empty strings.  Matches are reported by index into this list.
+        """
+        self.patterns = list(patterns)
+        self.goto = [{}]
+        self.fail = [0]
+        self.outputs = [[]]
+        for pattern_idx, pattern in enumerate(self.patterns):
+            if len(pattern) == 0:
+                raise Exception('Cannot match an empty pattern.')
+            state = 0
+            for char in pattern:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][char] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.outputs.append([])
+                state = next_state
+            self.outputs[state].append(pattern_idx)
+
+        # Breadth-first so that the failure state (a shorter suffix) is complete before its extensions
+        queue = deque(self.goto[0].values())
+        while len(queue) > 0:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                fail_state = self.fail[state]
+                while fail_state > 0 and char not in self.goto[fail_state]:
+                    fail_state = self.fail[fail_state]
+                self.fail[next_state] = self.goto[fail_state].get(char, 0)
+                self.outputs[next_state] = self.outputs[next_state] + self.outputs[self.fail[next_state]]
+                queue.append(next_state)
+
+    def iter_matches(self, text):
+        """
+        :param text: string to scan
+        :return: generator of (start, end, pattern_idx) for every occurrence, ordered by end position
+        """
+        goto, fail, outputs, patterns = self.goto, self.fail, self.outputs, self.patterns
+        state = 0
+        for idx, char in enumerate(text):
+            while state > 0 and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for pattern_idx in outputs[state]:
+                yield idx + 1 - len(patterns[pattern_idx]), idx + 1, pattern_idx
+
+
+class ShortFormMatch:
+    """
+    A short form occurrence.  start() and end() mirror re.Match so that ContextExtractor.get_context can consume it:
+    they include the single whitespace character matched by (\\s|\\b) on either side.  form_start and form_end delimit
+    the matched surface form itself.
+    """
+    __slots__ = ['short_form', 'form', 'form_start', 'form_end', 'match_start', 'match_end']
+
+    def __init__(self, short_form, form, form_start, form_end, match_start, match_end):
+        self.short_form = short_form
+        self.form = form
+        self.form_start = form_start
+        self.form_end = form_end
+        self.match_start = match_start
+        self.match_end = match_end
+
+    def start(self):
+        return self.match_start
+
+    def end(self):
+        return self.match_end
+
+
+class ShortFormMatcher:
+    """
+    Finds every short form in a document with one pass of an Aho-Corasick automaton.
+
+    Each short form is matched as the regex (\\s|\\b)(SF|SFs|SF's|SFs')(\\s|\\b) would (inflections only if
+    allow_inflections).  Among forms which start at the same position, the longest short form wins and then the
+    inflections are tried in the above order, as regex alternation would.
+    """
+    INFLECTIONS = ['', 's', '\'s', 's\'']
+
+    def __init__(self, short_forms, allow_inflections=False, ignore_case=False):
+        """
+        :param short_forms: collection of short forms
+        :param allow_inflections: Boolean flag to also match the short form followed by s, 's, or s'
+        :param ignore_case: Boolean flag to ignore the case of the short form
+        """
+        self.allow_inflections = allow_inflections
+        self.ignore_case = ignore_case
+        self.short_forms = sorted(set(short_forms), key=lambda sf: (-len(sf), sf))
+        inflections = self.INFLECTIONS if allow_inflections else self.INFLECTIONS[:1]
+        forms, self.form_short_forms, self.form_priorities = [], [], []
+        for sf_idx, short_form in enumerate(self.short_forms):
+            base_form = short_form.lower() if ignore_case else short_form
+            for inflection_idx, inflection in enumerate(inflections):
+                forms.append(base_form + inflection)
+                self.form_short_forms.append(short_form)
+                self.form_priorities.append((sf_idx, inflection_idx))
+        self.automaton = AhoCorasick(forms)
+
+    def _candidates(self, text):
+        """
+        :return: list of (form_start, priority, form_end, form_idx) for occurrences followed by (\\s|\\b)
+        """
+        candidates = []
+        n = len(text)
+        for start, end, form_idx in self.automaton.iter_matches(text):
+            if (end < n and text[end].isspace()) or is_boundary(text, end):
+                candidates.append((start, self.form_priorities[form_idx], end, form_idx))
+        candidates.sort()
+        return candidates
+
+    def _select(self, text, candidates):
+        """
+        :return: list of non-overlapping ShortFormMatch in the order re.finditer would return them
+        """
+        matches, last_end = [], 0
+        n = len(text)
+        for start, _, end, form_idx in candidates:
+            if start < last_end:
+                continue
+            # (\s|\b) consumes the preceding whitespace unless the previous match already consumed it
+            if start > last_end and text[start - 1].isspace():
+                match_start = start - 1
+            elif is_boundary(text, start):
+                match_start = start
+            else:
+                continue
+            match_end = end + 1 if end < n and text[end].isspace() else end
+            matches.append(ShortFormMatch(self.form_short_forms[form_idx], self.automaton.patterns[form_idx],
+                                          start, end, match_start, match_end))
+            last_end = match_end
+        return matches
+
+    def search_text(self, document):
+        return document.lower() if self.ignore_case else document
+
+    def finditer(self, document):
+        """
+        :param document: The document to be scanned
+        :return: list of non-overlapping ShortFormMatch for all short forms combined (as a single alternation regex)
+        """
+        text = self.search_text(document)
+        return self._select(text, self._candidates(text))
+
+    def finditer_by_short_form(self, document):
+        """
+        :param document: The document to be scanned
+        :return: dictionary from each short form found to its matches.  Each short form is matched independently, as if
+        it had its own regex, but the document is only scanned once.
+        """
+        text = self.search_text(document)
+        sf_candidates = {}
+        for candidate in self._candidates(text):
+            sf_candidates.setdefault(self.form_short_forms[candidate[-1]], []).append(candidate)
+        sf_matches = {}
+        for short_form, candidates in sf_candidates.items():
+            matches = self._select(text, candidates)
+            if len(matches) > 0:
+                sf_matches[short_form] = matches
+        return sf_matches
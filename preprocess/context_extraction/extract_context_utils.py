@@ -1,3 +1,5 @@
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
 import logging
 from enum import Enum
 import re
@@ -5,7 +7,11 @@ import re
 import inflect
 import numpy as np
 
+from aho_corasick import AhoCorasick, ShortFormMatcher
+
 logger = logging.getLogger(__name__)
+REGEX_SPECIAL_CHARS = set('.^$*+?{}[]\\|()')
+WORD_SEPARATOR_REGEX = re.compile(r'\s+')
 
 
 class TermType(Enum):
@@ -25,14 +31,144 @@ class ContextType(Enum):
     DOCUMENT = 'document'
 
 
+class SplitView:
+    """
+    This class stands in for re.split(separator, document[lo:hi]) without materializing the list.
+    Pieces are looked up by index from the separator matches over the whole document (see DocumentIndex).
+    """
+    def __init__(self, document: str, starts: list, ends: list, lo: int, hi: int, clip_head: bool):
+        """
+        :param document: The full document
+        :param starts: Start offsets of the separator matches in the document
+        :param ends: End offsets of the separator matches in the document
+        :param lo: Start of the substring which is split
+        :param hi: End of the substring which is split
+        :param clip_head: Boolean flag indicating that a separator which straddles lo still separates (True for \s+,
+        False for line breaks whose trailing spaces are not a separator on their own)
+        """
+        self.document, self.starts, self.ends, self.lo, self.hi = document, starts, ends, lo, hi
+        self.first_sep = bisect_right(ends, lo) if clip_head else bisect_left(starts, lo)
+        self.num_seps = max(0, bisect_left(starts, hi) - self.first_sep)
+
+    def __len__(self):
+        return self.num_seps + 1
+
+    def piece(self, idx: int):
+        start = self.lo if idx == 0 else min(self.ends[self.first_sep + idx - 1], self.hi)
+        end = self.hi if idx == self.num_seps else max(self.starts[self.first_sep + idx], self.lo)
+        return self.document[start:end]
+
+    def pieces(self, idxs):
+        return [self.piece(idx) for idx in idxs]
+
+    def trimmed(self):
+        """
+        This method applies ContextExtractor.trim_boundaries
+        :return: The range (start, end) of piece indices which survive trimming
+        """
+        start, end = 0, len(self)
+        if end > start and len(self.piece(start)) == 1 and not self.piece(start).isalnum():
+            start += 1
+        if end > start and not self.piece(start):
+            start += 1
+        if end > start and len(self.piece(end - 1)) == 1 and not self.piece(end - 1).isalnum():
+            end -= 1
+        if end > start and not self.piece(end - 1):
+            end -= 1
+        return start, end
+
+
+class EmptyPieces:
+    """
+    This class is the list of indices (relative to start) of the blank pieces of a SplitView in [start, end).
+    Interior pieces are looked up in the blank lines of the whole document so that only the clipped head and tail
+    pieces are inspected.
+    """
+    def __init__(self, view: SplitView, start: int, end: int, empty_doc_idxs: list):
+        """
+        :param view: A SplitView over line breaks
+        :param start: First piece index of the (trimmed) list
+        :param end: End piece index of the (trimmed) list
+        :param empty_doc_idxs: Sorted indices of the blank lines in re.split(line break, document)
+        """
+        self.view, self.start, self.empty_doc_idxs = view, start, empty_doc_idxs
+        last = view.num_seps
+        self.head = start == 0 < end and len(view.piece(0).strip()) < 1
+        self.tail = 0 < last and start <= last < end and len(view.piece(last).strip()) < 1
+        interior_start, interior_end = max(start, 1), min(end, last)
+        self.interior_lo = bisect_left(empty_doc_idxs, view.first_sep + interior_start)
+        self.interior_hi = max(self.interior_lo, bisect_left(empty_doc_idxs, view.first_sep + interior_end))
+        self.count = int(self.head) + self.interior_hi - self.interior_lo + int(self.tail)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx: int):
+        if idx < 0:
+            idx += self.count
+        if not 0 <= idx < self.count:
+            raise IndexError('list index out of range')
+        if self.head:
+            if idx == 0:
+                return -self.start
+            idx -= 1
+        if idx < self.interior_hi - self.interior_lo:
+            return self.empty_doc_idxs[self.interior_lo + idx] - self.view.first_sep - self.start
+        return self.view.num_seps - self.start
+
+
+class DocumentIndex:
+    """
+    This class holds the offsets of the whitespace runs and line breaks of a document.  They are found once (on first
+    use) so that extracting the context around each match costs O(window) rather than O(document).
+    """
+    def __init__(self, document: str, split_lines_regex):
+        """
+        :param document: The document to be scanned
+        :param split_lines_regex: The compiled line break regex (see ContextExtractor)
+        """
+        self.document = document
+        self.split_lines_regex = split_lines_regex
+        self.word_separators = None
+        self.line_separators = None
+
+    def get_word_separators(self):
+        """
+        :return: Start and end offsets of every \s+ run
+        """
+        if self.word_separators is None:
+            matches = list(WORD_SEPARATOR_REGEX.finditer(self.document))
+            self.word_separators = [m.start() for m in matches], [m.end() for m in matches]
+        return self.word_separators
+
+    def get_line_separators(self):
+        """
+        :return: Start and end offsets of every line break along with the indices of the blank lines
+        """
+        if self.line_separators is None:
+            matches = list(self.split_lines_regex.finditer(self.document))
+            starts, ends = [m.start() for m in matches], [m.end() for m in matches]
+            line_starts, line_ends = [0] + ends, starts + [len(self.document)]
+            empty_idxs = [idx for idx, (start, end) in enumerate(zip(line_starts, line_ends))
+                          if len(self.document[start:end].strip()) < 1]
+            self.line_separators = starts, ends, empty_idxs
+        return self.line_separators
+
+
 class ContextExtractor:
     """
     This class is used to extract contexts from a document for a given short-form or long-form of an acronym.
     The main interface to the class is extract_contexts()
     """
-    def __init__(self):
+    def __init__(self, max_cached_patterns: int = 1024):
+        """
+        :param max_cached_patterns: Number of compiled long form regexes and short form automata to keep (LRU)
+        """
         self.inflect_engine = inflect.engine()
         self.split_lines_regex = re.compile(r'[\n\r\v\f\x1c\x1d\x1e\x85\u2028\u2029](?: )*')
+        self.max_cached_patterns = max_cached_patterns
+        self.pattern_cache = OrderedDict()
+        self.inflection_cache = {}
 
     @staticmethod
     def trim_boundaries(string_list):
@@ -52,88 +188,176 @@ class ContextExtractor:
             string_list = string_list[:-1]
         return string_list
 
-    def get_context(self, document: str, match_found: re.match, context_config: dict):
+    def get_context(self, document: str, match_found: re.match, context_config: dict,
+                    document_index: DocumentIndex = None):
         """
         This method gets the context around a found match in the document in accordance with the context configuration
         :param document: The document to be scanned
         :param match_found: The match that is to be used as the center of the context window
         :param context_config: The context configuration
+        :param document_index: Optional DocumentIndex of the document.  Pass the same one for every match in a document.
         :return: A string containing the context around the found match (Can parameterize later to return str or list!)
+
+        Equivalent to splitting the text before and after the match and trimming the boundaries (see trim_boundaries)
+        but only the pieces in the window are materialized.
         """
+        if document_index is None:
+            document_index = DocumentIndex(document, self.split_lines_regex)
         match_str = document[match_found.start():match_found.end()].strip()
-        preceding_text = document[:match_found.start()]
-        succeeding_text = document[match_found.end():]
+        size = context_config['size']
         if context_config['type'] == ContextType.WORD:
-            preceding_text_words = self.trim_boundaries(re.split(r'\s+', preceding_text))
-            succeeding_text_words = self.trim_boundaries(re.split(r'\s+', succeeding_text))
-            return match_str, ' '.join(preceding_text_words[len(preceding_text_words) - context_config['size']:]
-                            + ['TARGETWORD'] + succeeding_text_words[:context_config['size']])
+            starts, ends = document_index.get_word_separators()
+            preceding_view = SplitView(document, starts, ends, 0, match_found.start(), clip_head=True)
+            succeeding_view = SplitView(document, starts, ends, match_found.end(), len(document), clip_head=True)
+            preceding_start, preceding_end = preceding_view.trimmed()
+            succeeding_start, succeeding_end = succeeding_view.trimmed()
+            preceding_idxs = range(preceding_start, preceding_end)[preceding_end - preceding_start - size:]
+            succeeding_idxs = range(succeeding_start, succeeding_end)[:size]
+            return match_str, ' '.join(preceding_view.pieces(preceding_idxs) + ['TARGETWORD']
+                                       + succeeding_view.pieces(succeeding_idxs))
         if context_config['type'] == ContextType.PARAGRAPH:
-            preceding_text_lines = self.trim_boundaries(re.split(self.split_lines_regex, preceding_text))
-            succeeding_text_lines = self.trim_boundaries(re.split(self.split_lines_regex, succeeding_text))
-            preceding_text_empty_line_indices = [index for index, item in enumerate(preceding_text_lines)
-                                                 if len(item.strip()) < 1]
-            succeeding_text_empty_line_indices = [index for index, item in enumerate(succeeding_text_lines)
-                                                  if len(item.strip()) < 1]
+            starts, ends, empty_idxs = document_index.get_line_separators()
+            preceding_view = SplitView(document, starts, ends, 0, match_found.start(), clip_head=False)
+            succeeding_view = SplitView(document, starts, ends, match_found.end(), len(document), clip_head=False)
+            preceding_start, preceding_end = preceding_view.trimmed()
+            succeeding_start, succeeding_end = succeeding_view.trimmed()
+            preceding_text_empty_line_indices = EmptyPieces(preceding_view, preceding_start, preceding_end, empty_idxs)
+            succeeding_text_empty_line_indices = EmptyPieces(
+                succeeding_view, succeeding_start, succeeding_end, empty_idxs)
             if not preceding_text_empty_line_indices:
                 preceding_text_empty_line_indices = [-1]
             if not succeeding_text_empty_line_indices:
-                succeeding_text_empty_line_indices = [len(succeeding_text_lines)]
-            return ' '.join(preceding_text_lines[
-                            preceding_text_empty_line_indices[
-                                len(preceding_text_empty_line_indices) - context_config['size']
-                                if context_config['size'] < len(preceding_text_empty_line_indices) else -1] + 1:]
-                            + ['TARGETWORD'] +
-                            succeeding_text_lines[:succeeding_text_empty_line_indices[
-                                context_config['size'] - 1
-                                if context_config['size'] < len(succeeding_text_empty_line_indices) else -1]])
+                succeeding_text_empty_line_indices = [succeeding_end - succeeding_start]
+            preceding_idxs = range(preceding_start, preceding_end)[preceding_text_empty_line_indices[
+                len(preceding_text_empty_line_indices) - size
+                if size < len(preceding_text_empty_line_indices) else -1] + 1:]
+            succeeding_idxs = range(succeeding_start, succeeding_end)[:succeeding_text_empty_line_indices[
+                size - 1 if size < len(succeeding_text_empty_line_indices) else -1]]
+            return ' '.join(preceding_view.pieces(preceding_idxs) + ['TARGETWORD']
+                            + succeeding_view.pieces(succeeding_idxs))
 
-    def get_contexts_for_long_form(self, long_forms: str, document: str, context_config: dict, allow_inflections: bool,
-                                   ignore_case: bool):
+    def get_word_forms(self, word: str, allow_inflections: bool, ignore_case: bool):
         """
-        This method gets the contexts for all occurrences of a long form
-        :param long_forms: ; delimited list of the long form for which contexts are to be returned
-        :param document: The document to be scanned
-        :param context_config: The context configuration
+        This method gets the forms of a single long form word which are searched for
+        :param word: A word in the long form
+        :param allow_inflections: Boolean flag to allow inflections on the word
+        :param ignore_case: Boolean flag to ignore the case of the word
+        :return: A list of word forms (the word itself comes first)
+        """
+        base_word_form = word.lower() if ignore_case else word
+        word_forms = [base_word_form]
+        if allow_inflections:
+            if base_word_form not in self.inflection_cache:
+                self.inflection_cache[base_word_form] = (self.inflect_engine.singular_noun(base_word_form),
+                                                         self.inflect_engine.plural_noun(base_word_form))
+            singular_inflection, plural_inflection = self.inflection_cache[base_word_form]
+            if singular_inflection:
+                word_forms.append(singular_inflection)
+                word_forms.append(singular_inflection + '\'s')
+            word_forms.append(plural_inflection)
+            word_forms.append(plural_inflection + '\'')
+        return word_forms
+
+    def build_long_form_regex(self, long_forms: str, allow_inflections: bool, ignore_case: bool):
+        """
+        This method builds the search regex for a long form (alternatives with the most words are tried first)
+        :param long_forms: ; delimited list of the long form
         :param allow_inflections: Boolean flag to allow inflections on the long form
         :param ignore_case: Boolean flag to ignore the case of the long form
-        :return: A string containing the context around the found match (Can parameterize later to return str or list!)
+        :return: The regex string along with the word forms of every word in every alternative (in search order)
         """
-        search_regexes = []
-        text_to_search = document.lower() if ignore_case else document
+        search_regexes, alternative_word_forms = [], []
         long_forms_arr = long_forms.split(';')
         num_words = np.array([len(a.split()) for a in long_forms_arr])
         lf_order = np.argsort(-num_words)
         for long_form_idx in range(len(lf_order)):
             long_form = long_forms_arr[lf_order[long_form_idx]]
             search_regex = r'(\s+|\b)'
-            words_in_long_form = long_form.split()
-            for word in words_in_long_form:
-                base_word_form = word.lower() if ignore_case else word
-                word_forms = [base_word_form]
-                if allow_inflections:
-                    singular_inflection = self.inflect_engine.singular_noun(base_word_form)
-                    if singular_inflection:
-                        word_forms.append(singular_inflection)
-                        word_forms.append(singular_inflection + '\'s')
-                    plural_inflection = self.inflect_engine.plural_noun(base_word_form)
-                    word_forms.append(plural_inflection)
-                    word_forms.append(plural_inflection + '\'')
+            word_forms_arr = [self.get_word_forms(word, allow_inflections, ignore_case) for word in long_form.split()]
+            for word_forms in word_forms_arr:
                 search_regex += r'(' + '|'.join(word_forms) + r')(\s+|\b)'
             search_regexes.append(search_regex)
+            alternative_word_forms.append(word_forms_arr)
+        return '|'.join(search_regexes), alternative_word_forms
 
-        summary_search_regex = '|'.join(search_regexes)
-        if context_config['type'] == ContextType.DOCUMENT:
-            if re.search(summary_search_regex, text_to_search):
-                return [document]
-            return []
-        else:
+    def get_cached_pattern(self, key: tuple, build_pattern):
+        """
+        This method looks up a compiled pattern in the LRU cache, building (and caching) it if missing
+        :param key: The cache key.  (term type, terms, allow_inflections, ignore_case)
+        :param build_pattern: Function of no arguments which builds the pattern
+        :return: The compiled pattern
+        """
+        if key in self.pattern_cache:
+            self.pattern_cache.move_to_end(key)
+            return self.pattern_cache[key]
+        pattern = build_pattern()
+        self.pattern_cache[key] = pattern
+        if len(self.pattern_cache) > self.max_cached_patterns:
+            self.pattern_cache.popitem(last=False)
+        return pattern
+
+    def get_long_form_regex(self, long_forms: str, allow_inflections: bool, ignore_case: bool):
+        """
+        This method returns the (cached) compiled search regex for a long form
+        :param long_forms: ; delimited list of the long form
+        :param allow_inflections: Boolean flag to allow inflections on the long form
+        :param ignore_case: Boolean flag to ignore the case of the long form
+        :return: The compiled regex
+        """
+        def build_pattern():
+            summary_search_regex, _ = self.build_long_form_regex(long_forms, allow_inflections, ignore_case)
             try:
-                return [self.get_context(document, match, context_config) for match in
-                        re.finditer(summary_search_regex, text_to_search)]
+                return re.compile(summary_search_regex)
             except re.error as e:
                 raise Exception('Problem with regex={} --> {}'.format(summary_search_regex, e.msg))
 
+        return self.get_cached_pattern((TermType.LONG_FORM, long_forms, allow_inflections, ignore_case), build_pattern)
+
+    def search_long_form(self, search_regex, document: str, context_config: dict, ignore_case: bool):
+        """
+        This method gets the contexts for all matches of a compiled long form regex
+        :param search_regex: The compiled regex (see get_long_form_regex)
+        :param document: The document to be scanned
+        :param context_config: The context configuration
+        :param ignore_case: Boolean flag indicating that search_regex was built for lowercased text
+        :return: A string containing the context around the found match (Can parameterize later to return str or list!)
+        """
+        text_to_search = document.lower() if ignore_case else document
+        if context_config['type'] == ContextType.DOCUMENT:
+            if search_regex.search(text_to_search):
+                return [document]
+            return []
+        document_index = DocumentIndex(document, self.split_lines_regex)
+        return [self.get_context(document, match, context_config, document_index=document_index) for match in
+                search_regex.finditer(text_to_search)]
+
+    def get_contexts_for_long_form(self, long_forms: str, document: str, context_config: dict, allow_inflections: bool,
+                                   ignore_case: bool):
+        """
+        This method gets the contexts for all occurrences of a long form
+        :param long_forms: ; delimited list of the long form for which contexts are to be returned
+        :param document: The document to be scanned
+        :param context_config: The context configuration
+        :param allow_inflections: Boolean flag to allow inflections on the long form
+        :param ignore_case: Boolean flag to ignore the case of the long form
+        :return: A string containing the context around the found match (Can parameterize later to return str or list!)
+        """
+        search_regex = self.get_long_form_regex(long_forms, allow_inflections, ignore_case)
+        return self.search_long_form(search_regex, document, context_config, ignore_case)
+
+    def get_short_form_matcher(self, short_forms, allow_inflections: bool, ignore_case: bool):
+        """
+        This method returns the (cached) automaton which matches all of the given short forms in a single pass
+        :param short_forms: Collection of short forms
+        :param allow_inflections: Boolean flag to allow inflections on the short forms
+        :param ignore_case: Boolean flag to ignore the case of the short forms
+        :return: A ShortFormMatcher
+        """
+        short_forms = tuple(sorted(set(short_forms)))
+        return self.get_cached_pattern(
+            (TermType.SHORT_FORM, short_forms, allow_inflections, ignore_case),
+            lambda: ShortFormMatcher(short_forms, allow_inflections=allow_inflections, ignore_case=ignore_case))
+
     def get_contexts_for_short_form(self, short_form: str, document: str, context_config: dict, allow_inflections: bool,
                                     ignore_case: bool):
         """
@@ -145,23 +369,37 @@ class ContextExtractor:
         :param ignore_case: Boolean flag to ignore the case of the short form
         :return: A string containing the context around the found match (Can parameterize later to return str or list!)
         """
-        search_regex = r'(\s|\b)'
-        text_to_search = document.lower() if ignore_case else document
-        if ignore_case:
-            base_short_form = short_form.lower()
-        else:
-            base_short_form = short_form
-        search_regex += base_short_form
-        if allow_inflections:
-            search_regex += r'|' + base_short_form + r's|' + base_short_form + r'\'s|' + base_short_form + r's\''
-        search_regex += r'(\s|\b)'
+        return self.get_contexts_for_short_forms(
+            [short_form], document, context_config, allow_inflections, ignore_case).get(short_form, [])
+
+    def get_contexts_for_short_forms(self, short_forms, document: str, context_config: dict, allow_inflections: bool,
+                                     ignore_case: bool):
+        """
+        This method gets the contexts for all occurrences of each of the short forms with a single scan of the document
+        :param short_forms: Collection of short forms for which contexts are to be returned
+        :param document: The document to be scanned
+        :param context_config: The context configuration
+        :param allow_inflections: Boolean flag to allow inflections on the short forms
+        :param ignore_case: Boolean flag to ignore the case of the short forms
+        :return: A dictionary from each short form found in the document to the output of get_contexts_for_short_form
+        """
+        matcher = self.get_short_form_matcher(short_forms, allow_inflections, ignore_case)
+        return self.search_short_forms(matcher, document, context_config)
+
+    def search_short_forms(self, matcher: ShortFormMatcher, document: str, context_config: dict):
+        """
+        This method gets the contexts for all matches of a short form automaton
+        :param matcher: The ShortFormMatcher (see get_short_form_matcher)
+        :param document: The document to be scanned
+        :param context_config: The context configuration
+        :return: A dictionary from each short form found in the document to the output of get_contexts_for_short_form
+        """
+        sf_matches = matcher.finditer_by_short_form(document)
         if context_config['type'] == ContextType.DOCUMENT:
-            if re.search(search_regex, text_to_search):
-                return [document]
-            return []
-        else:
-            return [self.get_context(document, match, context_config) for match in
-                    re.finditer(search_regex, text_to_search)]
+            return {short_form: [document] for short_form in sf_matches}
+        document_index = DocumentIndex(document, self.split_lines_regex)
+        return {short_form: [self.get_context(document, match, context_config, document_index=document_index)
+                             for match in matches] for short_form, matches in sf_matches.items()}
 
     @staticmethod
     def check_config_sanity(context_config: dict):
@@ -198,6 +436,106 @@ class ContextExtractor:
                                                     ignore_case)
         raise Exception('Invalid term type. Refer to class TermType for accepted values')
 
+    def extract_contexts_many(self, search_term: str, term_type: TermType, documents, context_config: dict,
+                              allow_inflections: bool, ignore_case: bool):
+        """
+        This method is the batch version of extract_contexts.  The config is checked and the pattern is looked up once.
+        :param search_term: The term for which contexts are to be extracted
+        :param term_type: The TermType of the search term
+        :param documents: Iterable of documents to be scanned
+        :param context_config: The context configuration
+        :param allow_inflections: Boolean flag to allow inflections on the search term
+        :param ignore_case: Boolean flag to ignore the case of the search term
+        :return: A list with the output of extract_contexts for each document
+        """
+        self.check_config_sanity(context_config)
+        if term_type == TermType.LONG_FORM:
+            search_regex = self.get_long_form_regex(search_term, allow_inflections, ignore_case)
+            return [self.search_long_form(search_regex, document, context_config, ignore_case)
+                    for document in documents]
+        if term_type == TermType.SHORT_FORM:
+            matcher = self.get_short_form_matcher([search_term], allow_inflections, ignore_case)
+            return [self.search_short_forms(matcher, document, context_config).get(search_term, [])
+                    for document in documents]
+        raise Exception('Invalid term type. Refer to class TermType for accepted values')
+
+
+class LongFormMatcher:
+    """
+    This class extracts the contexts of many long forms from a document with a single literal scan.
+    Each long form's regex (see ContextExtractor.build_long_form_regex) is compiled once.  An Aho-Corasick automaton
+    over the forms of one literal word per alternative (any match must contain one of them) selects the long forms whose
+    regex can match, so that only those regexes are run.  Output is identical to calling get_contexts_for_long_form for
+    every long form.
+    """
+    def __init__(self, long_forms_list, context_extractor: ContextExtractor, allow_inflections: bool,
+                 ignore_case: bool):
+        """
+        :param long_forms_list: List of ; delimited long forms
+        :param context_extractor: The ContextExtractor used to build regexes and contexts
+        :param allow_inflections: Boolean flag to allow inflections on the long forms
+        :param ignore_case: Boolean flag to ignore the case of the long forms
+        """
+        self.long_forms_list = list(long_forms_list)
+        self.context_extractor = context_extractor
+        self.ignore_case = ignore_case
+        self.search_regexes = []
+        self.alternative_word_forms = []  # Per long form (see ContextExtractor.build_long_form_regex)
+        self.unfiltered_idxs = set()  # Long forms without a literal word are always searched
+        literals, self.literal_long_form_idxs = [], []
+        for long_form_idx, long_forms in enumerate(self.long_forms_list):
+            _, alternative_word_forms = context_extractor.build_long_form_regex(
+                long_forms, allow_inflections, ignore_case)
+            self.alternative_word_forms.append(alternative_word_forms)
+            self.search_regexes.append(
+                context_extractor.get_long_form_regex(long_forms, allow_inflections, ignore_case))
+            key_word_forms = [self.select_literal_word(word_forms_arr) for word_forms_arr in alternative_word_forms]
+            if any(word_forms is None for word_forms in key_word_forms):
+                self.unfiltered_idxs.add(long_form_idx)
+                continue
+            for word_forms in key_word_forms:
+                literals += word_forms
+                self.literal_long_form_idxs += [long_form_idx] * len(word_forms)
+        self.automaton = AhoCorasick(literals)
+
+    @staticmethod
+    def select_literal_word(word_forms_arr):
+        """
+        This method picks the most selective word in a long form alternative whose forms are plain strings
+        :param word_forms_arr: The word forms of every word in the alternative
+        :return: The word forms of the word with the longest shortest form (or None if every word is a pattern)
+        """
+        literal_word_forms = [word_forms for word_forms in word_forms_arr if all(
+            len(form) > 0 and not REGEX_SPECIAL_CHARS.intersection(form) for form in word_forms)]
+        if len(literal_word_forms) == 0:
+            return None
+        return max(literal_word_forms, key=lambda word_forms: min(map(len, word_forms)))
+
+    def get_contexts(self, document: str, context_config: dict):
+        """
+        This method gets the contexts for all occurrences of every long form in the document
+        :param document: The document to be scanned
+        :param context_config: The context configuration
+        :return: A list of (long forms, output of get_contexts_for_long_form) for every long form found (in input order)
+        """
+        text_to_search = document.lower() if self.ignore_case else document
+        candidate_idxs = set(self.unfiltered_idxs)
+        for _, _, literal_idx in self.automaton.iter_matches(text_to_search):
+            candidate_idxs.add(self.literal_long_form_idxs[literal_idx])
+        results = []
+        document_index = DocumentIndex(document, self.context_extractor.split_lines_regex)
+        for long_form_idx in sorted(candidate_idxs):
+            search_regex = self.search_regexes[long_form_idx]
+            if context_config['type'] == ContextType.DOCUMENT:
+                result = [document] if search_regex.search(text_to_search) else []
+            else:
+                result = [self.context_extractor.get_context(document, match, context_config,
+                                                             document_index=document_index)
+                          for match in search_regex.finditer(text_to_search)]
+            if len(result) > 0:
+                results.append((self.long_forms_list[long_form_idx], result))
+        return results
+
 
 if __name__ == '__main__':
     context_extractor = ContextExtractor()
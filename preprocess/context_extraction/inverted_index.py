@@ -0,0 +1,302 @@
+from collections import defaultdict
+import hashlib
+import json
+from multiprocessing import Pool
+import os
+import re
+import shutil
+from time import time
+
+import numpy as np
+
+from extract_context_utils import REGEX_SPECIAL_CHARS
+
+TOKEN_REGEX = re.compile(r'\w+')
+SEGMENTS_FN = 'segments.json'
+SEGMENT_FILES = {
+    'tokens': 'tokens.txt',
+    'token_offsets': 'token_offsets.npy',
+    'docs': 'docs.npy',
+    'position_offsets': 'position_offsets.npy',
+    'positions': 'positions.npy',
+}
+
+
+def index_tokens(text):
+    """
+    :param text: raw document
+    :return: list of the \\w+ tokens of the lowercased document
+    """
+    return TOKEN_REGEX.findall(text.lower())
+
+
+def _token_positions(text):
+    token_positions = defaultdict(list)
+    for position, token in enumerate(index_tokens(text)):
+        token_positions[token].append(position)
+    return token_positions
+
+
+def store_range_checksum(note_store, start_idx, end_idx):
+    """
+    :param note_store: NoteStore
+    :param start_idx: first document of the range
+    :param end_idx: end document of the range (exclusive)
+    :return: checksum of the text offsets and ROW_IDs of documents [start_idx, end_idx)
+
+    Offsets are cumulative, so the checksum changes if any document up to end_idx is added, removed, resized or
+    reordered.
+    """
+    checksum = hashlib.md5()
+    checksum.update(np.ascontiguousarray(note_store.offsets[start_idx:end_idx + 1]).tobytes())
+    checksum.update(np.ascontiguousarray(note_store.row_ids[start_idx:end_idx]).tobytes())
+    return checksum.hexdigest()
+
+
+class IndexSegment:
+    """
+    Postings (token -> sorted document ids -> positions) for a contiguous range of documents in a NoteStore.
+    Arrays are memory-mapped.
+    """
+    def __init__(self, segment_dir):
+        self.segment_dir = segment_dir
+        with open(os.path.join(segment_dir, SEGMENT_FILES['tokens']), 'r') as fd:
+            self.token_ids = {token: token_id for token_id, token in enumerate(fd.read().split('\n')) if token}
+        load = lambda name: np.load(os.path.join(segment_dir, SEGMENT_FILES[name]), mmap_mode='r')
+        self.token_offsets = load('token_offsets')
+        self.docs = load('docs')
+        self.position_offsets = load('position_offsets')
+        self.positions = load('positions')
+
+    def posting_range(self, token):
+        token_id = self.token_ids.get(token)
+        if token_id is None:
+            return 0, 0
+        return int(self.token_offsets[token_id]), int(self.token_offsets[token_id + 1])
+
+    def token_docs(self, token):
+        start, end = self.posting_range(token)
+        return self.docs[start:end]
+
+    def token_positions(self, token, doc):
+        start, end = self.posting_range(token)
+        posting_idx = start + int(np.searchsorted(self.docs[start:end], doc))
+        if posting_idx == end or not self.docs[posting_idx] == doc:
+            return self.positions[0:0]
+        return self.positions[self.position_offsets[posting_idx]:self.position_offsets[posting_idx + 1]]
+
+    @staticmethod
+    def write(segment_dir, doc_token_positions):
+        """
+        :param segment_dir: directory to create
+        :param doc_token_positions: list of (document id, {token: positions}) in increasing document id order
+        :return: None
+        """
+        postings = defaultdict(list)
+        for doc, token_positions in doc_token_positions:
+            for token, positions in token_positions.items():
+                postings[token].append((doc, positions))
+        tokens = sorted(postings)
+        token_offsets, docs, position_offsets, positions = [0], [], [0], []
+        for token in tokens:
+            for doc, doc_positions in postings[token]:
+                docs.append(doc)
+                positions += doc_positions
+                position_offsets.append(len(positions))
+            token_offsets.append(len(docs))
+
+        tmp_dir = segment_dir + '.tmp'
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        with open(os.path.join(tmp_dir, SEGMENT_FILES['tokens']), 'w') as fd:
+            fd.write('\n'.join(tokens))
+        np.save(os.path.join(tmp_dir, SEGMENT_FILES['token_offsets']), np.array(token_offsets, dtype=np.int64))
+        np.save(os.path.join(tmp_dir, SEGMENT_FILES['docs']), np.array(docs, dtype=np.int64))
+        np.save(os.path.join(tmp_dir, SEGMENT_FILES['position_offsets']), np.array(position_offsets, dtype=np.int64))
+        np.save(os.path.join(tmp_dir, SEGMENT_FILES['positions']), np.array(positions, dtype=np.int32))
+        if os.path.exists(segment_dir):
+            shutil.rmtree(segment_dir)
+        os.rename(tmp_dir, segment_dir)
+
+
+class InvertedIndex:
+    """
+    On-disk positional index over the \\w+ tokens of the lowercased documents of a NoteStore.  It is made of segments,
+    each of which covers a contiguous range of documents, so that documents appended to the store are indexed without
+    rebuilding (see update_inverted_index).
+
+    candidate_documents returns a superset of the documents in which a long form regex (see
+    ContextExtractor.build_long_form_regex) can match so that the exact matcher only runs on those.
+    """
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        segments_fp = os.path.join(index_dir, SEGMENTS_FN)
+        self.source, self.segment_meta = None, []
+        if os.path.exists(segments_fp):
+            with open(segments_fp, 'r') as fd:
+                segments = json.load(fd)
+            if isinstance(segments, list):  # Written before segments recorded their store (always considered stale)
+                self.segment_meta = segments
+            else:
+                self.source, self.segment_meta = segments['source'], segments['segments']
+        self.segments = [IndexSegment(os.path.join(index_dir, meta['name'])) for meta in self.segment_meta]
+
+    @property
+    def num_documents(self):
+        return self.segment_meta[-1]['end'] if len(self.segment_meta) > 0 else 0
+
+    def matches_store(self, note_store):
+        """
+        :param note_store: NoteStore
+        :return: True if every indexed document is unchanged in note_store (same source file and same checksum for
+        each segment)
+        """
+        if self.num_documents > len(note_store):
+            return False
+        source, store_source = self.source or {}, note_store.meta['source'] or {}
+        if not source.get('source_fp') == store_source.get('source_fp'):
+            return False
+        return all(meta.get('checksum') == store_range_checksum(note_store, meta['start'], meta['end'])
+                   for meta in self.segment_meta)
+
+    def token_docs(self, token):
+        """
+        :return: sorted array of the documents which contain token
+        """
+        docs = [segment.token_docs(token) for segment in self.segments]
+        return np.concatenate(docs) if len(docs) > 0 else np.zeros([0], dtype=np.int64)
+
+    def document_frequency(self, token):
+        frequency = 0
+        for segment in self.segments:
+            start, end = segment.posting_range(token)
+            frequency += end - start
+        return frequency
+
+    def token_positions(self, token, doc):
+        segment_idx = int(np.searchsorted([meta['end'] for meta in self.segment_meta], doc, side='right'))
+        return self.segments[segment_idx].token_positions(token, doc)
+
+    @staticmethod
+    def form_tokens(word_forms):
+        """
+        :param word_forms: forms of a long form word (see ContextExtractor.get_word_forms)
+        :return: list of the index tokens of each form, or None if any form is a pattern (and can't be looked up)
+        """
+        if any(len(form) == 0 or REGEX_SPECIAL_CHARS.intersection(form) for form in word_forms):
+            return None
+        forms_tokens = [index_tokens(form) for form in word_forms]
+        if any(len(tokens) == 0 for tokens in forms_tokens):
+            return None
+        return forms_tokens
+
+    def word_docs(self, forms_tokens):
+        """
+        :return: sorted array of documents which contain every token of at least one form
+        """
+        docs = []
+        for tokens in forms_tokens:
+            tokens = sorted(set(tokens), key=self.document_frequency)
+            form_docs = self.token_docs(tokens[0])
+            for token in tokens[1:]:
+                form_docs = np.intersect1d(form_docs, self.token_docs(token), assume_unique=True)
+            docs.append(form_docs)
+        return np.unique(np.concatenate(docs))
+
+    def has_phrase(self, doc, words_forms_tokens):
+        """
+        :param doc: document id
+        :param words_forms_tokens: for each consecutive word, the index tokens of each of its forms
+        :return: True if the words occur as consecutive tokens in the document
+        """
+        ends = None
+        for forms_tokens in words_forms_tokens:
+            next_ends = set()
+            for tokens in forms_tokens:
+                starts = set(self.token_positions(tokens[0], doc).tolist())
+                if ends is not None:
+                    starts &= ends
+                for offset, token in enumerate(tokens[1:], start=1):
+                    if len(starts) == 0:
+                        break
+                    starts &= set((self.token_positions(token, doc) - offset).tolist())
+                next_ends.update(start + len(tokens) for start in starts)
+            if len(next_ends) == 0:
+                return False
+            ends = next_ends
+        return True
+
+    def candidate_documents(self, alternative_word_forms):
+        """
+        :param alternative_word_forms: second output of ContextExtractor.build_long_form_regex
+        :return: sorted array of the documents in which the long form can match
+
+        Only whitespace (or nothing) separates consecutive words of a long form match, so their index tokens are
+        consecutive.  Posting lists are intersected starting from the rarest word.  When every word of an alternative
+        is literal, the phrase is then verified with positions.  Alternatives without any literal word match anywhere.
+        """
+        docs = []
+        for word_forms_arr in alternative_word_forms:
+            words_forms_tokens = [self.form_tokens(word_forms) for word_forms in word_forms_arr]
+            literal_words = [forms_tokens for forms_tokens in words_forms_tokens if forms_tokens is not None]
+            if len(literal_words) == 0:
+                return np.arange(self.num_documents)
+            literal_words = sorted(literal_words, key=lambda forms_tokens: min(
+                self.document_frequency(tokens[0]) for tokens in forms_tokens))
+            alternative_docs = self.word_docs(literal_words[0])
+            for forms_tokens in literal_words[1:]:
+                if len(alternative_docs) == 0:
+                    break
+                alternative_docs = np.intersect1d(alternative_docs, self.word_docs(forms_tokens), assume_unique=True)
+            if len(literal_words) == len(words_forms_tokens) and len(words_forms_tokens) > 1:
+                alternative_docs = np.array(
+                    [doc for doc in alternative_docs.tolist() if self.has_phrase(doc, words_forms_tokens)],
+                    dtype=np.int64)
+            docs.append(alternative_docs)
+        return np.unique(np.concatenate(docs)) if len(docs) > 0 else np.zeros([0], dtype=np.int64)
+
+
+def update_inverted_index(index_dir, note_store, segment_size=20000, num_workers=None):
+    """
+    :param index_dir: directory of the index (created if missing)
+    :param note_store: NoteStore whose documents are indexed
+    :param segment_size: documents per segment (bounds memory while indexing)
+    :param num_workers: processes used to tokenize documents (defaults to all CPUs)
+    :return: InvertedIndex covering every document in note_store
+
+    Only documents beyond the end of the last segment are indexed, provided that the documents already indexed are
+    unchanged in the store (see InvertedIndex.matches_store).  Otherwise (i.e. the store was rebuilt from an edited or
+    reordered source), the index is rebuilt from scratch.
+    """
+    index = InvertedIndex(index_dir) if os.path.exists(os.path.join(index_dir, SEGMENTS_FN)) else None
+    if index is not None and not index.matches_store(note_store):
+        print('Index in {} is stale.  Rebuilding it...'.format(index_dir))
+        index = None
+    if index is None and os.path.exists(index_dir):
+        shutil.rmtree(index_dir)
+    os.makedirs(index_dir, exist_ok=True)
+    index = InvertedIndex(index_dir) if index is None else index
+    num_docs = len(note_store)
+    if index.num_documents == num_docs:
+        return index
+
+    segment_meta = list(index.segment_meta)
+    p = Pool(processes=num_workers)
+    for start_idx in range(index.num_documents, num_docs, segment_size):
+        end_idx = min(start_idx + segment_size, num_docs)
+        start_time = time()
+        texts = (note_store.get_text(doc) for doc in range(start_idx, end_idx))
+        doc_token_positions = zip(range(start_idx, end_idx), p.imap(_token_positions, texts, chunksize=64))
+        name = 'segment-{:012d}'.format(start_idx)
+        IndexSegment.write(os.path.join(index_dir, name), doc_token_positions)
+        segment_meta.append({'name': name, 'start': start_idx, 'end': end_idx,
+                             'checksum': store_range_checksum(note_store, start_idx, end_idx)})
+        segments_fp = os.path.join(index_dir, SEGMENTS_FN)
+        with open(segments_fp + '.tmp', 'w') as fd:
+            json.dump({'source': note_store.meta['source'], 'segments': segment_meta}, fd, indent=4)
+        os.replace(segments_fp + '.tmp', segments_fp)
+        print('Indexed documents [{}, {}) in {} seconds'.format(start_idx, end_idx, round(time() - start_time, 2)))
+    p.close()
+    p.join()
+    return InvertedIndex(index_dir)
@@ -1,30 +1,68 @@
-from collections import defaultdict
 from multiprocessing import Pool
 import os
 import sys
 from time import time
 
 import argparse
-import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
 home_dir = os.path.expanduser('~/LMC/')
 shared_data = os.path.join(home_dir, 'shared_data')
 sys.path.insert(0, os.path.join(home_dir, 'preprocess'))
-from extract_context_utils import ContextExtractor, ContextType
+from extract_context_utils import ContextExtractor, ContextType, LongFormMatcher
+from inverted_index import update_inverted_index
+from note_store import NoteStore, build_note_store, iter_noteevents
 
 LFS = pd.read_csv(os.path.join(shared_data, 'casi/labeled_sf_lf_map.csv'))['target_label'].unique().tolist()
 CONTEXT_EXTRACTOR = ContextExtractor()
+# Compiled once (before the Pool forks) so each document is scanned once for all LFS
+LF_MATCHER = LongFormMatcher(LFS, CONTEXT_EXTRACTOR, allow_inflections=False, ignore_case=True)
+COLUMBIA_FP = '/nlp/projects/BERT_corpus_icu_250M/corpusFiles/train/corpus.txt'
+NOTE_STORE = None  # Set by extract_indexed_contexts (before the Pool forks)
 
 
 def index_marks(nrows, chunk_size):
     return range(1 * chunk_size, (nrows // chunk_size + 1) * chunk_size, chunk_size)
 
 
-def split(dfm, chunk_size):
-    indices = index_marks(dfm.shape[0], chunk_size)
-    return np.split(dfm, indices)
+def chunk_range(num_rows, chunk, chunksize):
+    """
+    :param num_rows: number of documents
+    :param chunk: which chunk to return
+    :param chunksize: number of chunks (chunks hold int(num_rows / chunksize) documents, with the remainder in one more)
+    :return: (start, end) row range of the chunk.  Same split as np.split(df, index_marks(...))[chunk].
+    """
+    if chunksize <= 1:
+        return 0, num_rows
+    target_size = int(num_rows / float(chunksize))
+    bounds = [0] + list(index_marks(num_rows, target_size)) + [num_rows]
+    ranges = [(min(start, num_rows), min(end, num_rows)) for start, end in zip(bounds[:-1], bounds[1:])]
+    return ranges[chunk]
+
+
+def load_note_store(dataset, debug=False):
+    """
+    :param dataset: mimic or columbia
+    :param debug: use the mini version of MIMIC
+    :return: NoteStore of the raw documents.  It is built on first use (or when the raw corpus changes).
+
+    Run with -build_store once before launching chunk jobs in parallel so that they don't each build it.
+    """
+    if dataset == 'mimic':
+        debug_str = '_mini' if debug else ''
+        in_fp = os.path.join(home_dir, 'preprocess/data/mimic/NOTEEVENTS{}.csv'.format(debug_str))
+        notes = iter_noteevents(in_fp)
+    else:
+        in_fp = COLUMBIA_FP
+        notes = iter_columbia_notes(in_fp)
+    store_dir = os.path.splitext(in_fp)[0] + '_store'
+    if not NoteStore.is_fresh(store_dir, in_fp):
+        print('Building note store from {} in {}'.format(in_fp, store_dir))
+        start_time = time()
+        num_notes = build_note_store(store_dir, notes, source_fp=in_fp)
+        print('Stored {} documents in {} seconds'.format(num_notes, round(time() - start_time, 2)))
+    return NoteStore(store_dir)
 
 
 def add_counts(dataset):
@@ -83,9 +121,7 @@ def get_lf_contexts(row, window=20):
     doc_id, doc_category, doc_string = row['ROW_ID'], row['CATEGORY'], row['TEXT']
     contexts, doc_ids, forms, actual_lfs = [], [], [], []
     config = {'type': ContextType.WORD, 'size': window}
-    for lf in LFS:
-        result = CONTEXT_EXTRACTOR.get_contexts_for_long_form(
-            lf, doc_string, config, allow_inflections=False, ignore_case=True)
+    for lf, result in LF_MATCHER.get_contexts(doc_string, config):
         for actual_lf, c in result:
             forms.append(lf)
             contexts.append(c)
@@ -118,45 +154,80 @@ def extract_contexts(dataset, chunk, chunksize, debug):
     df.to_csv('data/{}_context_batches/{}{}.csv'.format(dataset, chunk, debug_str), index=False)
 
 
+def get_lf_contexts_at(doc_idx):
+    return get_lf_contexts(NOTE_STORE.record(doc_idx))
+
+
+def extract_indexed_contexts(dataset, lfs, out_fp, debug):
+    """
+    :param dataset: mimic or columbia
+    :param lfs: LFs for which to mine contexts
+    :param out_fp: csv to which the contexts are saved (same columns as extract_contexts)
+    :param debug: use the mini version of MIMIC
+    :return: None
+
+    Looks up the documents which can contain each LF in the inverted index (built or extended on first use) and only
+    runs the exact LF matcher on those.  Contexts are the same as those from extract_contexts over every chunk.
+    """
+    global LF_MATCHER, NOTE_STORE
+    NOTE_STORE = load_note_store(dataset, debug=debug)
+    index = update_inverted_index(NOTE_STORE.store_dir + '_index', NOTE_STORE)
+    LF_MATCHER = LongFormMatcher(lfs, CONTEXT_EXTRACTOR, allow_inflections=False, ignore_case=True)
+    start_time = time()
+    doc_idxs = set()
+    for alternative_word_forms in LF_MATCHER.alternative_word_forms:
+        doc_idxs.update(index.candidate_documents(alternative_word_forms).tolist())
+    doc_idxs = sorted(doc_idxs)
+    print('{} out of {} documents can contain the {} LFs (looked up in {} seconds)'.format(
+        len(doc_idxs), len(NOTE_STORE), len(lfs), round(time() - start_time, 2)))
+
+    start_time = time()
+    p = Pool()
+    contexts = p.map(get_lf_contexts_at, doc_idxs, chunksize=max(1, len(doc_idxs) // (4 * os.cpu_count())))
+    p.close()
+    print('Took {} seconds'.format(time() - start_time))
+
+    contexts_flat = [y for x in contexts for y in x]
+    df = pd.DataFrame(contexts_flat, columns=['lf', 'lf_match', 'doc_id', 'category', 'context'])
+    print('Saving {} contexts to {}'.format(df.shape[0], out_fp))
+    df.to_csv(out_fp, index=False)
+
+
 def get_mimic_chunk(chunk, chunksize, debug):
     tmp_batch_dir = 'data/mimic_context_batches/'
     if not os.path.exists(tmp_batch_dir):
         print('Creating dir={}'.format(tmp_batch_dir))
         os.mkdir(tmp_batch_dir)
 
-    debug_str = '_mini' if debug else ''
-    in_fp = os.path.join(home_dir, 'preprocess/data/mimic/NOTEEVENTS{}.csv'.format(debug_str))
-    print('Loading MIMIC from {}'.format(in_fp))
-    mimic_df = pd.read_csv(in_fp)
-
-    if chunksize > 1:
-        target_size = int(mimic_df.shape[0] / float(chunksize))
-        mimic_df = split(mimic_df, target_size)[chunk]
-    return mimic_df.to_dict('records')
+    note_store = load_note_store('mimic', debug=debug)
+    start_idx, end_idx = chunk_range(len(note_store), chunk, chunksize)
+    return note_store.records(start_idx, end_idx)
 
 
-def read_columbia_dataset():
-    columbia_data = defaultdict(list)
-    in_fp = '/nlp/projects/BERT_corpus_icu_250M/corpusFiles/train/corpus.txt'
+def iter_columbia_notes(in_fp):
+    """
+    :param in_fp: Columbia corpus.txt (documents are separated by blank lines)
+    :return: generator of (ROW_ID, CATEGORY, TEXT).  ROW_ID is the index of the line which closes the document.
+    """
     print('Loading Columbia data from {}'.format(in_fp))
-    curr_doc = ''
+    curr_doc = []  # Stripped lines of the current document (joined once it is complete)
+    i = -1
     with open(in_fp, 'r') as fd:
         for i, line in enumerate(fd):
             line = line.strip()
             if len(line) == 0 and len(curr_doc) > 0:
-                columbia_data['ROW_ID'].append(i)
-                columbia_data['TEXT'].append(curr_doc.strip())
-                columbia_data['CATEGORY'].append('Columbia ICU/CCU Notes')
-                curr_doc = ''
+                yield i, 'Columbia ICU/CCU Notes', ' '.join(curr_doc).strip()
+                curr_doc = []
             else:
-                curr_doc += line + ' '
+                curr_doc.append(line)
             if (i + 1) % 1000000 == 0:
                 print('Processed {} lines'.format(i + 1))
     if len(curr_doc) > 0:
-        columbia_data['ROW_ID'].append(i)
-        columbia_data['TEXT'].append(curr_doc.strip())
-        columbia_data['CATEGORY'].append('Columbia Notes')
-    columbia_df = pd.DataFrame(columbia_data)
+        yield i, 'Columbia Notes', ' '.join(curr_doc).strip()
+
+
+def read_columbia_dataset():
+    columbia_df = pd.DataFrame(list(iter_columbia_notes(COLUMBIA_FP)), columns=['ROW_ID', 'CATEGORY', 'TEXT'])
     print('Loaded {} documents'.format(columbia_df.shape[0]))
     return columbia_df
 
@@ -167,32 +238,43 @@ def get_columbia_chunk(chunk, chunksize):
         print('Creating dir={}'.format(tmp_batch_dir))
         os.mkdir(tmp_batch_dir)
 
-    columbia_df = read_columbia_dataset()
-    if chunksize > 1:
-        target_size = int(columbia_df.shape[0] / float(chunksize))
-        columbia_chunk_df = split(columbia_df, target_size)[chunk]
-    else:
-        columbia_chunk_df = columbia_df
-    return columbia_chunk_df.to_dict('records')
+    note_store = load_note_store('columbia')
+    start_idx, end_idx = chunk_range(len(note_store), chunk, chunksize)
+    return note_store.records(start_idx, end_idx)
 
 
 if __name__ == '__main__':
     arguments = argparse.ArgumentParser('Clinical Note Acronym Expansion Context Extraction.')
     arguments.add_argument('-add_counts', default=False, action='store_true')
+    arguments.add_argument('-build_store', default=False, action='store_true',
+                           help='Convert the raw corpus into a memory-mapped note store (once) and exit.')
     arguments.add_argument('--chunk', default=0, type=int)
     arguments.add_argument('--chunksize', default=10, type=int)
     arguments.add_argument('-collect', default=False, action='store_true')
     arguments.add_argument('--dataset', default='mimic')
     arguments.add_argument('-debug', default=False, action='store_true')
     arguments.add_argument('-render_stats', default=False, action='store_true')
+    arguments.add_argument('-use_index', default=False, action='store_true',
+                           help='Mine contexts only from the documents which the inverted index says can match.')
+    arguments.add_argument('--lf_fp', default=None,
+                           help='csv with a target_label column of LFs to mine (with -use_index).  Defaults to CASI.')
+    arguments.add_argument('--out_fp', default=None,
+                           help='Output csv for -use_index.  Defaults to data/{dataset}_index_contexts.csv')
 
     args = arguments.parse_args()
 
-    if args.collect:
+    if args.build_store:
+        load_note_store(args.dataset, debug=args.debug)
+    elif args.collect:
         collect_contexts(args.dataset)
     elif args.add_counts:
         add_counts(args.dataset)
     elif args.render_stats:
         render_stats(args.dataset)
+    elif args.use_index:
+        lfs = LFS if args.lf_fp is None else pd.read_csv(args.lf_fp)['target_label'].unique().tolist()
+        debug_str = '_mini' if args.debug else ''
+        out_fp = args.out_fp or 'data/{}_index_contexts{}.csv'.format(args.dataset, debug_str)
+        extract_indexed_contexts(args.dataset, lfs, out_fp, args.debug)
     else:
         extract_contexts(args.dataset, args.chunk, args.chunksize, args.debug)
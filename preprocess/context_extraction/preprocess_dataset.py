@@ -1,17 +1,24 @@
 import argparse
+from bisect import bisect_right
 import json
+from multiprocessing import Pool
 import os
 import re
 import sys
+from time import time
 
 import numpy as np
 import pandas as pd
 
 home_dir = os.path.expanduser('~/LMC/')
 sys.path.insert(0, os.path.join(home_dir, 'preprocess'))
-from mimic_contexts import read_columbia_dataset
+from aho_corasick import AhoCorasick, is_boundary
+from mimic_contexts import load_note_store
 from mimic_tokenize import clean_text, tokenize_str, create_section_token
 
+# Set by resolve_full_context_headers (before the Pool forks)
+NOTE_STORE, ROW_ID_IDXS, HEADER_MATCHER, SECTION_NAMES = None, None, None, None
+
 
 def get_section_names(dataset):
     section_df = pd.read_csv(os.path.join(home_dir, 'preprocess/data/{}/section_freq.csv'.format(dataset))).dropna()
@@ -29,33 +36,87 @@ def _is_header(sectioned_text, idx, section_names):
     return sectioned_text[idx] in section_names and idx + 1 < len(sectioned_text) and sectioned_text[idx + 1] == ':'
 
 
-def get_header_from_full_context(data_df, context, lf_match, doc_id, header_regexes, section_names):
+class HeaderMatcher:
+    """
+    Finds the section headers (a section name followed by ':') of every level of unpack_section_names in one pass of an
+    Aho-Corasick automaton.
+
+    Headers are the same as those from applying r'\\b(level names)(:)' with re.split for each level in turn: a level
+    only matches in the text left between the headers of earlier levels and, at a given position, its names are tried
+    in order.  Names are matched literally and are assumed not to contain ':' (as for names found by compute_sections).
+    """
+    def __init__(self, section_levels):
+        """
+        :param section_levels: output of unpack_section_names
+        """
+        self.num_levels = len(section_levels)
+        patterns, self.pattern_levels = [], []
+        for level_idx, level in enumerate(section_levels):
+            for name_idx, name in enumerate(level):
+                patterns.append(name + ':')
+                self.pattern_levels.append((level_idx, name_idx))
+        self.automaton = AhoCorasick(patterns)
+
+    def find_spans(self, text):
+        """
+        :param text: uppercased text
+        :return: sorted list of (start, end) of each header name.  text[end] is the ':' which follows it.
+        """
+        level_candidates = [[] for _ in range(self.num_levels)]
+        for start, end, pattern_idx in self.automaton.iter_matches(text):
+            if is_boundary(text, start):
+                level_idx, name_idx = self.pattern_levels[pattern_idx]
+                level_candidates[level_idx].append((start, name_idx, end))
+
+        starts, ends = [], []
+        for candidates in level_candidates:
+            level_spans, last_end = [], 0
+            for start, _, end in sorted(candidates):
+                if start < last_end:
+                    continue
+                span_idx = bisect_right(starts, start)
+                if (span_idx > 0 and ends[span_idx - 1] > start) or (span_idx < len(starts) and starts[span_idx] < end):
+                    continue  # Overlaps a header of an earlier level
+                level_spans.append((start, end))
+                last_end = end
+            spans = sorted(list(zip(starts, ends)) + level_spans)
+            starts, ends = [start for start, _ in spans], [end for _, end in spans]
+        return [(start, end - 1) for start, end in zip(starts, ends)]
+
+    def split(self, text):
+        """
+        :param text: uppercased text
+        :return: list of text pieces: the text between headers, each header name and each ':' which follows one
+        """
+        pieces, prev_end = [], 0
+        for start, end in self.find_spans(text):
+            pieces += [text[prev_end:start], text[start:end], ':']
+            prev_end = end + 1
+        pieces.append(text[prev_end:])
+        return pieces
+
+
+def get_context_start(full_context, context, lf_match):
     """
-    :param data_df: dataframe of dataset
+    :param full_context: whitespace-normalized document
     :param context: local context surrounding expansion
     :param lf_match: target LF (center of context)
-    :param doc_id: ROW_ID in which context was found
-    :param header_regexes: list of regexes to extract section headers (see #unpack_section_names for explanation)
-    :return: first header preceding context, if any
-
-    Sometimes the window of text returned contains no section headers, which means we must go back and search through
-    whole document to find appropriate section header.
+    :return: character offset of context in full_context
     """
-    full_contexts = data_df[data_df['ROW_ID'] == doc_id]['TEXT'].tolist()
-    assert len(full_contexts) == 1
-    full_context = re.sub(r'\s+', ' ', full_contexts[0])
     context_repl = context.replace('TARGETWORD', lf_match)
     try:
-        pre_idx = full_context.index(context_repl)
+        return full_context.index(context_repl)
     except:
-        pre_idx = full_context.index(context.split('TARGETWORD')[0].strip()[:-2])
-    relevant_context = full_context[:pre_idx]
-    sep_symbol = ' headersep '
-    sectioned_text = relevant_context.upper()
-    for header_regex in header_regexes:
-        sectioned_text = sep_symbol.join(re.split(header_regex, sectioned_text, flags=re.M))
+        return full_context.index(context.split('TARGETWORD')[0].strip()[:-2])
 
-    sectioned_tokens = list(filter(lambda x: len(x.strip()) > 0, sectioned_text.split(sep_symbol)))
+
+def get_header_from_prefix(relevant_context, header_matcher, section_names):
+    """
+    :param relevant_context: whitespace-normalized document up to (excluding) the context
+    :param header_matcher: HeaderMatcher for the section levels (see #unpack_section_names for explanation)
+    :return: last header in relevant_context, if any
+    """
+    sectioned_tokens = list(filter(lambda x: len(x.strip()) > 0, header_matcher.split(relevant_context.upper())))
 
     headers = []
     for tok_idx, toks in enumerate(sectioned_tokens):
@@ -69,19 +130,110 @@ def get_header_from_full_context(data_df, context, lf_match, doc_id, header_rege
     return headers[-1]
 
 
-def tokenize_rs(text, section_names, header_regexes=None):
+class DocumentSections:
+    """
+    Section header spans of a whole document, computed once and shared by every context found in it.  The header
+    preceding a context is found by bisecting on header ends.
+    """
+    def __init__(self, text, header_matcher, section_names):
+        """
+        :param text: raw document
+        :param header_matcher: HeaderMatcher for the section levels (see #unpack_section_names for explanation)
+        """
+        self.full_context = re.sub(r'\s+', ' ', text)
+        self.header_matcher = header_matcher
+        self.section_names = section_names
+        upper_context = self.full_context.upper()
+        # Offsets only carry over if upper() preserves length (i.e. no \u00df -> SS)
+        self.use_offsets = len(upper_context) == len(self.full_context)
+        if not self.use_offsets:
+            return
+
+        spans = []
+        for start, end in header_matcher.find_spans(upper_context):
+            spans.append((start, end + 1, self.get_section_token(upper_context[start:end])))
+        self.header_starts = [start for start, _, _ in spans]
+        self.header_ends = [end for _, end, _ in spans]
+        # last_headers[i] is the last valid header among the first i spans
+        self.last_headers = ['<pad>']
+        for _, _, section_token in spans:
+            self.last_headers.append(self.last_headers[-1] if section_token is None else section_token)
+
+    def get_section_token(self, header):
+        """
+        :param header: header name found by the HeaderMatcher
+        :return: section token if get_header_from_prefix would count the header, else None
+        """
+        if len(header.strip()) == 0:
+            return None
+        header_stripped = header.strip().strip(':').upper()
+        if header in self.section_names and header_stripped in self.section_names:
+            return create_section_token(header_stripped)
+        return None
+
+    def get_header(self, context, lf_match):
+        """
+        :param context: local context surrounding expansion
+        :param lf_match: target LF (center of context)
+        :return: first header preceding context, if any.  Same as get_header_from_prefix on the text before context.
+        """
+        pre_idx = get_context_start(self.full_context, context, lf_match)
+        if self.use_offsets:
+            span_idx = bisect_right(self.header_ends, pre_idx)
+            # A header which straddles pre_idx may hide shorter ones which end before it.  Fall back on the prefix.
+            if span_idx == len(self.header_starts) or self.header_starts[span_idx] >= pre_idx:
+                return self.last_headers[span_idx]
+        return get_header_from_prefix(self.full_context[:pre_idx], self.header_matcher, self.section_names)
+
+
+def _resolve_document_headers(doc_queries):
+    doc_id, queries = doc_queries
+    doc_sections = DocumentSections(NOTE_STORE.get_text(ROW_ID_IDXS[doc_id]), HEADER_MATCHER, SECTION_NAMES)
+    return [(row_pos, doc_sections.get_header(context, lf_match)) for row_pos, context, lf_match in queries]
+
+
+def resolve_full_context_headers(note_store, queries, header_matcher, section_names):
+    """
+    :param note_store: NoteStore of the dataset
+    :param queries: list of (row position, context, lf_match, doc_id) for contexts without a header in their window
+    :param header_matcher: HeaderMatcher for the section levels (see #unpack_section_names for explanation)
+    :return: dictionary from row position to the first header preceding the context in its full document
+
+    Sometimes the window of text returned contains no section headers, which means we must go back and search through
+    whole document to find appropriate section header.  Contexts are grouped by document so that each document is
+    read and sectioned once.  Documents are processed in parallel.
+    """
+    global NOTE_STORE, ROW_ID_IDXS, HEADER_MATCHER, SECTION_NAMES
+    NOTE_STORE, HEADER_MATCHER, SECTION_NAMES = note_store, header_matcher, section_names
+    ROW_ID_IDXS = {int(row_id): idx for idx, row_id in enumerate(note_store.row_ids.tolist())}
+    assert len(ROW_ID_IDXS) == len(note_store)
+
+    doc_queries = {}
+    for row_pos, context, lf_match, doc_id in queries:
+        doc_queries.setdefault(int(doc_id), []).append((row_pos, context, lf_match))
+    doc_queries = list(doc_queries.items())
+    start_time = time()
+    p = Pool()
+    doc_headers = p.map(_resolve_document_headers, doc_queries,
+                        chunksize=max(1, len(doc_queries) // (4 * os.cpu_count())))
+    p.close()
+    p.join()
+    print('Found headers for {} contexts across {} documents in {} seconds'.format(
+        len(queries), len(doc_queries), round(time() - start_time, 2)))
+    return {row_pos: header for headers in doc_headers for row_pos, header in headers}
+
+
+def tokenize_rs(text, section_names, header_matcher=None):
     """
     :param text: string, window of text surrounding acronym SF
-    :param header_regexes: list of regexes to extract section headers (see #unpack_section_names for explanation)
+    :param header_matcher: HeaderMatcher for the section levels (see #unpack_section_names for explanation).  Built
+    from section_names if None (pass one in when tokenizing many texts).
     :return: list of tokens including both word tokens and section headers
     """
+    if header_matcher is None:
+        header_matcher = HeaderMatcher(unpack_section_names(section_names))
     tokenized_text = []
-    sep_symbol = ' headersep '
-    sectioned_text = text.upper()
-    for header_regex in header_regexes:
-        sectioned_text = sep_symbol.join(re.split(header_regex, sectioned_text, flags=re.M))
-
-    sectioned_tokens = list(filter(lambda x: len(x.strip()) > 0, sectioned_text.split(sep_symbol)))
+    sectioned_tokens = list(filter(lambda x: len(x.strip()) > 0, header_matcher.split(text.upper())))
     for tok_idx, toks in enumerate(sectioned_tokens):
         if toks == ':':
             continue
@@ -164,10 +316,7 @@ def preprocess_rs(dataset, window=10):
     with open(os.path.join(casi_dir, 'sf_lf_map.json'), 'r') as fd:
         sf_lf_map = json.load(fd)
 
-    if dataset == 'mimic':
-        data_df = pd.read_csv(os.path.join(home_dir, 'preprocess/data/mimic/NOTEEVENTS.csv'))
-    else:
-        data_df = read_columbia_dataset()
+    note_store = load_note_store(dataset)
 
     section_names = get_section_names(args.dataset)
 
@@ -178,13 +327,14 @@ def preprocess_rs(dataset, window=10):
     trimmed_contexts = []
 
     section_levels = unpack_section_names(section_names)
-    header_regexes = list(map(lambda level: r'\b({})(:)'.format('|'.join(level)), section_levels))
+    header_matcher = HeaderMatcher(section_levels)
     print('Tokenizing and extracting context windows...')
     is_valid = []
+    full_context_queries = []  # Contexts whose section is found in the full document (after the loop)
     for row_idx, row in df.iterrows():
         row = row.to_dict()
         context = row['context']
-        tokens = tokenize_rs(context, section_names, header_regexes=header_regexes)
+        tokens = tokenize_rs(context, section_names, header_matcher=header_matcher)
         is_header = list(map(lambda x: 'header=' in x, tokens))
         header_locs = np.where(np.array(is_header))[0]
 
@@ -225,8 +375,7 @@ def preprocess_rs(dataset, window=10):
             left_header_boundary = 0 if left_header is None else left_header_window + 1
 
             if left_header is None:
-                left_header = get_header_from_full_context(
-                    data_df, context, row['lf_match'], row['doc_id'], header_regexes, section_names)
+                full_context_queries.append((len(sections), context, row['lf_match'], row['doc_id']))
 
             right_header_boundary = len(tokens) if right_header_window is None else right_header_window
 
@@ -244,6 +393,11 @@ def preprocess_rs(dataset, window=10):
         if (row_idx + 1) % 1000 == 0:
             print('Processed {} out of {} examples'.format(row_idx + 1, N))
 
+    full_context_headers = resolve_full_context_headers(
+        note_store, full_context_queries, header_matcher, section_names)
+    for row_pos, header in full_context_headers.items():
+        sections[row_pos] = header
+
     df['target_lf_idx'] = df['sf'].combine(df['target_lf_sense'], lambda sf, lf: sf_lf_map[sf].index(lf))
     df['row_idx'] = list(range(df.shape[0]))
     df.rename(columns={'lf': 'target_lf'}, inplace=True)
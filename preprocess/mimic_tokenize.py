@@ -17,12 +17,26 @@ sys.path.insert(0, os.path.join(home_dir, 'utils'))
 from model_utils import render_args
 from compute_sections import HEADER_SEARCH_REGEX
 
-# Loaded so it's available inside scope of preprocess MIMIC without re-loading for every document or having to pickle
-section_df = pd.read_csv(os.path.join(home_dir, 'preprocess/data/mimic/section_freq.csv')).dropna()
-SECTION_NAMES = list(set(list(sorted(section_df['section'].tolist()))))
+SECTION_FREQ_FP = os.path.join(home_dir, 'preprocess/data/mimic/section_freq.csv')
 SEP_REGEX = r'\.\s|\n{2,}|^\s{0,}\d{1,2}\s{0,}[-).]\s{1,}'
 
 
+def load_section_names(section_freq_fp=SECTION_FREQ_FP):
+    """
+    :param section_freq_fp: csv of frequent section headers (output of compute_sections.py)
+    :return: list of frequent section header names
+    """
+    if not os.path.exists(section_freq_fp):
+        raise Exception('{} does not exist.  Please run compute_sections.py first.'.format(section_freq_fp))
+    section_df = pd.read_csv(section_freq_fp).dropna()
+    return list(set(list(sorted(section_df['section'].tolist()))))
+
+
+# Set before the Pool forks (see __main__) so it's available inside scope of preprocess MIMIC without re-loading for
+# every document or having to pickle.  Importing this module does not require section_freq.csv.
+SECTION_NAMES = None
+
+
 def clean_text(text):
     """
     :param text: string representing raw MIMIC note
@@ -38,6 +52,21 @@ def clean_text(text):
     return text
 
 
+def count_tokens(parsed_docs):
+    """
+    :param parsed_docs: list of space delimited tokenized documents (output of preprocess_mimic)
+    :return: dictionary of token counts.  __ALL__ holds the total count of non-metadata tokens
+    """
+    token_cts = defaultdict(int)
+    for doc_idx, doc in enumerate(parsed_docs):
+        for token in doc.split():
+            token_cts[token] += 1
+            # Don't include special tokens in token counts
+            if 'header=' not in token and 'document=' not in token:
+                token_cts['__ALL__'] += 1
+    return token_cts
+
+
 def create_section_token(section):
     """
     :param section: string representing a section header as extracted from MIMIC note
@@ -88,6 +117,8 @@ def preprocess_mimic(input, split_sentences=False):
     section, which is defined as having a corpus count >= 10.
     """
     category, text = input
+    if SECTION_NAMES is None:
+        raise Exception('SECTION_NAMES must be set (i.e. with load_section_names) before tokenizing.')
     stopwords = get_mimic_stopwords()
 
     tokenized_text = []
@@ -139,10 +170,15 @@ if __name__ == '__main__':
     arguments.add_argument('-debug', default=False, action='store_true')
     arguments.add_argument('-split_sentences', default=False, action='store_true')
     arguments.add_argument('-filter_rs', default=False, action='store_true')
+    arguments.add_argument('--section_freq_fp', default=SECTION_FREQ_FP,
+                           help='Frequent section headers (output of compute_sections.py).')
 
     args = arguments.parse_args()
     render_args(args)
 
+    # Fails loudly (before loading the data) if compute_sections.py has not been run
+    SECTION_NAMES = load_section_names(args.section_freq_fp)
+
     # Expand home path (~) so that pandas knows where to look
     print('Loading data...')
     args.mimic_fp = os.path.expanduser(args.mimic_fp)
@@ -173,13 +209,7 @@ if __name__ == '__main__':
     end_time = time()
     print('Took {} seconds'.format(end_time - start_time))
 
-    token_cts = defaultdict(int)
-    for doc_idx, doc in enumerate(parsed_docs):
-        for token in doc.split():
-            token_cts[token] += 1
-            # Don't include special tokens in token counts
-            if 'header=' not in token and 'document=' not in token:
-                token_cts['__ALL__'] += 1
+    token_cts = count_tokens(parsed_docs)
     debug_str = '_mini' if args.debug else ''
     out_tok_fn = args.mimic_fp + '_tokenized{}{}.json'.format(debug_str, sentence_str)
     out_counts_fn = args.mimic_fp + '_token_counts{}{}.json'.format(debug_str, sentence_str)
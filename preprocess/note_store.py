@@ -0,0 +1,136 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+STORE_FILES = {
+    'text': 'text.bin',
+    'offsets': 'text_offsets.npy',
+    'row_ids': 'row_ids.npy',
+    'category_ids': 'category_ids.npy',
+    'meta': 'meta.json',
+}
+
+
+def source_signature(source_fp):
+    """
+    :param source_fp: raw corpus file from which a store is built
+    :return: dictionary which changes whenever the source file does (used to detect stale stores)
+    """
+    stat = os.stat(source_fp)
+    return {'source_fp': os.path.abspath(source_fp), 'size': stat.st_size, 'mtime': int(stat.st_mtime)}
+
+
+def iter_noteevents(in_fp, chunksize=100000):
+    """
+    :param in_fp: NOTEEVENTS-shaped csv with ROW_ID, CATEGORY and TEXT columns
+    :param chunksize: rows parsed at a time (bounds memory)
+    :return: generator of (ROW_ID, CATEGORY, TEXT) in file order
+    """
+    for chunk_df in pd.read_csv(in_fp, usecols=['ROW_ID', 'CATEGORY', 'TEXT'], chunksize=chunksize):
+        for row_id, category, text in zip(chunk_df['ROW_ID'].tolist(), chunk_df['CATEGORY'].tolist(),
+                                          chunk_df['TEXT'].tolist()):
+            yield row_id, category, text
+
+
+def build_note_store(out_dir, notes, source_fp=None):
+    """
+    :param out_dir: directory in which to save the store
+    :param notes: iterable of (ROW_ID (int), CATEGORY, TEXT)
+    :param source_fp: optional raw corpus file.  Its signature is saved so that NoteStore.is_fresh can detect changes.
+    :return: number of notes written
+
+    Texts are streamed as utf-8 to a single file.  Offsets, ROW_IDs and category ids are saved as numpy arrays.  The
+    store is written to a temporary directory and renamed into place so that concurrent readers never see a partial one.
+    """
+    tmp_dir = out_dir.rstrip('/') + '.tmp{}'.format(os.getpid())
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    offsets, row_ids, category_ids, categories = [0], [], [], {}
+    with open(os.path.join(tmp_dir, STORE_FILES['text']), 'wb') as fd:
+        for row_id, category, text in notes:
+            text_bytes = ('' if type(text) == float else text).encode('utf-8')  # Missing TEXT is stored as ''
+            fd.write(text_bytes)
+            offsets.append(offsets[-1] + len(text_bytes))
+            row_ids.append(row_id)
+            category = None if type(category) == float else category
+            if category not in categories:
+                categories[category] = len(categories)
+            category_ids.append(categories[category])
+    np.save(os.path.join(tmp_dir, STORE_FILES['offsets']), np.array(offsets, dtype=np.int64))
+    np.save(os.path.join(tmp_dir, STORE_FILES['row_ids']), np.array(row_ids, dtype=np.int64))
+    np.save(os.path.join(tmp_dir, STORE_FILES['category_ids']), np.array(category_ids, dtype=np.int32))
+    meta = {
+        'num_notes': len(row_ids),
+        'categories': sorted(categories, key=lambda category: categories[category]),
+        'source': None if source_fp is None else source_signature(source_fp),
+    }
+    with open(os.path.join(tmp_dir, STORE_FILES['meta']), 'w') as fd:
+        json.dump(meta, fd)
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.rename(tmp_dir, out_dir)
+    return len(row_ids)
+
+
+class NoteStore:
+    """
+    Read-only, memory-mapped store of raw notes (see build_note_store).  Slicing a range of notes only touches the bytes
+    of those notes, so chunked jobs don't need to re-parse the raw corpus.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, STORE_FILES['meta']), 'r') as fd:
+            self.meta = json.load(fd)
+        self.categories = self.meta['categories']
+        self.offsets = np.load(os.path.join(store_dir, STORE_FILES['offsets']), mmap_mode='r')
+        self.row_ids = np.load(os.path.join(store_dir, STORE_FILES['row_ids']), mmap_mode='r')
+        self.category_ids = np.load(os.path.join(store_dir, STORE_FILES['category_ids']), mmap_mode='r')
+        if self.offsets[-1] > 0:
+            self.text = np.memmap(os.path.join(store_dir, STORE_FILES['text']), dtype=np.uint8, mode='r')
+        else:
+            self.text = np.zeros([0], dtype=np.uint8)  # Can't memory-map an empty file
+
+    @staticmethod
+    def is_fresh(store_dir, source_fp):
+        """
+        :return: True if store_dir holds a complete store built from the current version of source_fp
+        """
+        meta_fp = os.path.join(store_dir, STORE_FILES['meta'])
+        if not os.path.exists(meta_fp):
+            return False
+        with open(meta_fp, 'r') as fd:
+            meta = json.load(fd)
+        return meta['source'] == source_signature(source_fp)
+
+    def __len__(self):
+        return self.meta['num_notes']
+
+    def get_text(self, idx):
+        return self.text[self.offsets[idx]:self.offsets[idx + 1]].tobytes().decode('utf-8')
+
+    def record(self, idx):
+        """
+        :param idx: position of the note in the store
+        :return: {'ROW_ID', 'CATEGORY', 'TEXT'} dictionary
+        """
+        return {
+            'ROW_ID': int(self.row_ids[idx]),
+            'CATEGORY': self.categories[self.category_ids[idx]],
+            'TEXT': self.get_text(idx)
+        }
+
+    def records(self, start_idx=0, end_idx=None):
+        """
+        :param start_idx: first note (by position in the store)
+        :param end_idx: end note (exclusive).  Defaults to the end of the store.
+        :return: list of records (see record) for notes [start_idx, end_idx)
+        """
+        end_idx = len(self) if end_idx is None else end_idx
+        return [self.record(idx) for idx in range(start_idx, end_idx)]
+
+    def to_df(self):
+        return pd.DataFrame(self.records(), columns=['ROW_ID', 'CATEGORY', 'TEXT'])
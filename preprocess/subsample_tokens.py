@@ -10,36 +10,21 @@ from tokens_to_ids import tokens_to_ids
 from vocab import Vocab
 
 
-if __name__ == '__main__':
-    arguments = argparse.ArgumentParser('MIMIC-III Note Subsampling of Tokenized Data.')
-    arguments.add_argument('--tokenized_fp', default='data/mimic/NOTEEVENTS_tokenized')
-    arguments.add_argument('--token_counts_fp', default='data/mimic/NOTEEVENTS_token_counts')
-
-    arguments.add_argument('-debug', default=False, action='store_true')
-    arguments.add_argument('--min_token_count', default=10, type=int, help='Drop all tokens with corpus count below')
-    arguments.add_argument('--subsample_param', default=0.001, type=float, help='Controls probability of keeping words')
-    arguments.add_argument('-split_sentences', default=False, action='store_true')
-
-    args = arguments.parse_args()
-
+def subsample_tokens(tokenized_data, token_counts, min_token_count=10, subsample_param=0.001, seed=1992):
+    """
+    :param tokenized_data: list of space delimited tokenized documents (output of mimic_tokenize.py)
+    :param token_counts: dictionary of corpus token counts (output of mimic_tokenize.py)
+    :param min_token_count: Drop all tokens with corpus count below
+    :param subsample_param: Controls probability of keeping words
+    :param seed: Seed for the random number generator which decides which tokens are kept
+    :return: list of subsampled documents and the vocabulary (with section and document category pseudo-tokens)
+    """
     # Computing random numbers online 1 at a time is inefficient.  Pre-compute a large batch
     # And iterate through using rand_ct as an index to simulating sampling from a binomial
-    np.random.seed(1992)
+    np.random.seed(seed)
     rand_arr = np.random.rand(10000)
     rand_ct = 0
 
-    # Expand home path (~) so that pandas knows where to look
-    args.tokenized_fp = os.path.expanduser(args.tokenized_fp)
-    args.token_counts_fp = os.path.expanduser(args.token_counts_fp)
-
-    debug_str = '_mini' if args.debug else ''
-    sentence_str = '_sentence' if args.split_sentences else ''
-    tokenized_data_fn = '{}{}{}.json'.format(args.tokenized_fp, debug_str, sentence_str)
-    with open(tokenized_data_fn, 'r') as fd:
-        tokenized_data = json.load(fd)
-    token_counts_fn = '{}{}{}.json'.format(args.token_counts_fp, debug_str, sentence_str)
-    with open(token_counts_fn, 'r') as fd:
-        token_counts = json.load(fd)
     N = float(token_counts['__ALL__'])
     print('Subsampling {} tokens'.format(N))
 
@@ -70,10 +55,10 @@ if __name__ == '__main__':
                 subsampled_doc.append(token)
                 categories.add(token)
             else:
-                if wc < args.min_token_count:
+                if wc < min_token_count:
                     continue
                 frac = wc / N
-                keep_prob = min((np.sqrt(frac / args.subsample_param) + 1) * (args.subsample_param / frac), 1.0)
+                keep_prob = min((np.sqrt(frac / subsample_param) + 1) * (subsample_param / frac), 1.0)
                 should_keep = rand_arr[rand_ct] < keep_prob
 
                 rand_ct += 1
@@ -97,6 +82,35 @@ if __name__ == '__main__':
     vocab.category_start_vocab_id = vocab.size()
     print('Adding {} document categories'.format(len(categories)))
     vocab.add_tokens(categories, token_support=0)
+    return tokenized_subsampled_data, vocab
+
+
+if __name__ == '__main__':
+    arguments = argparse.ArgumentParser('MIMIC-III Note Subsampling of Tokenized Data.')
+    arguments.add_argument('--tokenized_fp', default='data/mimic/NOTEEVENTS_tokenized')
+    arguments.add_argument('--token_counts_fp', default='data/mimic/NOTEEVENTS_token_counts')
+
+    arguments.add_argument('-debug', default=False, action='store_true')
+    arguments.add_argument('--min_token_count', default=10, type=int, help='Drop all tokens with corpus count below')
+    arguments.add_argument('--subsample_param', default=0.001, type=float, help='Controls probability of keeping words')
+    arguments.add_argument('-split_sentences', default=False, action='store_true')
+
+    args = arguments.parse_args()
+
+    # Expand home path (~) so that pandas knows where to look
+    args.tokenized_fp = os.path.expanduser(args.tokenized_fp)
+    args.token_counts_fp = os.path.expanduser(args.token_counts_fp)
+
+    debug_str = '_mini' if args.debug else ''
+    sentence_str = '_sentence' if args.split_sentences else ''
+    tokenized_data_fn = '{}{}{}.json'.format(args.tokenized_fp, debug_str, sentence_str)
+    with open(tokenized_data_fn, 'r') as fd:
+        tokenized_data = json.load(fd)
+    token_counts_fn = '{}{}{}.json'.format(args.token_counts_fp, debug_str, sentence_str)
+    with open(token_counts_fn, 'r') as fd:
+        token_counts = json.load(fd)
+    tokenized_subsampled_data, vocab = subsample_tokens(
+        tokenized_data, token_counts, min_token_count=args.min_token_count, subsample_param=args.subsample_param)
 
     subsampled_out_fn = '{}_subsampled{}{}.json'.format(args.tokenized_fp, debug_str, sentence_str)
     print('Saving subsampled tokens to {}'.format(subsampled_out_fn))
@@ -0,0 +1,194 @@
+import os
+
+import argparse
+import numpy as np
+import pandas as pd
+
+home_dir = os.path.expanduser('~/LMC/')
+
+NOTEEVENTS_COLS = ['ROW_ID', 'SUBJECT_ID', 'HADM_ID', 'CHARTDATE', 'CHARTTIME', 'STORETIME', 'CATEGORY', 'DESCRIPTION',
+                   'CGID', 'ISERROR', 'TEXT']
+# Note categories (and approximate relative frequencies) as found in MIMIC-III NOTEEVENTS
+CATEGORIES = [
+    ('Nursing/other', 0.39), ('Radiology', 0.25), ('Nursing', 0.11), ('ECG', 0.09), ('Physician ', 0.07),
+    ('Discharge summary', 0.03), ('Echo', 0.02), ('Respiratory ', 0.02), ('Nutrition', 0.005), ('General', 0.003),
+    ('Rehab Services', 0.003), ('Social Work', 0.001), ('Case Management ', 0.001), ('Pharmacy', 0.001),
+    ('Consult', 0.001)
+]
+# Frequently occurring section headers.  Each one matches compute_sections.HEADER_SEARCH_REGEX when followed by ':'
+FREQUENT_HEADERS = [
+    'Admission Date', 'Discharge Date', 'Date of Birth', 'Service', 'Allergies', 'Attending', 'Chief Complaint',
+    'Major Surgical or Invasive Procedure', 'History of Present Illness', 'Past Medical History', 'Social History',
+    'Family History', 'Physical Exam', 'Pertinent Results', 'Brief Hospital Course', 'Medications on Admission',
+    'Discharge Medications', 'Discharge Disposition', 'Discharge Diagnosis', 'Discharge Condition',
+    'Discharge Instructions', 'Followup Instructions', 'INDICATION', 'COMPARISON', 'FINDINGS', 'IMPRESSION',
+    'TECHNIQUE', 'REASON FOR THIS EXAMINATION', 'Assessment and Plan', 'Review of Systems', 'Neuro',
+    'Cardiovascular', 'Resp', 'Gastrointestinal', 'Genitourinary', 'Skin', 'Labs', 'Plan'
+]
+# De-identification placeholders in the [**...**] format used by MIMIC
+DEID_PATTERNS = [
+    '[**{year}-{month}-{day}**]', '[**Hospital1 {num}**]', '[**Last Name (NamePattern1) {num}**]',
+    '[**First Name8 (NamePattern2) {num}**]', '[**Known lastname {num}**]', '[**Location (un) {num}**]',
+    '[**Telephone/Fax (1) {num}**]', '[**MD Number(3) {num}**]', '[**Doctor Last Name {num}**]'
+]
+DIGIT_PATTERNS = ['{a}', '{a}.{b}', '{a}/{b}', '{a}-{b}', '{a}mg', '{a}%', '{a}.{b} mg/dL']
+SYLLABLES = ['ab', 'al', 'an', 'ar', 'ba', 'ca', 'co', 'de', 'di', 'ed', 'el', 'en', 'er', 'es', 'ga', 'he', 'ia',
+             'ic', 'id', 'il', 'in', 'is', 'it', 'la', 'le', 'li', 'lo', 'ma', 'me', 'mi', 'mo', 'na', 'ne', 'no',
+             'nt', 'ol', 'om', 'on', 'or', 'os', 'pa', 'pe', 'po', 'ra', 're', 'ri', 'ro', 'sa', 'se', 'si', 'ta',
+             'te', 'ti', 'to', 'tr', 'ul', 'um', 'ur', 'us', 've']
+
+
+def build_vocabulary(vocab_size, rng):
+    """
+    :param vocab_size: number of distinct (pseudo-)words
+    :param rng: np.random.RandomState
+    :return: list of unique lowercase words.  Shorter words tend to have lower ranks (i.e. higher frequency)
+    """
+    words, seen = [], set()
+    while len(words) < vocab_size:
+        max_syllables = 2 + min(4, len(words) // 2000)
+        word = ''.join(rng.choice(SYLLABLES, size=rng.randint(1, max_syllables + 1)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+
+def zipf_probs(vocab_size, exponent=1.1):
+    """
+    :param vocab_size: number of ranks
+    :param exponent: Zipf exponent s where p(rank r) is proportional to 1 / r^s
+    :return: normalized numpy array of probabilities
+    """
+    weights = 1.0 / np.power(np.arange(1, vocab_size + 1), exponent)
+    return weights / weights.sum()
+
+
+def _render_deid(rng):
+    pattern = DEID_PATTERNS[rng.randint(len(DEID_PATTERNS))]
+    return pattern.format(year=rng.randint(2100, 2200), month=rng.randint(1, 13), day=rng.randint(1, 29),
+                          num=rng.randint(1, 10000))
+
+
+def _render_digit(rng):
+    pattern = DIGIT_PATTERNS[rng.randint(len(DIGIT_PATTERNS))]
+    return pattern.format(a=rng.randint(0, 250), b=rng.randint(0, 100))
+
+
+def _render_section_body(words, rng, deid_p, digit_p):
+    """
+    :return: string of sentences made up of Zipfian words interspersed with de-id placeholders and numbers
+    """
+    draws = rng.random_sample(len(words))
+    out = []
+    sentence_len = rng.randint(6, 18)
+    for idx, word in enumerate(words):
+        if draws[idx] < deid_p:
+            out.append(_render_deid(rng))
+        elif draws[idx] < deid_p + digit_p:
+            out.append(_render_digit(rng))
+        else:
+            out.append(word)
+        if (idx + 1) % sentence_len == 0:
+            out[-1] += '.' if rng.random_sample() < 0.85 else ','
+    if len(out) > 0 and not out[-1].endswith('.'):
+        out[-1] += '.'
+    return ' '.join(out)
+
+
+def generate_note(word_ids, vocab, rng, num_sections, deid_p=0.02, digit_p=0.05, rare_header_p=0.1):
+    """
+    :param word_ids: ranks of the Zipfian vocabulary to use for the note's tokens
+    :param vocab: list of words returned by build_vocabulary
+    :param rng: np.random.RandomState
+    :param num_sections: number of section headers in the note
+    :param deid_p: probability of a token being replaced by a [**...**] de-identification placeholder
+    :param digit_p: probability of a token being replaced by a number (i.e. 98.6, 120/80, 5mg)
+    :param rare_header_p: probability of a section header being a one-off (i.e. not among FREQUENT_HEADERS)
+    :return: string in the layout of a MIMIC-III note
+
+    Section lengths are random so some sections are empty (consecutive headers), as is common in MIMIC.
+    """
+    words = [vocab[i] for i in word_ids]
+    section_starts = [0] + sorted(rng.randint(0, len(words) + 1, size=num_sections - 1).tolist()) + [len(words)]
+    lines = []
+    for section_idx in range(num_sections):
+        if rng.random_sample() < rare_header_p:
+            header = ' '.join(vocab[i].capitalize() for i in rng.randint(0, len(vocab), size=rng.randint(1, 4)))
+        else:
+            header = FREQUENT_HEADERS[rng.randint(len(FREQUENT_HEADERS))]
+            header = header.upper() if rng.random_sample() < 0.3 else header
+        prefix = '{}. '.format(rng.randint(1, 10)) if rng.random_sample() < 0.1 else ''
+        section_words = words[section_starts[section_idx]:section_starts[section_idx + 1]]
+        body = _render_section_body(section_words, rng, deid_p, digit_p)
+        # Headers either start a new line or (less often) are inlined after at least 4 spaces
+        if section_idx > 0 and rng.random_sample() < 0.2:
+            lines.append('    {}{}: {}'.format(prefix, header, body))
+        else:
+            lines.append('\n{}{}:\n{}'.format(prefix, header, body))
+    return ''.join(lines).lstrip('\n')
+
+
+def generate_noteevents(num_docs, vocab_size=50000, mean_doc_tokens=400, zipf_exponent=1.1, mean_sections=6,
+                        deid_p=0.02, digit_p=0.05, seed=1992):
+    """
+    :param num_docs: number of notes (rows) to generate
+    :param vocab_size: number of distinct words
+    :param mean_doc_tokens: mean number of word tokens per note (lengths are log-normally distributed)
+    :param zipf_exponent: Zipf exponent of the word distribution
+    :param mean_sections: mean number of section headers per note (Poisson distributed, at least 1)
+    :param deid_p: probability of a token being replaced by a [**...**] de-identification placeholder
+    :param digit_p: probability of a token being replaced by a number
+    :param seed: random seed.  The same arguments always produce the same corpus.
+    :return: pd.DataFrame with the columns of MIMIC-III NOTEEVENTS.csv
+    """
+    rng = np.random.RandomState(seed)
+    vocab = build_vocabulary(vocab_size, rng)
+    probs = zipf_probs(vocab_size, exponent=zipf_exponent)
+    category_names = [c[0] for c in CATEGORIES]
+    category_p = np.array([c[1] for c in CATEGORIES])
+    category_p /= category_p.sum()
+
+    sigma = 0.8
+    mu = np.log(mean_doc_tokens) - (sigma ** 2) / 2.0
+    doc_lens = np.maximum(rng.lognormal(mu, sigma, size=num_docs).astype(int), 5)
+    all_word_ids = rng.choice(vocab_size, size=int(doc_lens.sum()), p=probs)
+    doc_offsets = np.concatenate([[0], np.cumsum(doc_lens)])
+    num_sections = np.maximum(rng.poisson(mean_sections, size=num_docs), 1)
+    categories = rng.choice(category_names, size=num_docs, p=category_p)
+
+    rows = []
+    for doc_idx in range(num_docs):
+        word_ids = all_word_ids[doc_offsets[doc_idx]:doc_offsets[doc_idx + 1]]
+        text = generate_note(word_ids, vocab, rng, num_sections[doc_idx], deid_p=deid_p, digit_p=digit_p)
+        chartdate = '21{:02d}-{:02d}-{:02d}'.format(rng.randint(0, 100), rng.randint(1, 13), rng.randint(1, 29))
+        rows.append([doc_idx + 1, rng.randint(1, 100000), rng.randint(100000, 200000), chartdate,
+                     chartdate + ' 00:00:00', chartdate + ' 00:00:00', categories[doc_idx], 'Report',
+                     rng.randint(10000, 30000), None, text])
+    return pd.DataFrame(rows, columns=NOTEEVENTS_COLS)
+
+
+if __name__ == '__main__':
+    arguments = argparse.ArgumentParser('Generate a synthetic corpus in the format of MIMIC-III NOTEEVENTS.csv.')
+    arguments.add_argument('--num_docs', default=10000, type=int)
+    arguments.add_argument('--out_fp', default=os.path.join(home_dir, 'preprocess/data/synthetic/NOTEEVENTS.csv'))
+    arguments.add_argument('--vocab_size', default=50000, type=int)
+    arguments.add_argument('--mean_doc_tokens', default=400, type=int)
+    arguments.add_argument('--mean_sections', default=6, type=int)
+    arguments.add_argument('--zipf_exponent', default=1.1, type=float)
+    arguments.add_argument('--deid_p', default=0.02, type=float)
+    arguments.add_argument('--digit_p', default=0.05, type=float)
+    arguments.add_argument('--seed', default=1992, type=int)
+
+    args = arguments.parse_args()
+    df = generate_noteevents(
+        args.num_docs, vocab_size=args.vocab_size, mean_doc_tokens=args.mean_doc_tokens,
+        zipf_exponent=args.zipf_exponent, mean_sections=args.mean_sections, deid_p=args.deid_p,
+        digit_p=args.digit_p, seed=args.seed)
+    out_dir = os.path.dirname(args.out_fp)
+    if len(out_dir) > 0 and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    print('Saving {} synthetic notes to {}'.format(df.shape[0], args.out_fp))
+    df.to_csv(args.out_fp, index=False)
+    num_bytes = df['TEXT'].str.len().sum()
+    print('Total size of TEXT={} MB'.format(round(num_bytes / float(1 << 20), 2)))
@@ -5,6 +5,21 @@ import numpy as np
 from tqdm import tqdm
 
 
+def convert_tokens_to_ids(tokens, vocab):
+    """
+    :param tokens: list of space delimited subsampled documents
+    :param vocab: Vocab instance containing every token in tokens
+    :return: a flattened numpy array of token ids for the whole corpus
+    """
+    ids = []
+    N = len(tokens)
+    for doc_idx in tqdm(range(N)):
+        doc_ids = vocab.get_ids(tokens[doc_idx].split())
+        assert min(doc_ids) > 0
+        ids += doc_ids
+    return np.array(ids, dtype=int)
+
+
 def tokens_to_ids(args, token_infile):
     """"
     :param args: argparse instance
@@ -26,16 +41,11 @@ def tokens_to_ids(args, token_infile):
     vocab_infile = 'data/vocab{}{}.pk'.format(debug_str, sentence_str)
     with open(vocab_infile, 'rb') as fd:
         vocab = pickle.load(fd)
-    ids = []
-    N = len(tokens)
-    for doc_idx in tqdm(range(N)):
-        doc_ids = vocab.get_ids(tokens[doc_idx].split())
-        assert min(doc_ids) > 0
-        ids += doc_ids
+    ids = convert_tokens_to_ids(tokens, vocab)
 
     print('Saving {} tokens to disc'.format(len(ids)))
     out_fn = 'data/ids{}{}.npy'.format(debug_str, sentence_str)
     with open(out_fn, 'wb') as fd:
-        np.save(fd, np.array(ids, dtype=int))
+        np.save(fd, ids)
     with open(vocab_infile, 'wb') as fd:
         pickle.dump(vocab, fd)
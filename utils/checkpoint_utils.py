@@ -0,0 +1,327 @@
+from collections import OrderedDict
+import inspect
+import os
+import pickle
+from queue import Queue
+import random
+from threading import Thread
+from uuid import uuid4
+
+import numpy as np
+import torch
+
+# Number of restored checkpoints kept in memory by load_inference_state
+INFERENCE_CACHE_SIZE = 2
+_inference_cache = OrderedDict()
+
+
+def atomic_save(state_dict, checkpoint_fp):
+    """
+    :param state_dict: dictionary to serialize with torch.save
+    :param checkpoint_fp: final location of the serialized file
+    :return: None
+
+    Writes to a temporary file in the same directory and renames it into place so that readers never observe a
+    partially written checkpoint.
+    """
+    tmp_fp = checkpoint_fp + '.tmp'
+    torch.save(state_dict, tmp_fp)
+    os.replace(tmp_fp, checkpoint_fp)
+
+
+def optimizer_state_fp(checkpoint_fp, optimizer_id):
+    """
+    :param checkpoint_fp: path to serialized checkpoint
+    :param optimizer_id: id shared by the checkpoint and its optimizer state
+    :return: path of the sidecar file which holds the checkpoint's optimizer state (ignored by find_checkpoint)
+    """
+    return '{}.{}.optimizer'.format(checkpoint_fp, optimizer_id)
+
+
+def _remove_stale_optimizer_states(checkpoint_fp, optimizer_id):
+    """
+    :param checkpoint_fp: path to serialized checkpoint
+    :param optimizer_id: id of the sidecar referenced by checkpoint_fp (None if it doesn't reference one)
+    :return: None
+
+    Deletes the sidecars of previous versions of checkpoint_fp (and any left behind by an interrupted save).
+    """
+    checkpoint_dir, checkpoint_fn = os.path.split(checkpoint_fp)
+    keep_fn = None if optimizer_id is None else os.path.basename(optimizer_state_fp(checkpoint_fp, optimizer_id))
+    for fn in os.listdir(checkpoint_dir or '.'):
+        if fn.startswith(checkpoint_fn + '.') and fn.endswith('.optimizer') and not fn == keep_fn:
+            os.remove(os.path.join(checkpoint_dir, fn))
+
+
+def save_checkpoint_state(state_dict, checkpoint_fp):
+    """
+    :param state_dict: checkpoint dictionary, possibly with an optimizer_state_dict
+    :param checkpoint_fp: final location of the serialized checkpoint
+    :return: None
+
+    The optimizer state (i.e. Adam statistics, which are twice the size of the weights) is written to a sidecar file so
+    that inference loads (see load_inference_state) never read it.  Each save writes its sidecar under a new name, then
+    atomically replaces the checkpoint which references it, and only then deletes the previous sidecar.  A crash at any
+    point therefore leaves the checkpoint on disk paired with its own optimizer state.
+    """
+    state_dict = dict(state_dict)
+    optimizer_state = state_dict.pop('optimizer_state_dict', None)
+    optimizer_id = None
+    if optimizer_state is not None:
+        optimizer_id = uuid4().hex
+        optimizer_fp = optimizer_state_fp(checkpoint_fp, optimizer_id)
+        atomic_save({'id': optimizer_id, 'optimizer_state_dict': optimizer_state}, optimizer_fp)
+        state_dict['optimizer_state'] = {'fn': os.path.basename(optimizer_fp), 'id': optimizer_id}
+    atomic_save(state_dict, checkpoint_fp)
+    _remove_stale_optimizer_states(checkpoint_fp, optimizer_id)
+
+
+def load_checkpoint_state(checkpoint_fp):
+    """
+    :param checkpoint_fp: path to serialized checkpoint
+    :return: checkpoint state including its optimizer_state_dict (read from the sidecar file if there is one).  Tensors
+    are mapped to CPU if no GPU is available.
+
+    Used to resume training.  Older checkpoints hold the optimizer state inline and are returned unchanged.  If the
+    sidecar is missing or belongs to another checkpoint, a warning is printed and optimizer_state_dict is None so that
+    training resumes with a fresh optimizer.
+    """
+    map_location = None if torch.cuda.is_available() else (lambda storage, loc: storage)
+    checkpoint_state = torch.load(checkpoint_fp, map_location=map_location)
+    optimizer_ref = checkpoint_state.pop('optimizer_state', None)
+    if optimizer_ref is not None:
+        optimizer_fp = os.path.join(os.path.dirname(checkpoint_fp), optimizer_ref['fn'])
+        optimizer_state = None
+        if os.path.exists(optimizer_fp):
+            optimizer_state = torch.load(optimizer_fp, map_location=map_location)
+        if optimizer_state is None or not optimizer_state['id'] == optimizer_ref['id']:
+            print('Warning: {} does not hold the optimizer state of {}.  Resuming with a fresh optimizer.'.format(
+                optimizer_fp, checkpoint_fp))
+            checkpoint_state['optimizer_state_dict'] = None
+        else:
+            checkpoint_state['optimizer_state_dict'] = optimizer_state['optimizer_state_dict']
+    return checkpoint_state
+
+
+def capture_rng_state():
+    """
+    :return: dictionary holding the current state of every random number generator used during training
+    """
+    rng_state = {'numpy': np.random.get_state(), 'python': random.getstate(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        rng_state['cuda'] = torch.cuda.get_rng_state_all()
+    return rng_state
+
+
+def restore_rng_state(rng_state):
+    """
+    :param rng_state: dictionary returned by capture_rng_state
+    :return: None
+    """
+    np.random.set_state(rng_state['numpy'])
+    random.setstate(rng_state['python'])
+    torch.set_rng_state(rng_state['torch'])
+    if 'cuda' in rng_state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng_state['cuda'])
+
+
+def find_checkpoint(checkpoint_dir, ckpt=None):
+    """
+    :param checkpoint_dir: Directory in which model weights are serialized
+    :param ckpt: Optional pre-specified epoch from which to restore checkpoint
+    :return: full path of the checkpoint to restore along with the largest epoch encountered while searching
+    """
+    checkpoint_fns = os.listdir(checkpoint_dir)
+    checkpoint_fns = list(filter(
+        lambda x: x.endswith('.pth') and 'results' not in x and 'metrics' not in x, checkpoint_fns))
+    max_checkpoint_epoch, latest_checkpoint_idx = -1, -1
+    for cidx, checkpoint_fn in enumerate(checkpoint_fns):
+        checkpoint_epoch = int(checkpoint_fn.split('_')[-1].split('.')[0])
+        if ckpt is not None and checkpoint_epoch == int(ckpt):
+            latest_checkpoint_idx = cidx
+            break
+        if 'best' in checkpoint_fn and ckpt is None:  # Always select 'best' if it exists in weights directory
+            latest_checkpoint_idx = cidx
+            break
+        max_checkpoint_epoch = max(max_checkpoint_epoch, checkpoint_epoch)
+        if checkpoint_epoch == max_checkpoint_epoch:
+            latest_checkpoint_idx = cidx
+    return os.path.join(checkpoint_dir, checkpoint_fns[latest_checkpoint_idx]), max_checkpoint_epoch
+
+
+def _load_weights(checkpoint_fp):
+    """
+    :param checkpoint_fp: path to serialized checkpoint
+    :return: checkpoint state with all tensors on CPU.  Memory-maps tensor storage when torch.load supports it.
+    Optimizer state is in a sidecar file (see save_checkpoint_state) and is not read.
+    """
+    if 'mmap' in inspect.signature(torch.load).parameters:
+        try:
+            return torch.load(checkpoint_fp, map_location='cpu', mmap=True)
+        except RuntimeError:  # Legacy (non-zipfile) serialization format cannot be memory-mapped
+            pass
+    return torch.load(checkpoint_fp, map_location=lambda storage, loc: storage)
+
+
+def load_inference_state(checkpoint_dir, ckpt=None):
+    """
+    :param checkpoint_dir: Directory in which model weights are serialized
+    :param ckpt: Optional pre-specified epoch from which to restore checkpoint
+    :return: path to the selected checkpoint and its state without optimizer statistics
+
+    Restored states are cached per (path, modification time) so that repeated evaluations of the same checkpoint only
+    read it from disk once.  The returned state is shared across calls and must be treated as read-only: callers should
+    copy any object they intend to mutate (i.e. vocabularies which acronym expanders add tokens to).
+    """
+    checkpoint_fp, _ = find_checkpoint(checkpoint_dir, ckpt=ckpt)
+    key = (checkpoint_fp, os.path.getmtime(checkpoint_fp))
+    if key in _inference_cache:
+        _inference_cache.move_to_end(key)
+        return checkpoint_fp, _inference_cache[key]
+
+    checkpoint_state = _load_weights(checkpoint_fp)
+    checkpoint_state.pop('optimizer_state', None)
+    checkpoint_state.pop('optimizer_state_dict', None)  # Held inline by older checkpoints
+    resolve_static_artifacts(checkpoint_dir, checkpoint_state)
+
+    # A checkpoint which has been overwritten since it was last restored is stale
+    for stale_key in [k for k in _inference_cache if k[0] == checkpoint_fp]:
+        del _inference_cache[stale_key]
+    _inference_cache[key] = checkpoint_state
+    while len(_inference_cache) > INFERENCE_CACHE_SIZE:
+        _inference_cache.popitem(last=False)
+    return checkpoint_fp, checkpoint_state
+
+
+def get_resume_state(checkpoint_fp, checkpoint_state):
+    """
+    :param checkpoint_fp: path to the checkpoint being restored
+    :param checkpoint_state: dictionary as loaded from checkpoint_fp
+    :return: dictionary with (at least) the epoch and batch from which to continue training
+
+    Checkpoints written before resume state was recorded only encode the epoch in their file name.  Training then
+    continues from the start of the following epoch.
+    """
+    resume_state = checkpoint_state.get('resume')
+    if resume_state is None:
+        checkpoint_epoch = int(os.path.basename(checkpoint_fp).split('_')[-1].split('.')[0])
+        resume_state = {'epoch': checkpoint_epoch + 1, 'batch': 0}
+    return resume_state
+
+
+def resolve_static_artifacts(checkpoint_dir, checkpoint_state):
+    """
+    :param checkpoint_dir: Directory in which model weights are serialized
+    :param checkpoint_state: dictionary as loaded from a checkpoint file
+    :return: checkpoint_state with every referenced static artifact loaded in place under its name
+
+    Older checkpoints embed vocabularies directly and are returned unchanged.
+    """
+    for name, artifact_fn in checkpoint_state.pop('artifacts', {}).items():
+        with open(os.path.join(checkpoint_dir, artifact_fn), 'rb') as fd:
+            checkpoint_state[name] = pickle.load(fd)
+    return checkpoint_state
+
+
+def save_static_artifacts(checkpoint_dir, artifacts):
+    """
+    :param checkpoint_dir: Directory in which model weights are serialized
+    :param artifacts: dictionary of name --> picklable object which does not change over the course of training
+    (i.e. vocabularies, metadata counts, tokenizers)
+    :return: dictionary of name --> file name (relative to checkpoint_dir) to be stored in each checkpoint
+
+    Artifacts are written once per experiment.  If the file already exists, it is not re-serialized.
+    """
+    artifact_fns = {}
+    for name, artifact in artifacts.items():
+        artifact_fn = '{}.pk'.format(name)
+        artifact_fp = os.path.join(checkpoint_dir, artifact_fn)
+        if not os.path.exists(artifact_fp):
+            print('Saving static artifact {} to {}'.format(name, artifact_fp))
+            tmp_fp = artifact_fp + '.tmp'
+            with open(tmp_fp, 'wb') as fd:
+                pickle.dump(artifact, fd)
+            os.replace(tmp_fp, artifact_fp)
+        artifact_fns[name] = artifact_fn
+    return artifact_fns
+
+
+def snapshot_to_cpu(obj):
+    """
+    :param obj: arbitrarily nested dict / list / tuple of tensors and python objects (i.e. a model or optimizer
+    state dict)
+    :return: a copy of obj where every tensor has been detached and copied into CPU memory
+
+    The snapshot is decoupled from the live parameters so that the optimizer can keep updating them while the
+    checkpoint is being written.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, OrderedDict):
+        return OrderedDict((k, snapshot_to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, dict):
+        return {k: snapshot_to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(v) for v in obj)
+    return obj
+
+
+class AsyncCheckpointWriter:
+    """
+    Serializes checkpoints on a background thread.  The training loop only pays for copying tensors to CPU memory.
+
+    At most one checkpoint waits in the queue behind the one being written, which bounds the extra host memory to two
+    snapshots.  Errors raised by the background thread are re-raised on the next call into the writer.
+    """
+    def __init__(self):
+        self.error = None
+        self.queue = Queue(maxsize=1)
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            state_dict, checkpoint_fp = item
+            try:
+                save_checkpoint_state(state_dict, checkpoint_fp)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def close(self):
+        """
+        :return: None
+
+        Flushes any pending checkpoints and shuts down the background thread.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self._raise_error()
+
+    def save(self, state_dict, checkpoint_fp):
+        """
+        :param state_dict: dictionary of tensors and python objects to serialize
+        :param checkpoint_fp: final location of the serialized file
+        :return: None
+        """
+        self._raise_error()
+        self.queue.put((snapshot_to_cpu(state_dict), checkpoint_fp))
+
+    def wait(self):
+        """
+        :return: None
+
+        Blocks until every queued checkpoint is on disk.
+        """
+        self.queue.join()
+        self._raise_error()
@@ -3,6 +3,8 @@ import subprocess
 import sys
 
 import numpy as np
+import torch
+import torch.nn as nn
 
 
 # Disable
@@ -17,6 +19,29 @@ def enable_print():
     sys.stderr = sys.__stderr__
 
 
+def expand_embeddings(embeddings, vocab_size, init_func=None):
+    """
+    :param embeddings: pre-trained nn.Embedding
+    :param vocab_size: new (larger or equal) number of embeddings
+    :param init_func: in-place initializer applied only to the new rows.  Defaults to standard normal.
+    :return: nn.Embedding whose first rows are copied from embeddings and whose extra rows are randomly initialized
+
+    If no rows need to be added, embeddings is returned unchanged.
+    """
+    prev_vocab_size, embed_dim = embeddings.weight.size()
+    if vocab_size == prev_vocab_size:
+        return embeddings
+    expanded = nn.Embedding(vocab_size, embed_dim, padding_idx=embeddings.padding_idx)
+    with torch.no_grad():
+        expanded.weight[:prev_vocab_size] = embeddings.weight
+        new_rows = expanded.weight[prev_vocab_size:]
+        if init_func is None:
+            new_rows.normal_(0, 1)
+        else:
+            init_func(new_rows)
+    return expanded
+
+
 def get_git_revision_hash():
     """
     :return: current git hash
@@ -57,3 +82,15 @@ def render_num_params(model, vocab_size):
             pm_size += np.array(size).prod()
         full_pm_size += np.array(size).prod()
     print('Model has {} parameters.  {} without counting embeddings'.format(full_pm_size, pm_size))
+
+
+def parameters_state(module):
+    """
+    :param module: PyTorch module
+    :return: hashable snapshot which changes whenever any parameter of module is updated or moved
+
+    In-place updates (i.e. load_state_dict) bump a tensor's _version and moving devices changes data_ptr.  Used to
+    invalidate caches of values derived from the weights.  Optimizer steps which update p.data in place (as in older
+    versions of torch) are not detected so modules must also drop such caches when they enter training mode.
+    """
+    return tuple((p.data_ptr(), p._version) for p in module.parameters())
@@ -0,0 +1,150 @@
+from contextlib import contextmanager
+import inspect
+import os
+
+import torch
+
+try:
+    import torch.profiler as torch_profiler
+except ImportError:  # torch < 1.8.1 only ships the autograd profiler
+    torch_profiler = None
+
+# record_function ranges are only emitted while a TrainingProfiler is active
+_active = False
+
+
+def add_profile_args(parser):
+    """
+    :param parser: argparse.ArgumentParser of a training or evaluation entry point
+    :return: None
+
+    Registers the arguments shared by every entry point which supports profiling.
+    """
+    parser.add_argument('-profile', '--profile', default=False, action='store_true', help=(
+        'Profile a window of steps with torch.profiler.  Chrome traces and operator tables are saved to the '
+        'experiment\'s weights directory.'))
+    parser.add_argument('--profile_wait', default=5, type=int, help='Steps to skip before profiling.')
+    parser.add_argument('--profile_warmup', default=2, type=int, help='Steps traced but discarded before profiling.')
+    parser.add_argument('--profile_active', default=10, type=int, help='Number of steps to profile.')
+
+
+@contextmanager
+def _null_range():
+    yield
+
+
+def record_function(name):
+    """
+    :param name: label of the range (i.e. batch_building, encoder, decoder, kl, hinge)
+    :return: context manager which labels the enclosed ops in the profiler trace.  A no-op unless profiling.
+    """
+    if _active and hasattr(torch.autograd.profiler, 'record_function'):
+        return torch.autograd.profiler.record_function(name)
+    return _null_range()
+
+
+class TrainingProfiler:
+    """
+    Profiles a window of steps (batches) with torch.profiler: CPU (and CUDA if available) activities, input shapes and
+    memory.  The first wait steps are skipped, the next warmup steps are traced and discarded, and the following active
+    steps are recorded.  Call step() after every batch and close() once done.
+
+    On torch versions without torch.profiler, the autograd profiler records the active steps instead (with whichever
+    of record_shapes and profile_memory it supports).
+
+    Outputs (within out_dir):
+    - {name}_trace.json: Chrome trace (open in chrome://tracing or https://ui.perfetto.dev)
+    - {name}_ops.txt: operator summary tables sorted by self CPU time and grouped by input shape
+    """
+    def __init__(self, args, out_dir, name='profile'):
+        """
+        :param args: argparse instance with profile, profile_wait, profile_warmup and profile_active (see
+        add_profile_args).  Profiling is disabled if args has no profile attribute.
+        :param out_dir: directory (i.e. weights/{model}/{experiment}) in which to save traces
+        :param name: prefix for output files
+        """
+        self.enabled = getattr(args, 'profile', False)
+        self.out_dir = out_dir
+        self.name = name
+        self.step_ct = 0
+        self.prof = None
+        self.finished = not self.enabled
+        if not self.enabled:
+            return
+        self.wait, self.warmup, self.active = args.profile_wait, args.profile_warmup, args.profile_active
+
+        global _active
+        _active = True
+        if torch_profiler is not None:
+            activities = [torch_profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch_profiler.ProfilerActivity.CUDA)
+            self.prof = torch_profiler.profile(
+                activities=activities,
+                schedule=torch_profiler.schedule(wait=self.wait, warmup=self.warmup, active=self.active, repeat=1),
+                on_trace_ready=self._export, record_shapes=True, profile_memory=True)
+            self.prof.__enter__()
+        elif self.wait + self.warmup == 0:
+            self._start_legacy()
+        print('Profiling steps {}-{}.  Results will be saved to {}'.format(
+            self.wait + self.warmup + 1, self.wait + self.warmup + self.active, out_dir))
+
+    def _export(self, prof):
+        trace_fp = os.path.join(self.out_dir, '{}_trace.json'.format(self.name))
+        ops_fp = os.path.join(self.out_dir, '{}_ops.txt'.format(self.name))
+        prof.export_chrome_trace(trace_fp)
+        sort_by = 'self_cpu_time_total'
+        with open(ops_fp, 'w') as fd:
+            fd.write(prof.key_averages().table(sort_by=sort_by, row_limit=50))
+            fd.write('\n\n')
+            try:
+                fd.write(prof.key_averages(group_by_input_shape=True).table(sort_by=sort_by, row_limit=50))
+            except TypeError:  # Older autograd profiler does not group by input shape
+                pass
+        print('Saved profiler trace to {} and operator summary to {}'.format(trace_fp, ops_fp))
+
+    def _start_legacy(self):
+        profile_kwargs = {'use_cuda': torch.cuda.is_available()}
+        legacy_params = inspect.signature(torch.autograd.profiler.profile).parameters
+        for param in ['record_shapes', 'profile_memory']:
+            if param in legacy_params:
+                profile_kwargs[param] = True
+        self.prof = torch.autograd.profiler.profile(**profile_kwargs)
+        self.prof.__enter__()
+
+    def _stop(self):
+        global _active
+        _active = False
+        self.finished = True
+        if self.prof is None:
+            return
+        self.prof.__exit__(None, None, None)
+        if torch_profiler is None:
+            self._export(self.prof)
+        self.prof = None
+
+    def close(self):
+        """
+        :return: None
+
+        Stops profiling if the window has not been fully stepped through (i.e. fewer batches than wait + warmup +
+        active).  Whatever was recorded is still exported.
+        """
+        if not self.finished:
+            self._stop()
+
+    def step(self):
+        """
+        :return: None
+
+        Marks the end of a step (batch).
+        """
+        if self.finished:
+            return
+        self.step_ct += 1
+        if torch_profiler is not None:
+            self.prof.step()
+        elif self.step_ct == self.wait + self.warmup:
+            self._start_legacy()
+        if self.step_ct >= self.wait + self.warmup + self.active:
+            self._stop()
@@ -0,0 +1,223 @@
+from collections import OrderedDict
+import json
+import os
+from time import time
+
+import torch
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+PHASES = ['batch_wait', 'h2d', 'forward', 'backward', 'step']
+
+
+def get_peak_rss_mb():
+    """
+    :return: peak resident set size (MB) of this process and the largest peak among its terminated and waited for
+    children (i.e. Pool workers after join).  Live children, such as the workers of an active DataLoader, are not
+    included (see get_workers_rss_mb).  (None, None) if the platform does not expose it.
+    """
+    if resource is None:
+        return None, None
+    # ru_maxrss is reported in kilobytes on Linux
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+    return round(self_rss, 1), round(children_rss, 1)
+
+
+def get_process_rss_mb(pid):
+    """
+    :param pid: process id
+    :return: current resident set size (MB) of the process.  None if /proc is unavailable (i.e. macOS) or the process
+    has exited.
+    """
+    try:
+        with open('/proc/{}/statm'.format(pid), 'r') as fd:
+            return int(fd.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / float(1 << 20)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def get_workers_rss_mb(data_iter):
+    """
+    :param data_iter: iterator returned by iter(DataLoader)
+    :return: current resident set size (MB) summed over the live worker processes of data_iter.  None for
+    single-process loading or when it can't be read.
+    """
+    workers = getattr(data_iter, '_workers', None)
+    if not workers:
+        return None
+    worker_rss = [get_process_rss_mb(worker.pid) for worker in workers if worker.is_alive()]
+    worker_rss = [rss for rss in worker_rss if rss is not None]
+    return round(sum(worker_rss), 1) if len(worker_rss) > 0 else None
+
+
+def get_queue_depth(data_iter):
+    """
+    :param data_iter: iterator returned by iter(DataLoader)
+    :return: number of prefetched batches waiting to be consumed.  None for single-process loading or when the
+    platform does not implement Queue.qsize (macOS)
+    """
+    data_queue = getattr(data_iter, '_data_queue', None)
+    if data_queue is None:
+        return None
+    try:
+        return data_queue.qsize()
+    except NotImplementedError:
+        return None
+
+
+class TrainingTelemetry:
+    """
+    Breaks down where training time goes.  Each batch is split into consecutive phases:
+
+    - batch_wait: waiting for the batcher / DataLoader to produce the next batch
+    - h2d: host to device transfer
+    - forward, backward, step: model forward pass, backpropagation, and optimizer update (incl. gradient clipping)
+
+    Call start_epoch() before the batch loop, then lap(<phase>) at the end of each phase, and end_batch() with the
+    number of examples and tokens processed.  Every interval batches, and at the end of each epoch, a JSON record is
+    appended to telemetry.jsonl (next to metrics.csv).
+
+    Throughput is measured over every batch.  On GPU, kernel launches return immediately so phases can only be timed by
+    synchronizing with the device at each phase boundary, which stalls the pipeline.  Phases are therefore only timed
+    on one in every sample_interval batches ({phase}_sec sums over those sampled batches).  On CPU, every batch is
+    timed.
+    """
+    def __init__(self, weights_dir, data_iter=None, interval=1000, sample_interval=100):
+        """
+        :param weights_dir: experiment directory where metrics.csv lives
+        :param data_iter: Optional DataLoader iterator whose prefetch queue depth is sampled after each batch
+        :param interval: number of batches per interval record.  0 disables telemetry
+        :param sample_interval: on GPU, phases are timed (with device synchronization) every sample_interval batches
+        """
+        self.enabled = interval > 0
+        self.interval = interval
+        self.sample_interval = max(sample_interval, 1)
+        self.data_iter = data_iter
+        self.out_fp = os.path.join(weights_dir, 'telemetry.jsonl')
+        self.sync = torch.cuda.is_available()
+        self.interval_stats = self._empty_stats()
+        self.epoch_stats = self._empty_stats()
+        self.epoch = None
+        self.last_time = None
+        self.num_batches = 0  # Across epochs.  Determines which batches are sampled
+        self.sampling = False
+        self.peak_workers_rss = None
+
+    def _empty_stats(self):
+        stats = OrderedDict([(phase, 0.0) for phase in PHASES])
+        stats.update({'batches': 0, 'sampled_batches': 0, 'examples': 0, 'tokens': 0, 'queue_depth': 0,
+                      'queue_samples': 0, 'start_time': time()})
+        return stats
+
+    def _start_batch(self):
+        self.sampling = not self.sync or self.num_batches % self.sample_interval == 0
+        if self.sampling:
+            self.last_time = self._now()
+            workers_rss = get_workers_rss_mb(self.data_iter)
+            if workers_rss is not None:
+                self.peak_workers_rss = max(self.peak_workers_rss or 0.0, workers_rss)
+
+    def _now(self):
+        if self.sync:
+            torch.cuda.synchronize()
+        return time()
+
+    def _record(self, record_type, batch, stats):
+        elapsed = time() - stats['start_time']
+        record = OrderedDict([('type', record_type), ('epoch', self.epoch), ('batch', batch),
+                              ('batches', stats['batches']), ('seconds', round(elapsed, 3))])
+        record['examples_per_sec'] = round(stats['examples'] / max(elapsed, 1e-8), 2)
+        record['tokens_per_sec'] = round(stats['tokens'] / max(elapsed, 1e-8), 2)
+        phase_total = sum(stats[phase] for phase in PHASES)
+        for phase in PHASES:
+            record['{}_sec'.format(phase)] = round(stats[phase], 3)
+            record['{}_frac'.format(phase)] = round(stats[phase] / max(phase_total, 1e-8), 4)
+        record['sampled_batches'] = stats['sampled_batches']
+        record['peak_rss_mb'], _ = get_peak_rss_mb()
+        record['workers_rss_mb'] = get_workers_rss_mb(self.data_iter)
+        record['peak_workers_rss_mb'] = self.peak_workers_rss
+        if stats['queue_samples'] > 0:
+            record['queue_depth'] = round(stats['queue_depth'] / float(stats['queue_samples']), 2)
+        else:
+            record['queue_depth'] = None
+        if self.sync:
+            record['peak_cuda_mb'] = round(torch.cuda.max_memory_allocated() / float(1 << 20), 1)
+        with open(self.out_fp, mode='a') as fd:
+            fd.write(json.dumps(record) + '\n')
+        return record
+
+    def start_epoch(self, epoch, data_iter=None):
+        """
+        :param epoch: current epoch
+        :param data_iter: Optional DataLoader iterator for the epoch (a new one is created by every iter(DataLoader))
+        :return: None
+
+        Starts the clock for the first batch_wait phase of the epoch.
+        """
+        self.epoch = epoch
+        if data_iter is not None:
+            self.data_iter = data_iter
+        self.interval_stats = self._empty_stats()
+        self.epoch_stats = self._empty_stats()
+        if self.enabled:
+            self._start_batch()
+
+    def lap(self, phase):
+        """
+        :param phase: one of PHASES which has just completed
+        :return: None
+
+        A no-op (no device synchronization) unless the current batch is sampled.
+        """
+        if not self.enabled or not self.sampling:
+            return
+        now = self._now()
+        self.interval_stats[phase] += now - self.last_time
+        self.epoch_stats[phase] += now - self.last_time
+        self.last_time = now
+
+    def end_batch(self, batch, num_examples, num_tokens):
+        """
+        :param batch: index of the batch within the epoch
+        :param num_examples: number of center words in the batch
+        :param num_tokens: number of center and (non-padded) context tokens in the batch
+        :return: None
+
+        Call at the very end of the training step.  The clock restarts for the next batch_wait phase so that time spent
+        checkpointing between lap('step') and end_batch is not attributed to any phase.
+        """
+        if not self.enabled:
+            return
+        queue_depth = get_queue_depth(self.data_iter)
+        for stats in [self.interval_stats, self.epoch_stats]:
+            stats['batches'] += 1
+            stats['sampled_batches'] += int(self.sampling)
+            stats['examples'] += num_examples
+            stats['tokens'] += num_tokens
+            if queue_depth is not None:
+                stats['queue_depth'] += queue_depth
+                stats['queue_samples'] += 1
+        if self.interval_stats['batches'] >= self.interval:
+            self._record('interval', batch + 1, self.interval_stats)
+            self.interval_stats = self._empty_stats()
+        self.num_batches += 1
+        self._start_batch()
+
+    def end_epoch(self, batch):
+        """
+        :param batch: number of batches completed in the epoch
+        :return: epoch summary record (also printed and written to telemetry.jsonl)
+        """
+        if not self.enabled:
+            return None
+        record = self._record('epoch', batch, self.epoch_stats)
+        print('Epoch={} throughput: {} examples/sec, {} tokens/sec.  Time split: {}.  Peak RSS={} MB'.format(
+            self.epoch, record['examples_per_sec'], record['tokens_per_sec'],
+            ', '.join('{}={}%'.format(phase, round(record['{}_frac'.format(phase)] * 100, 1)) for phase in PHASES),
+            record['peak_rss_mb']))
+        return record